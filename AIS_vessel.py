@@ -2,125 +2,2708 @@ import asyncio
 import websockets
 import sys
 import json
+import gzip
+import struct
 import threading
 import os
 from folium.plugins import MarkerCluster
 import webbrowser
 import folium
+import numpy as np
 import time
-import copy
+import math
+import heapq
 from datetime import datetime
 import signal
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import sqlite3
+import zlib
+import re
+import multiprocessing
+import logging
+import logging.handlers
+import queue
+import atexit
+import calendar
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlparse, parse_qs
+import urllib.request
 from html import escape
+from collections import deque, OrderedDict
+from typing import Optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
 
 # API Configuration
 API_KEY = "<Your API Key Here>"  # Replace with your actual key
 MAP_FILE = "vessel_map.html"
 MAP_UPDATE_INTERVAL = 10  # in seconds
+MAP_RENDER_PROCESS = True  # Write the static map page from a worker process instead of the updater thread
 MMSI_FILTER_FILE = "watched_vessels.txt"
 PORT = 8080
 MAX_MARKERS = 5000  # Optional cap for performance; set to None to disable
+AIS_STREAM_URL = "wss://stream.aisstream.io/v0/stream"  # Point at ws://localhost:8765 to use the replay stand-in
+CAPTURE_FILE = None  # Record raw frames to this file (e.g. "capture.ais.gz") for later replay; None to disable
+REPLAY_FILE = None  # Replay frames from this capture instead of connecting to AISStream.io
+REPLAY_SPEED = 1.0  # 1.0 = recorded pace, N = N times faster, 0 = as fast as possible
+REPLAY_SERVER_PORT = 8765  # Port of the local WebSocket stand-in started with "serve-replay"
+FRAME_QUEUE_SIZE = 50000  # Raw frames buffered between the WebSocket receiver and the ingest worker
+FRAME_QUEUE_POLICY = "drop-oldest"  # When full: "drop-oldest" discards the oldest frame, "block" pauses reading
+INGEST_BATCH_SIZE = 500  # Maximum frames applied per vessels_lock acquisition
+GZIP_MIN_SIZE = 1024  # Compress HTTP responses at least this large when the client accepts gzip
+DYNAMIC_MAP = False  # Write the map page once and stream vessel changes into it instead of rebuilding it
+DYNAMIC_POLL_INTERVAL = 2  # Seconds between dynamic map polls of /vessels/delta
+SPATIAL_CELL_SIZE = 0.5  # Degrees of latitude/longitude per spatial index cell
+EARTH_RADIUS_KM = 6371.0088
+CLUSTER_MAX_ZOOM = 12  # Highest zoom served as clusters; closer zooms get individual vessels
+CLUSTER_GRID = 8  # Cluster cells per tile side (power of two; 8 gives 32px cells on 256px tiles)
+CLUSTER_PENDING_CELLS = 20000  # Changed finest cells buffered on ingest before they are folded into every zoom
+SEARCH_RESULT_LIMIT = 10  # Matches returned by /find_vessel and /autocomplete
+TRACK_DB_FILE = "vessel_tracks.db"  # SQLite position history behind /track; None to disable
+TRACK_PARTITION_SECONDS = 3600  # Time span of each history table; old tables are dropped whole
+TRACK_RETENTION = 48 * 3600  # Seconds of position history to keep
+TRACK_FLUSH_INTERVAL = 2  # Seconds between batched history writes
+TRACK_BUFFER_SIZE = 200000  # Positions held for the writer before the oldest are dropped
+TRAIL_TOLERANCE_PX = 1.5  # On-screen error allowed when simplifying trails, in pixels at the requested zoom
+TRAIL_SEGMENT_POINTS = 256  # Live trail points buffered before the older part is simplified for good
+TRAIL_CACHE_SIZE = 2000  # Simplified (MMSI, zoom) trails kept in memory
+STATE_CHECKPOINT_FILE = "vessel_state.ckpt"  # Binary checkpoint of the vessel table for warm restarts; None to disable
+STATE_LOG_FILE = "vessel_state.log"  # Changes appended since the last checkpoint
+STATE_LOG_MAX_BYTES = 8 * 1024 * 1024  # Write a fresh checkpoint once the change log grows past this
+FRAME_DECODER = "auto"  # "msgspec", "orjson" or "json"; "auto" picks the fastest one installed
+INGEST_PROCESSES = 0  # Worker processes that decode frames sharded by MMSI; 0 decodes on the ingest thread
+SHARD_QUEUE_BATCHES = 64  # Batches waiting per worker process before the dispatcher blocks
+STATIC_RESEND_INTERVAL = 600  # Seconds a worker suppresses unchanged ShipStaticData for the same vessel
+SUBSCRIPTION_REGIONS = None  # {"name": [boxes], ...} opens one connection per region; None subscribes to BOUNDING_BOXES at once
+DEDUP_WINDOW = 60  # Seconds a (MMSI, message type, time) report is remembered to drop copies from overlapping regions
+LOG_LEVEL = "INFO"  # "DEBUG" also logs every HTTP request and map build step
+LOG_RATE_LIMIT = 10  # Records per message per LOG_RATE_INTERVAL before the rest are counted instead of printed
+LOG_RATE_INTERVAL = 60  # Seconds
+LATENCY_SAMPLE_EVERY = 100  # Measure AIS-timestamp-to-applied latency on every Nth frame
+DISPLAY_TTL = 1800  # Seconds without a report before a vessel leaves the map
+RETENTION_TTL = 7200  # Seconds without a report before a vessel is dropped from memory
+DEAD_RECKONING = True  # Project positions forward from course and speed between reports when serving them
+DEAD_RECKONING_MAX_AGE = 600  # Seconds after a report beyond which a vessel is shown where it last reported
+DEAD_RECKONING_MIN_SPEED = 0.5  # Knots; slower vessels (moored, at anchor, GPS jitter) are not moved
+ENCOUNTER_CPA_NM = 0.5  # Closest point of approach, in nautical miles, at or below which two vessels are an encounter
+ENCOUNTER_TCPA_MINUTES = 20  # How far ahead an approach may be to count
+ENCOUNTER_CHECK_INTERVAL = 10  # Seconds between fleet-wide encounter passes; 0 evaluates only when /encounters is asked
+ENCOUNTER_MIN_SPEED = 1.0  # Knots; pairs where neither vessel moves this fast (moored alongside each other) are skipped
+ENCOUNTER_MAX_CPA_NM = 10  # Largest cpa /encounters accepts, to bound the candidate pairs of one pass
+ENCOUNTER_MAX_TCPA_MINUTES = 120  # Largest tcpa /encounters accepts
+ENCOUNTER_CHUNK_SIZE = 4096  # Moving vessels whose candidate pairs are built and checked at once
+HEATMAP = True  # Keep vessel density and traffic counters for the heatmap layers and /heatmap tiles
+HEATMAP_MAX_ZOOM = 10  # Finest zoom with its own counters; closer zooms enlarge its cells
+HEATMAP_GRID = 32  # Heatmap cells per tile side (power of two up to 256; 32 gives 8px cells on 256px tiles)
+HEATMAP_HALF_LIFE = 6 * 3600  # Seconds for a cell's traffic to halve without new reports
+HEATMAP_MAX_GAP = 600  # Longest silence between two reports of a vessel still counted as time spent where it is
+HEATMAP_PENDING_CELLS = 20000  # Changed finest cells buffered on ingest before they are added up into every zoom
+VIEW_CACHE_SIZE = 256  # Filtered vessel sets and encoded responses kept for the views clients ask for
+VIEW_CACHE_SECONDS = 5  # Longest a cached view can lag behind vessels ageing off the map
+SNAPSHOT_MAX_AGE = 1.0  # Seconds readers share the last published snapshot before changes make them take a new one
+ALERT_RULES_FILE = "alert_rules.json"  # Geofence, speed, going-dark and ship-type-in-zone rules; None to disable alerts
+ALERT_SINKS = ("log", "sse")  # Where alerts go: "log", "sse" (the map page) and/or "webhook"
+ALERT_WEBHOOK_URL = None  # POST each alert as JSON here when the "webhook" sink is enabled
+ALERT_CHECK_INTERVAL = 5  # Seconds between going-dark checks and rule file reloads
+ALERT_QUEUE_SIZE = 10000  # Alerts waiting for delivery before new ones are dropped
+ALERT_HISTORY = 200  # Recent alerts kept for /alerts
+
+# Adjust these coordinates as you wish, you can use maps for determining coordinates
+# You can add more bounding boxes if needed. Refer below for format.
+# Format: [[min_lat, min_lon], [max_lat, max_lon]]
+# Run "python AIS_vessel.py box-cover" to turn overlapping boxes into non-overlapping regions
+BOUNDING_BOXES = [
+    [[48.155583, -2.926026], [53.684314, 10.279541]], # Northern Europe
+    [[51.373832, 6.060791], [50.104884, 8.665237]], # Rhine river
+    [[50.001780, 8.277969], [47.614036, 7.589722]], # Rhine river
+    [[42.703819, 10.587158], [41.075161, 2.103882]], # Mediterranean
+    [[43.416062, -8.340454], [44.936130, -0.617065]], # Bay of Biscay
+    [[46.166358, -1.210327], [48.232469, 48.232469]], # Central Europe
+    [[46.814774, 1.689119], [47.003679, 8.403625]], # Central Europe
+    [[47.989921, 7.207642], [48.806863, 9.228516]], # Southern Germany
+    [[35.0, -10.0], [60.0, 30.0]] # Europe
+]
+
+# Replaced by each update's vessel JSON in the cached map page template
+MAP_PAYLOAD_PLACEHOLDER = "/*VESSEL_PAYLOAD*/null"
+
+# Heatmap tile colours at these fractions of the log-scaled busiest cell, RGBA from quiet to busy
+HEATMAP_STOPS = np.array([0.0, 0.25, 0.5, 0.75, 1.0])
+HEATMAP_COLORS = np.array([[0, 0, 255, 90], [0, 160, 255, 140], [0, 210, 0, 170], [255, 210, 0, 200], [230, 0, 0, 230]])
+
+# Capture file layout: gzip stream of CAPTURE_MAGIC followed by (receive time, length, frame bytes) records
+CAPTURE_MAGIC = b"AISCAP1\n"
+CAPTURE_RECORD = struct.Struct("<dI")
+
+# Positions returned by ingest worker processes, in arrival order
+SHARD_POSITION_DTYPE = np.dtype([
+    ("mmsi", "<i8"), ("ts", "<f8"), ("lat", "<f8"), ("lon", "<f8"), ("course", "<f8"), ("speed", "<f8"), ("heading", "<f8")
+])
+FRAME_TIME_PATTERN = re.compile(r'"time_utc"\s*:\s*"(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)(\.\d+)?')
+FRAME_KEY_PATTERN = re.compile(r'"MMSI"\s*:\s*(\d+).*?"time_utc"\s*:\s*"([^"]*)"', re.S)
+FRAME_MMSI_PATTERN = re.compile(r'"UserID"\s*:\s*(\d+)')
+FRAME_MMSI_PATTERN_BYTES = re.compile(rb'"UserID"\s*:\s*(\d+)')
+
+# State files: magic and checkpoint id, then blocks of (upserts, deletes, strings length, crc32) headers followed by
+# STATE_DTYPE rows, deleted MMSIs as int64 and a JSON list of [name, callsign] pairs
+CHECKPOINT_MAGIC = b"AISSTAT1"
+STATE_LOG_MAGIC = b"AISSLOG1"
+STATE_HEADER = struct.Struct("<Q")
+STATE_BLOCK = struct.Struct("<IIII")
+STATE_DTYPE = np.dtype([
+    ("mmsi", "<i8"), ("lat", "<f8"), ("lon", "<f8"), ("course", "<f8"), ("speed", "<f8"), ("heading", "<f8"),
+    ("ship_type", "<i2"), ("length", "<f4"), ("width", "<f4"), ("last_update", "<f8")
+])
+
+class RateLimitFilter(logging.Filter):
+    """Let each message template through LOG_RATE_LIMIT times per interval, then report how many were dropped"""
+    def __init__(self, limit=LOG_RATE_LIMIT, interval=LOG_RATE_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows = {}  # Message template -> [window start, records seen]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(record.msg)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[1] - self.limit if window is not None and window[1] > self.limit else 0
+                self.windows[record.msg] = [now, 1]
+                if suppressed:
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+                return True
+            window[1] += 1
+            return window[1] <= self.limit
+
+log = logging.getLogger("ais")
+
+def setup_logging(level=None):
+    """Log to the console from a background thread so callers never wait on terminal I/O"""
+    records = queue.SimpleQueue()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(message)s", "%H:%M:%S"))
+    listener = logging.handlers.QueueListener(records, console)
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(RateLimitFilter())
+    log.addHandler(handler)
+    log.setLevel(level or LOG_LEVEL)
+    log.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms rendered in the Prometheus text format"""
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}  # name -> (type, help, histogram buckets)
+        self.values = {}  # name -> {labels: value, or [bucket counts, sum, count] for histograms}
+
+    def define(self, name, kind, help_text, buckets=None):
+        self.families[name] = (kind, help_text, buckets or self.DEFAULT_BUCKETS)
+        self.values[name] = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.families[name][2]
+        with self.lock:
+            histogram = self.values[name].get(key)
+            if histogram is None:
+                histogram = self.values[name][key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for key, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in self.families.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in self.values[name].items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+                        continue
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets + (float("inf"),), counts):
+                        cumulative += bucket_count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.define("ais_frames_received_total", "counter", "Raw frames received per subscription")
+metrics.define("ais_duplicate_frames_total", "counter", "Frames dropped as copies from overlapping subscriptions")
+metrics.define("ais_reconnects_total", "counter", "WebSocket reconnects per subscription")
+metrics.define("ais_frames_dropped_total", "counter", "Frames dropped because the ingest queue was full")
+metrics.define("ais_ingest_queue_depth", "gauge", "Frames waiting for the ingest worker")
+metrics.define("ais_messages_processed_total", "counter", "AIS messages applied to the vessel table per type")
+metrics.define("ais_decode_errors_total", "counter", "Frames that could not be decoded")
+metrics.define("ais_process_errors_total", "counter", "Decoded messages that failed to apply")
+metrics.define("ais_ingest_latency_seconds", "histogram", "Sampled delay from AIS report time to applied",
+               (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+metrics.define("ais_lock_wait_seconds", "histogram", "Time spent waiting for a lock")
+metrics.define("ais_lock_hold_seconds", "histogram", "Time a lock was held")
+metrics.define("ais_map_build_seconds", "histogram", "Time to select the map vessels and hand their payload to the renderer")
+metrics.define("ais_map_save_seconds", "histogram", "Time to fill in and write the map page")
+metrics.define("ais_map_html_bytes", "gauge", "Size of the last written map page")
+metrics.define("ais_vessels", "gauge", "Vessels in memory by state")
+metrics.define("ais_view_cache_requests_total", "counter", "View cache lookups by result")
+metrics.define("ais_alerts_total", "counter", "Alerts raised per rule type and event")
+metrics.define("ais_alerts_dropped_total", "counter", "Alerts dropped because the delivery queue was full")
+metrics.define("ais_encounter_pass_seconds", "histogram", "Time of one fleet-wide CPA/TCPA encounter pass")
+metrics.define("ais_encounters", "gauge", "Vessel pairs within the encounter thresholds in the last pass")
+metrics.define("ais_vessels_evicted_total", "counter", "Vessels dropped from memory after RETENTION_TTL")
+metrics.define("ais_http_requests_total", "counter", "Control server requests per route")
+metrics.define("ais_uptime_seconds", "gauge", "Seconds since start")
+
+class TimedLock:
+    """Lock that records how long callers waited for it and how long they held it"""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired_at = 0.0
+        self.waited = 0.0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        self.waited = self.acquired_at - started
+        return self
+
+    def __exit__(self, *exc_info):
+        held = time.perf_counter() - self.acquired_at
+        waited = self.waited
+        self.lock.release()
+        metrics.observe("ais_lock_wait_seconds", waited, lock=self.name)
+        metrics.observe("ais_lock_hold_seconds", held, lock=self.name)
 
 # Global variables
-vessels = {}
-vessels_lock = threading.Lock()
+vessels_lock = TimedLock("vessels")
 running = True
 filter_enabled = False
 search_term = ""
+start_time = time.time()
+map_publish_lock = threading.Lock()  # Serializes map page writes with the offline page written on shutdown
+map_template = None  # Static page template when rendering on the updater thread
+map_renderer = None  # MapRenderProcess when MAP_RENDER_PROCESS is on
+last_map_key = None  # (generation, filter, search, rows checksum) of the last published page
+last_map_payload = None
+map_offline = False
+
+class FrameQueue:
+    """Bounded FIFO of raw frames between the WebSocket receiver and the ingest worker"""
+    def __init__(self, maxsize=FRAME_QUEUE_SIZE, policy=FRAME_QUEUE_POLICY):
+        if policy not in ("drop-oldest", "block"):
+            raise ValueError(f"Unknown frame queue policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.frames = deque()
+        self.not_empty = threading.Condition()
+        self.enqueued = 0
+        self.dropped = 0
+        self.processed = 0
+        self.high_water = 0
+
+    def put(self, frame, drop_oldest=True):
+        """Queue a frame; when full either drop the oldest frame or return False"""
+        with self.not_empty:
+            if len(self.frames) >= self.maxsize:
+                if not drop_oldest:
+                    return False
+                self.frames.popleft()
+                self.dropped += 1
+                metrics.inc("ais_frames_dropped_total")
+            self.frames.append(frame)
+            self.enqueued += 1
+            self.high_water = max(self.high_water, len(self.frames))
+            self.not_empty.notify()
+        return True
+
+    def get_batch(self, max_items, timeout=None):
+        """Remove up to max_items frames, waiting up to timeout seconds for the first one"""
+        with self.not_empty:
+            if not self.frames:
+                self.not_empty.wait(timeout)
+            count = min(max_items, len(self.frames))
+            return [self.frames.popleft() for _ in range(count)]
+
+    def mark_processed(self, count):
+        with self.not_empty:
+            self.processed += count
+
+    def stats(self):
+        """Return queue depth and counters"""
+        with self.not_empty:
+            return {
+                "depth": len(self.frames),
+                "max_size": self.maxsize,
+                "policy": self.policy,
+                "high_water": self.high_water,
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "processed": self.processed
+            }
+
+class VesselTable:
+    """Read-only queries shared by the live vessel store and its snapshots"""
+    # (column, dtype, empty value)
+    COLUMNS = (
+        ("mmsi", np.int64, 0),
+        ("lat", np.float64, np.nan),
+        ("lon", np.float64, np.nan),
+        ("course", np.float64, np.nan),
+        ("speed", np.float64, np.nan),
+        ("heading", np.float64, np.nan),
+        ("ship_type", np.int16, 0),
+        ("length", np.float32, np.nan),
+        ("width", np.float32, np.nan),
+        ("last_update", np.float64, 0.0),
+        ("name", object, None),
+        ("callsign", object, None)
+    )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, mmsi):
+        return mmsi in self.rows
+
+    def get(self, mmsi):
+        """Return a vessel as a dict, or None if it is unknown"""
+        row = self.rows.get(mmsi)
+        return None if row is None else self.record(row)
+
+    def record(self, row):
+        """Return one row as a plain dict with the MMSI as a string"""
+        return self.records([row])[0]
+
+    def records(self, rows):
+        """Return rows as plain dicts, reading each column once"""
+        rows = np.asarray(rows, dtype=np.intp)
+        values = {column: getattr(self, column)[rows].tolist() for column, dtype, empty in self.COLUMNS}
+        records = []
+        for i in range(len(rows)):
+            record = {column: values[column][i] for column in values}
+            for column in ("lat", "lon", "course", "speed", "heading", "length", "width"):
+                if record[column] != record[column]:
+                    record[column] = None  # NaN means "not reported"
+            record["mmsi"] = str(record["mmsi"])
+            record["ship_type"] = record["ship_type"] or None
+            records.append(record)
+        return records
+
+    def positioned_rows(self):
+        """Rows of vessels that have reported a position"""
+        n = self.row_count
+        mask = (self.mmsi[:n] != 0) & ~np.isnan(self.lat[:n]) & ~np.isnan(self.lon[:n])
+        return np.flatnonzero(mask)
+
+    def visible_rows(self, now, max_age):
+        """Rows of positioned vessels updated within max_age seconds"""
+        rows = self.positioned_rows()
+        return rows[now - self.last_update[rows] <= max_age]
+
+    def newest(self, rows, limit):
+        """The limit most recently updated rows, newest first"""
+        if len(rows) > limit:
+            rows = rows[np.argpartition(-self.last_update[rows], limit - 1)[:limit]]
+        return rows[np.argsort(-self.last_update[rows], kind="stable")]
+
+    def center(self, rows):
+        """Mean position of the given rows, or None when empty"""
+        if not len(rows):
+            return None
+        return [float(self.lat[rows].mean()), float(self.lon[rows].mean())]
+
+class VesselStore(VesselTable):
+    """Columnar vessel table: one numpy array per field, rows indexed by integer MMSI"""
+    PAGE_SIZE = 1024  # Rows per copy-on-write snapshot page
+    CHANGELOG_LENGTH = 600  # Snapshot generations remembered for changed_since
+
+    def __init__(self, capacity=PAGE_SIZE):
+        self.rows = {}  # MMSI -> row
+        self.free_rows = []
+        self.row_count = 0  # Rows ever handed out; columns are only meaningful below this
+        self.capacity = capacity
+        for column, dtype, empty in self.COLUMNS:
+            setattr(self, column, np.full(capacity, empty, dtype=dtype))
+        self.generation = 0
+        self.pages = []  # Page copies shared by published snapshots
+        self.dirty_pages = set()
+        self.pending_changes = set()  # MMSIs changed since the last snapshot
+        self.changelog = deque(maxlen=self.CHANGELOG_LENGTH)  # (generation, MMSIs changed in it)
+        self.published = None
+
+    def _grow(self):
+        """Double the capacity of every column"""
+        extra = self.capacity
+        for column, dtype, empty in self.COLUMNS:
+            setattr(self, column, np.concatenate((getattr(self, column), np.full(extra, empty, dtype=dtype))))
+        self.capacity += extra
+
+    def _row_for(self, mmsi):
+        """Return the row of a vessel, allocating one if it is new"""
+        row = self.rows.get(mmsi)
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                if self.row_count == self.capacity:
+                    self._grow()
+                row = self.row_count
+                self.row_count += 1
+            self.rows[mmsi] = row
+            self.mmsi[row] = mmsi
+        self.dirty_pages.add(row // self.PAGE_SIZE)
+        self.pending_changes.add(mmsi)
+        return row
+
+    def upsert_position(self, mmsi, lat, lon, course, speed, heading, timestamp):
+        """Insert or update a vessel from a PositionReport"""
+        row = self._row_for(mmsi)
+        self.lat[row] = lat
+        self.lon[row] = lon
+        self.course[row] = course
+        self.speed[row] = speed
+        self.heading[row] = heading
+        self.last_update[row] = timestamp
+        return row
+
+    def upsert_static(self, mmsi, name, ship_type, length, width, callsign, timestamp, lat=None, lon=None):
+        """Insert or update a vessel from ShipStaticData, optionally with its metadata position"""
+        row = self._row_for(mmsi)
+        self.name[row] = name
+        self.ship_type[row] = ship_type or 0
+        self.length[row] = length
+        self.width[row] = width
+        self.callsign[row] = callsign
+        self.last_update[row] = timestamp
+        if lat is not None and lon is not None:
+            self.lat[row] = lat
+            self.lon[row] = lon
+        return row
+
+    def remove(self, mmsi):
+        """Drop a vessel and recycle its row"""
+        row = self.rows.pop(mmsi, None)
+        if row is None:
+            return False
+        for column, dtype, empty in self.COLUMNS:
+            getattr(self, column)[row] = empty
+        self.free_rows.append(row)
+        self.dirty_pages.add(row // self.PAGE_SIZE)
+        self.pending_changes.add(mmsi)
+        return True
+
+    def clear(self):
+        self.__init__(self.capacity)
+
+    def restore(self, fixed, strings):
+        """Replace the table with STATE_DTYPE rows and their [name, callsign] pairs"""
+        capacity = max(self.PAGE_SIZE, -(-len(fixed) // self.PAGE_SIZE) * self.PAGE_SIZE)
+        self.__init__(capacity)
+        for column, dtype, empty in self.COLUMNS:
+            if column in STATE_DTYPE.names:
+                getattr(self, column)[:len(fixed)] = fixed[column]
+        for row, (name, callsign) in enumerate(strings):
+            self.name[row] = name
+            self.callsign[row] = callsign
+        self.row_count = len(fixed)
+        self.rows = {mmsi: row for row, mmsi in enumerate(fixed["mmsi"].tolist())}
+        self.pending_changes = set(self.rows)
+
+    def snapshot(self, max_age=0):
+        """Publish an immutable view of the table, copying only pages changed since the last one; reuse it up to max_age"""
+        if self.published is not None and (not self.pending_changes or time.time() - self.published.taken_at < max_age):
+            return self.published
+        self.generation += 1
+        page_count = -(-self.row_count // self.PAGE_SIZE)
+        pages = self.pages + [None] * (page_count - len(self.pages))
+        for page in range(page_count):
+            if page in self.dirty_pages or pages[page] is None:
+                start = page * self.PAGE_SIZE
+                pages[page] = {}
+                for column, dtype, empty in self.COLUMNS:
+                    copy = getattr(self, column)[start:start + self.PAGE_SIZE].copy()
+                    copy.flags.writeable = False
+                    pages[page][column] = copy
+        self.changelog.append((self.generation, frozenset(self.pending_changes)))
+        self.pending_changes = set()
+        self.dirty_pages = set()
+        self.pages = pages
+        self.published = VesselSnapshot(self.generation, pages, self.row_count)
+        return self.published
+
+    def changed_since(self, generation, until=None):
+        """MMSIs changed after the given snapshot generation (up to until), or None if that is older than the changelog"""
+        until = self.generation if until is None else until
+        if generation >= until:
+            return set()
+        if not self.changelog or self.changelog[0][0] > generation + 1:
+            return None
+        changed = set()
+        for logged_generation, mmsis in self.changelog:
+            if generation < logged_generation <= until:
+                changed |= mmsis
+        return changed
+
+class VesselSnapshot(VesselTable):
+    """Immutable view of the vessel table at one generation; safe to read without vessels_lock"""
+    def __init__(self, generation, pages, row_count):
+        self.generation = generation
+        self.pages = pages
+        self.row_count = row_count
+        self.taken_at = time.time()
+
+    def __getattr__(self, name):
+        # Columns and the MMSI index are assembled from the pages on first use
+        if name == "rows":
+            value = {mmsi: row for row, mmsi in enumerate(self.mmsi.tolist()) if mmsi}
+        elif name in (column for column, dtype, empty in self.COLUMNS):
+            dtype = next(d for column, d, empty in self.COLUMNS if column == name)
+            value = np.concatenate([page[name] for page in self.pages])[:self.row_count] if self.pages \
+                else np.empty(0, dtype=dtype)
+            value.flags.writeable = False
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+class SpatialGrid:
+    """Uniform latitude/longitude grid of vessel positions for viewport and nearest-vessel queries"""
+    def __init__(self, cell_size=SPATIAL_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}  # (lat cell, lon cell) -> set of MMSIs
+        self.positions = {}  # MMSI -> (lat, lon, cell)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def update(self, mmsi, lat, lon):
+        """Move a vessel to a new position; unusable positions drop it from the index"""
+        if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            self.remove(mmsi)  # AIS reports 91/181 when the position is not available
+            return
+        cell = self._cell(lat, lon)
+        previous = self.positions.get(mmsi)
+        if previous is None or previous[2] != cell:
+            if previous is not None:
+                self._discard(mmsi, previous[2])
+            self.cells.setdefault(cell, set()).add(mmsi)
+        self.positions[mmsi] = (lat, lon, cell)
+
+    def remove(self, mmsi):
+        previous = self.positions.pop(mmsi, None)
+        if previous is not None:
+            self._discard(mmsi, previous[2])
+
+    def _discard(self, mmsi, cell):
+        members = self.cells[cell]
+        members.discard(mmsi)
+        if not members:
+            del self.cells[cell]
+
+    def query_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """MMSIs inside a bounding box; boxes with min_lon > max_lon wrap the antimeridian"""
+        if min_lon > max_lon:
+            return self.query_bbox(min_lat, min_lon, max_lat, 180) + self.query_bbox(min_lat, -180, max_lat, max_lon)
+        low_lat, low_lon = self._cell(min_lat, min_lon)
+        high_lat, high_lon = self._cell(max_lat, max_lon)
+        if (high_lat - low_lat + 1) * (high_lon - low_lon + 1) > len(self.cells):
+            candidates = [cell for cell in self.cells
+                          if low_lat <= cell[0] <= high_lat and low_lon <= cell[1] <= high_lon]
+        else:
+            candidates = [(cell_lat, cell_lon) for cell_lat in range(low_lat, high_lat + 1)
+                          for cell_lon in range(low_lon, high_lon + 1) if (cell_lat, cell_lon) in self.cells]
+        found = []
+        for cell in candidates:
+            members = self.cells[cell]
+            if low_lat < cell[0] < high_lat and low_lon < cell[1] < high_lon:
+                found.extend(members)  # Interior cell, no need to check each position
+                continue
+            for mmsi in members:
+                lat, lon, _ = self.positions[mmsi]
+                if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                    found.append(mmsi)
+        return found
+
+    def _around(self, lat, lon, radius_km):
+        """MMSIs in the bounding box of a circle around a point"""
+        radius = radius_km / EARTH_RADIUS_KM
+        min_lat = lat - math.degrees(radius)
+        max_lat = lat + math.degrees(radius)
+        if min_lat <= -90 or max_lat >= 90:
+            return self.query_bbox(max(min_lat, -90), -180, min(max_lat, 90), 180)  # Circle reaches a pole
+        delta_lon = math.degrees(math.asin(min(1.0, math.sin(radius) / math.cos(math.radians(lat)))))
+        min_lon = (lon - delta_lon + 180) % 360 - 180
+        max_lon = (lon + delta_lon + 180) % 360 - 180
+        if delta_lon >= 180 or min_lon == max_lon:
+            return self.query_bbox(min_lat, -180, max_lat, 180)
+        return self.query_bbox(min_lat, min_lon, max_lat, max_lon)
+
+    def nearest(self, lat, lon, k=1, max_distance=None):
+        """Up to k (distance in km, MMSI) pairs closest to a point, optionally within max_distance km"""
+        if not self.positions or k < 1:
+            return []
+        # Widen the search until it holds k vessels, then search the circle their kth distance implies
+        radius = max_distance or math.radians(self.cell_size) * EARTH_RADIUS_KM
+        while True:
+            candidates = self._around(lat, lon, radius)
+            if len(candidates) >= k or radius >= math.pi * EARTH_RADIUS_KM or max_distance:
+                break
+            radius *= 2
+        best = sorted((haversine_km(lat, lon, *self.positions[mmsi][:2]), mmsi) for mmsi in candidates)[:k]
+        if len(best) == k and best[-1][0] > radius:
+            best = sorted((haversine_km(lat, lon, *self.positions[mmsi][:2]), mmsi)
+                          for mmsi in self._around(lat, lon, best[-1][0]))[:k]
+        if max_distance is not None:
+            best = [pair for pair in best if pair[0] <= max_distance]
+        return best
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def tile_bounds(z, x, y):
+    """(min_lon, min_lat, max_lon, max_lat) of a Web Mercator tile"""
+    n = 2 ** z
+    def tile_lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+    return (x / n * 360 - 180, tile_lat(y + 1), (x + 1) / n * 360 - 180, tile_lat(y))
+
+def mercator_cell(lat, lon, scale):
+    """(x, y) cell of a position on a Web Mercator grid of scale cells per world side"""
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    x = int((lon + 180) / 360 * scale)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * scale)
+    return (x if x < scale else scale - 1), (y if y < scale else scale - 1)
+
+class ClusterIndex:
+    """Per-zoom grid clusters of vessel positions with ship type breakdowns, kept up to date on ingest"""
+    def __init__(self, max_zoom=CLUSTER_MAX_ZOOM, grid=CLUSTER_GRID):
+        if grid & (grid - 1):
+            raise ValueError("CLUSTER_GRID must be a power of two")
+        self.max_zoom = max_zoom
+        self.grid = grid
+        self.grid_bits = grid.bit_length() - 1
+        self.scale = 2 ** max_zoom * grid  # Cells per world side at max_zoom
+        self.levels = [{} for _ in range(max_zoom + 1)]  # zoom -> {(cell x, cell y): [count, lat sum, lon sum, {type: count}]}
+        self.members = {}  # MMSI -> (cell x, cell y, lat, lon, type) at max_zoom
+        self.pending = {}  # (cell x, cell y) at max_zoom -> [count, lat sum, lon sum, {type: count}] not yet in the levels
+
+    def __len__(self):
+        return len(self.members)
+
+    def _cell(self, lat, lon):
+        """Web Mercator cell at max_zoom"""
+        return mercator_cell(lat, lon, self.scale)
+
+    def update(self, mmsi, lat, lon, ship_type):
+        """Move a vessel into the cluster cells of its current position and type"""
+        if lat is None or lon is None or lat != lat or lon != lon or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            self.remove(mmsi)
+            return
+        category = get_ship_type_name(ship_type)
+        x, y = self._cell(lat, lon)
+        previous = self.members.get(mmsi)
+        if previous is not None:
+            if previous[0] == x and previous[1] == y and previous[4] == category:
+                return  # Same finest cell, clusters are unchanged
+            self._apply(previous, -1)
+        member = (x, y, float(lat), float(lon), category)
+        self.members[mmsi] = member
+        self._apply(member, 1)
+
+    def remove(self, mmsi):
+        member = self.members.pop(mmsi, None)
+        if member is not None:
+            self._apply(member, -1)
+
+    def _apply(self, member, sign):
+        """Buffer a vessel joining or leaving its finest cell; flush folds the change into the coarser zooms"""
+        x, y, lat, lon, category = member
+        delta = self.pending.get((x, y))
+        if delta is None:
+            delta = self.pending[(x, y)] = [0, 0.0, 0.0, {}]
+        delta[0] += sign
+        delta[1] += sign * lat
+        delta[2] += sign * lon
+        types = delta[3]
+        types[category] = types.get(category, 0) + sign
+        if len(self.pending) >= CLUSTER_PENDING_CELLS:
+            self.flush()
+
+    @staticmethod
+    def _merge(cluster, count, lat_sum, lon_sum, types):
+        cluster[0] += count
+        cluster[1] += lat_sum
+        cluster[2] += lon_sum
+        cluster_types = cluster[3]
+        for category, type_count in types.items():
+            type_count += cluster_types.get(category, 0)
+            if type_count:
+                cluster_types[category] = type_count
+            else:
+                cluster_types.pop(category, None)
+
+    def flush(self):
+        """Apply the buffered cell changes from max_zoom up, merging them per parent cell on the way"""
+        deltas, self.pending = self.pending, {}
+        for zoom in range(self.max_zoom, -1, -1):
+            level = self.levels[zoom]
+            parents = {}
+            for key, delta in deltas.items():
+                cluster = level.get(key)
+                if cluster is None:
+                    cluster = level[key] = [0, 0.0, 0.0, {}]
+                self._merge(cluster, *delta)
+                if not cluster[0]:
+                    del level[key]
+                parent_key = (key[0] >> 1, key[1] >> 1)
+                parent = parents.get(parent_key)
+                if parent is None:
+                    parents[parent_key] = [delta[0], delta[1], delta[2], dict(delta[3])]
+                else:
+                    self._merge(parent, *delta)
+            deltas = parents
+
+    def tile(self, z, x, y):
+        """Clusters inside tile z/x/y as [lat, lon, count, {ship type: count}] rows"""
+        self.flush()
+        level = self.levels[z]
+        base_x = x << self.grid_bits
+        base_y = y << self.grid_bits
+        clusters = []
+        for cell_x in range(base_x, base_x + self.grid):
+            for cell_y in range(base_y, base_y + self.grid):
+                cluster = level.get((cell_x, cell_y))
+                if cluster:
+                    count, lat_sum, lon_sum, types = cluster
+                    clusters.append([round(lat_sum / count, 5), round(lon_sum / count, 5), count, dict(types)])
+        return clusters
+
+class HeatmapGrid:
+    """Per-zoom grid counters of vessels (density) and decayed vessel-hours (traffic) by ship type, kept up to date on ingest"""
+    CATEGORIES = 9  # Unknown, then the ten-code groups of get_ship_type_name from 20-29 to 90-99
+    LAYERS = ("density", "traffic")
+
+    def __init__(self, max_zoom=HEATMAP_MAX_ZOOM, grid=HEATMAP_GRID, half_life=HEATMAP_HALF_LIFE):
+        if grid & (grid - 1) or grid > 256:
+            raise ValueError("HEATMAP_GRID must be a power of two up to 256")
+        self.max_zoom = max_zoom
+        self.grid = grid
+        self.grid_bits = grid.bit_length() - 1
+        self.scale = 2 ** max_zoom * grid  # Cells per world side at max_zoom
+        width = 2 * self.CATEGORIES + 2
+        # Per zoom: cell x << 32 | cell y -> row, and rows of [vessels per category..., traffic per category..., vessels, traffic]
+        self.index = [{} for _ in range(max_zoom + 1)]
+        self.counters = [np.zeros((64, width)) for _ in range(max_zoom + 1)]
+        self.keys = [np.zeros(64, dtype=np.int64) for _ in range(max_zoom + 1)]  # Cell key of each row
+        self.free = [[] for _ in range(max_zoom + 1)]  # Rows of cells that emptied out
+        self.peaks = np.zeros((max_zoom + 1, 2))  # Highest current cell totals per zoom, for colour scaling
+        self.members = {}  # MMSI -> (cell x, cell y, category) at max_zoom of the vessels counted in the density
+        self.pending = {}  # (cell x, cell y, counter) at max_zoom -> amount not yet added up into the zoom levels
+        self.last_report = {}  # MMSI -> time of its last position
+        self.decay = math.log(2) / half_life
+        self.epoch = None  # Traffic is stored as hours * exp(decay * (time - epoch)), so adding never rescales other cells
+
+    @staticmethod
+    def category(ship_type):
+        """Counter index of a ship type code"""
+        return ship_type // 10 - 1 if ship_type and 20 <= ship_type <= 99 else 0
+
+    @staticmethod
+    def category_names():
+        return [get_ship_type_name(code) for code in [0] + list(range(20, 100, 10))]
+
+    def _add(self, x, y, counter, amount):
+        """Buffer amount for one counter of max_zoom cell (x, y); most reports land in a cell that is already pending"""
+        key = (x, y, counter)
+        self.pending[key] = self.pending.get(key, 0.0) + amount
+        if len(self.pending) >= HEATMAP_PENDING_CELLS:
+            self.flush()
+
+    def _row(self, zoom, key):
+        """Counter row of a cell, allocated on first use"""
+        index = self.index[zoom]
+        row = index.get(key)
+        if row is None:
+            if self.free[zoom]:
+                row = self.free[zoom].pop()
+            else:
+                row = len(index)
+                if row == len(self.keys[zoom]):
+                    self.counters[zoom] = np.concatenate([self.counters[zoom], np.zeros_like(self.counters[zoom])])
+                    self.keys[zoom] = np.concatenate([self.keys[zoom], np.zeros_like(self.keys[zoom])])
+            index[key] = row
+            self.keys[zoom][row] = key
+        return row
+
+    def _release(self, zoom, rows):
+        """Forget cells whose rows hold nothing any more"""
+        for row in rows.tolist():
+            del self.index[zoom][int(self.keys[zoom][row])]
+            self.free[zoom].append(row)
+        self.counters[zoom][rows] = 0.0
+
+    def flush(self):
+        """Add the buffered amounts up into the cells of every zoom, one vectorized pass per zoom"""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        cells = np.array(list(pending), dtype=np.int64)
+        amounts = np.fromiter(pending.values(), dtype=np.float64, count=len(pending))
+        counter = cells[:, 2]
+        total = 2 * self.CATEGORIES + (counter >= self.CATEGORIES)
+        for zoom in range(self.max_zoom + 1):
+            shift = self.max_zoom - zoom
+            keys, inverse = np.unique(((cells[:, 0] >> shift) << 32) | (cells[:, 1] >> shift), return_inverse=True)
+            touched = np.fromiter((self._row(zoom, key) for key in keys.tolist()), dtype=np.intp, count=len(keys))
+            rows = touched[inverse]
+            counters = self.counters[zoom]
+            np.add.at(counters, (rows, counter), amounts)
+            np.add.at(counters, (rows, total), amounts)
+            totals = counters[touched, -2:]
+            empty = (totals[:, 0] <= 0) & (totals[:, 1] <= 0)
+            if empty.any():
+                self._release(zoom, touched[empty])
+            # Recomputed rather than raised, so the colour scale follows a busy spike back down; unused rows are zero
+            self.peaks[zoom] = counters[:, -2:].max(axis=0)
+
+    def update(self, mmsi, lat, lon, ship_type):
+        """Count a vessel in the density of its current cell and type; returns its cell, or None without a position"""
+        if lat is None or lon is None or lat != lat or lon != lon or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            self.remove(mmsi)
+            return None
+        x, y = mercator_cell(lat, lon, self.scale)
+        member = (x, y, self.category(ship_type))
+        previous = self.members.get(mmsi)
+        if previous != member:
+            if previous is not None:
+                self._add(previous[0], previous[1], previous[2], -1.0)
+            self.members[mmsi] = member
+            self._add(x, y, member[2], 1.0)
+        return member
+
+    def observe(self, mmsi, lat, lon, ship_type, timestamp):
+        """Count a position report: the vessel's density cell, and the time since its previous report as traffic"""
+        member = self.update(mmsi, lat, lon, ship_type)
+        previous = self.last_report.get(mmsi)
+        self.last_report[mmsi] = timestamp
+        if member is None or previous is None or timestamp <= previous:
+            return
+        if self.epoch is None:
+            self.epoch = timestamp
+        elif (timestamp - self.epoch) * self.decay > 30:
+            self._rebase(timestamp)
+        hours = min(timestamp - previous, HEATMAP_MAX_GAP) / 3600
+        self._add(member[0], member[1], self.CATEGORIES + member[2], hours * math.exp(self.decay * (timestamp - self.epoch)))
+
+    def _rebase(self, timestamp):
+        """Move the decay epoch forward before the stored traffic grows too large, dropping cells that faded out"""
+        self.flush()
+        factor = math.exp(-self.decay * (timestamp - self.epoch))
+        for zoom in range(self.max_zoom + 1):
+            counters = self.counters[zoom]
+            counters[:, self.CATEGORIES:2 * self.CATEGORIES] *= factor
+            counters[:, -1] *= factor
+            live = np.fromiter(self.index[zoom].values(), dtype=np.intp, count=len(self.index[zoom]))
+            faded = live[(counters[live, -2] <= 0) & (counters[live, -1] < 1e-6)]
+            if len(faded):
+                self._release(zoom, faded)
+            self.peaks[zoom] = counters.max(axis=0)[-2:]
+        self.epoch = timestamp
+
+    def remove(self, mmsi):
+        """Take a vessel out of the density; its traffic stays"""
+        member = self.members.pop(mmsi, None)
+        if member is not None:
+            self._add(member[0], member[1], member[2], -1.0)
+
+    def forget(self, mmsi):
+        self.remove(mmsi)
+        self.last_report.pop(mmsi, None)
+
+    def _scale(self, layer, now):
+        """Factor turning stored counters of a layer into current values"""
+        if layer == "density" or self.epoch is None:
+            return 1.0
+        return math.exp(-self.decay * (now - self.epoch))
+
+    def _read(self, zoom, columns, rows, layer, now):
+        """Per-category values of the cells at the crossings of columns and rows of a zoom level"""
+        index = self.index[zoom]
+        keys = (columns[np.newaxis, :] << 32) | rows[:, np.newaxis]
+        found = np.array([index.get(key, -1) for key in keys.ravel().tolist()], dtype=np.intp).reshape(keys.shape)
+        offset = 0 if layer == "density" else self.CATEGORIES
+        values = self.counters[zoom][found, offset:offset + self.CATEGORIES]
+        values[found < 0] = 0.0
+        return values * self._scale(layer, now)
+
+    def tile(self, z, x, y, layer="traffic", now=None):
+        """Counters of the grid x grid bins of tile z/x/y as a [bin row, bin column, category] array
+
+        Beyond max_zoom each max_zoom cell covers several bins, and they all show its counters.
+        """
+        self.flush()
+        zoom = min(z, self.max_zoom)
+        bins = np.arange(self.grid, dtype=np.int64)
+        columns = ((x << self.grid_bits) + bins) >> (z - zoom)
+        rows = ((y << self.grid_bits) + bins) >> (z - zoom)
+        unique_columns, column_bins = np.unique(columns, return_inverse=True)
+        unique_rows, row_bins = np.unique(rows, return_inverse=True)
+        values = self._read(zoom, unique_columns, unique_rows, layer, now or time.time())
+        return values[row_bins][:, column_bins]
+
+    def peak(self, z, layer="traffic", now=None):
+        """Highest cell total of a layer at a zoom, as the top of the colour scale"""
+        self.flush()
+        return float(self.peaks[min(z, self.max_zoom), self.LAYERS.index(layer)]) * self._scale(layer, now or time.time())
+
+    def region(self, min_lat, min_lon, max_lat, max_lon, layer="traffic", max_cells=64, now=None):
+        """Per-category totals of the cells overlapping a bounding box, from the finest zoom needing at most max_cells per side"""
+        if min_lon > max_lon:  # Across the antimeridian
+            west_zoom, west = self.region(min_lat, min_lon, max_lat, 180, layer, max_cells, now)
+            east_zoom, east = self.region(min_lat, -180, max_lat, max_lon, layer, max_cells, now)
+            return min(west_zoom, east_zoom), west + east
+        self.flush()
+        (low_x, high_y), (high_x, low_y) = mercator_cell(min_lat, min_lon, self.scale), mercator_cell(max_lat, max_lon, self.scale)
+        zoom = self.max_zoom
+        while zoom > 0 and max(high_x - low_x, high_y - low_y) >> (self.max_zoom - zoom) >= max_cells:
+            zoom -= 1
+        shift = self.max_zoom - zoom
+        columns = np.arange(low_x >> shift, (high_x >> shift) + 1, dtype=np.int64)
+        rows = np.arange(low_y >> shift, (high_y >> shift) + 1, dtype=np.int64)
+        return zoom, self._read(zoom, columns, rows, layer, now or time.time()).sum(axis=(0, 1))
+
+class SearchIndex:
+    """Trigram index over vessel names, callsigns and MMSIs for ranked substring search"""
+    def __init__(self):
+        self.texts = {}  # MMSI -> (name, callsign, MMSI) as normalised text
+        self.grams = {}  # Trigram -> set of MMSIs
+        self.prefixes = {}  # One and two character word prefixes -> set of MMSIs, for short terms
+
+    def __len__(self):
+        return len(self.texts)
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.lower().split()) if text else ""
+
+    @staticmethod
+    def _keys(texts):
+        grams = set()
+        prefixes = set()
+        for text in texts:
+            for i in range(len(text) - 2):
+                grams.add(text[i:i + 3])
+            for word in text.split():
+                prefixes.add(word[:1])
+                prefixes.add(word[:2])
+        return grams, prefixes
+
+    def add(self, mmsi):
+        """Make a vessel searchable by MMSI until its static data arrives"""
+        if mmsi not in self.texts:
+            self.update(mmsi)
+
+    def update(self, mmsi, name=None, callsign=None):
+        """Index a vessel's current name and callsign"""
+        texts = (self.normalize(name), self.normalize(callsign), str(mmsi))
+        if self.texts.get(mmsi) == texts:
+            return
+        self.remove(mmsi)
+        self.texts[mmsi] = texts
+        grams, prefixes = self._keys(texts)
+        for gram in grams:
+            self.grams.setdefault(gram, set()).add(mmsi)
+        for prefix in prefixes:
+            self.prefixes.setdefault(prefix, set()).add(mmsi)
+
+    def remove(self, mmsi):
+        texts = self.texts.pop(mmsi, None)
+        if texts is None:
+            return
+        grams, prefixes = self._keys(texts)
+        for keys, index in ((grams, self.grams), (prefixes, self.prefixes)):
+            for key in keys:
+                members = index[key]
+                members.discard(mmsi)
+                if not members:
+                    del index[key]
+
+    @staticmethod
+    def _score(term, texts):
+        """Rank a match: exact beats prefix beats word prefix beats substring; 0 means no match"""
+        name, callsign, mmsi = texts
+        if term == mmsi:
+            return 100
+        if term == name:
+            return 90
+        if term == callsign:
+            return 85
+        if name.startswith(term):
+            return 70
+        if mmsi.startswith(term):
+            return 65
+        if any(word.startswith(term) for word in name.split()):
+            return 60
+        if callsign.startswith(term):
+            return 55
+        if term in name:
+            return 40
+        if term in callsign:
+            return 30
+        if term in mmsi:
+            return 20
+        return 0
+
+    def search(self, term, limit=SEARCH_RESULT_LIMIT, scope=None):
+        """Best matching MMSIs for a term, optionally restricted to a set of MMSIs; limit None returns all"""
+        term = self.normalize(term)
+        if not term:
+            return []
+        if len(term) < 3:
+            candidates = self.prefixes.get(term, set())
+        else:
+            postings = sorted((self.grams.get(term[i:i + 3], set()) for i in range(len(term) - 2)), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+        if scope is not None:
+            candidates = candidates & scope if len(scope) < len(candidates) else scope & candidates
+        scored = []
+        for mmsi in candidates:
+            score = self._score(term, self.texts[mmsi])
+            if score:
+                scored.append((-score, self.texts[mmsi][0], mmsi))
+        best = sorted(scored) if limit is None else heapq.nsmallest(limit, scored)
+        return [mmsi for _, _, mmsi in best]
+
+class VesselExpiry:
+    """Min-heap of per-vessel deadlines that hides vessels after display_ttl and evicts them after retention_ttl"""
+    def __init__(self, display_ttl=DISPLAY_TTL, retention_ttl=RETENTION_TTL):
+        self.display_ttl = display_ttl
+        self.retention_ttl = retention_ttl
+        self.last_seen = {}  # MMSI -> last report time
+        self.deadlines = {}  # MMSI -> deadline of its live heap entry; other entries for it are stale
+        self.hidden = set()  # Past display_ttl, not yet evicted
+        self.heap = []  # (deadline, MMSI)
+        self.hide_callbacks = []
+        self.evict_callbacks = []
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def on_hide(self, callback):
+        """Call callback(mmsi) when a vessel leaves the map"""
+        self.hide_callbacks.append(callback)
+
+    def on_evict(self, callback):
+        """Call callback(mmsi) when a vessel is dropped from memory"""
+        self.evict_callbacks.append(callback)
+
+    def touch(self, mmsi, timestamp):
+        """Record a report; refreshed vessels are rescheduled lazily when their old deadline comes up"""
+        self.last_seen[mmsi] = timestamp
+        if mmsi not in self.deadlines or mmsi in self.hidden:
+            self.hidden.discard(mmsi)
+            self._schedule(mmsi, timestamp + self.display_ttl)
+
+    def _schedule(self, mmsi, deadline):
+        self.deadlines[mmsi] = deadline
+        heapq.heappush(self.heap, (deadline, mmsi))
+
+    def reset(self, mmsis, timestamps):
+        """Replace the schedule with a bulk-loaded fleet"""
+        self.last_seen = dict(zip(mmsis, timestamps))
+        self.deadlines = {mmsi: timestamp + self.display_ttl for mmsi, timestamp in self.last_seen.items()}
+        self.hidden = set()
+        self.heap = [(deadline, mmsi) for mmsi, deadline in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
+    def clear(self):
+        self.reset((), ())
+
+    def is_visible(self, mmsi, now):
+        return now - self.last_seen.get(mmsi, -math.inf) <= self.display_ttl
+
+    def expire(self, now):
+        """Hide and evict vessels whose deadline has passed; returns (hidden, evicted) MMSI lists"""
+        hidden, evicted = [], []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, mmsi = heapq.heappop(self.heap)
+            if self.deadlines.get(mmsi) != deadline:
+                continue  # Superseded by a later schedule
+            last_seen = self.last_seen[mmsi]
+            if now - last_seen <= self.display_ttl:
+                self._schedule(mmsi, last_seen + self.display_ttl)
+            elif now - last_seen <= self.retention_ttl:
+                if mmsi not in self.hidden:
+                    self.hidden.add(mmsi)
+                    hidden.append(mmsi)
+                self._schedule(mmsi, last_seen + self.retention_ttl)
+            else:
+                del self.last_seen[mmsi], self.deadlines[mmsi]
+                self.hidden.discard(mmsi)
+                evicted.append(mmsi)
+        for mmsi in hidden:
+            for callback in self.hide_callbacks:
+                callback(mmsi)
+        for mmsi in evicted:
+            for callback in self.evict_callbacks:
+                callback(mmsi)
+        return hidden, evicted
+
+class TrackStore:
+    """Append-only position history in SQLite, one WAL table per time partition keyed by (mmsi, ts)"""
+    def __init__(self, path, partition_seconds=TRACK_PARTITION_SECONDS, retention=TRACK_RETENTION):
+        self.path = path
+        self.partition_seconds = partition_seconds
+        self.retention = retention
+        self.pending = deque(maxlen=TRACK_BUFFER_SIZE)  # (mmsi, ts, lat, lon, course, speed) awaiting flush
+        self.partitions = set()
+        self.connection = None  # Owned by the writer thread
+        self.written = 0
+
+    def append(self, mmsi, timestamp, lat, lon, course, speed):
+        """Queue a position for the next batched write; safe to call from the ingest path"""
+        if lat is not None and lon is not None:
+            self.pending.append((mmsi, timestamp, lat, lon, course, speed))
+
+    def open(self):
+        """Open the writer connection and discover existing partitions"""
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent; only the last commits can be lost
+        tables = self.connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'track_%'")
+        self.partitions = {int(name[len("track_"):]) for name, in tables}
+
+    def _create_partition(self, partition):
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS track_{partition} ("
+            "mmsi INTEGER NOT NULL, ts REAL NOT NULL, lat REAL NOT NULL, lon REAL NOT NULL, course REAL, speed REAL, "
+            "PRIMARY KEY (mmsi, ts)) WITHOUT ROWID"
+        )
+        self.partitions.add(partition)
+
+    def flush(self):
+        """Write every pending position in one transaction and return how many were taken"""
+        if self.connection is None:
+            self.open()
+        batches = {}
+        count = 0
+        while self.pending:
+            point = self.pending.popleft()
+            batches.setdefault(int(point[1] // self.partition_seconds), []).append(point)
+            count += 1
+        if not batches:
+            return 0
+        with self.connection:
+            for partition, points in batches.items():
+                if partition not in self.partitions:
+                    self._create_partition(partition)
+                self.connection.executemany(f"INSERT OR IGNORE INTO track_{partition} VALUES (?, ?, ?, ?, ?, ?)", points)
+        self.written += count
+        return count
+
+    def expire(self, now=None):
+        """Drop partitions that lie entirely outside the retention window"""
+        if self.connection is None:
+            self.open()
+        oldest = int(((now or time.time()) - self.retention) // self.partition_seconds)
+        expired = sorted(partition for partition in self.partitions if partition < oldest)
+        with self.connection:
+            for partition in expired:
+                self.connection.execute(f"DROP TABLE IF EXISTS track_{partition}")
+                self.partitions.discard(partition)
+        return expired
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def query(self, mmsi, since, until=None):
+        """(ts, lat, lon, course, speed) rows for one vessel between since and until, oldest first"""
+        until = time.time() if until is None else until
+        # Positions still waiting for the writer are part of the track too
+        unwritten = [point[1:] for point in list(self.pending) if point[0] == mmsi and since <= point[1] <= until]
+        if not os.path.exists(self.path):
+            return unwritten
+        first = int(since // self.partition_seconds)
+        last = int(until // self.partition_seconds)
+        points = []
+        # Readers use their own connection; WAL lets them run alongside the writer
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            for partition in sorted(p for p in set(self.partitions) if first <= p <= last):
+                try:
+                    points.extend(connection.execute(
+                        f"SELECT ts, lat, lon, course, speed FROM track_{partition} "
+                        "WHERE mmsi = ? AND ts >= ? AND ts <= ? ORDER BY ts",
+                        (mmsi, since, until)
+                    ))
+                except sqlite3.OperationalError:
+                    continue  # Partition expired while we were reading
+        finally:
+            connection.close()
+        if unwritten:
+            written_until = points[-1][0] if points else -math.inf
+            points.extend(point for point in unwritten if point[0] > written_until)
+        return points
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "written": self.written,
+            "partitions": len(self.partitions)
+        }
+
+def trail_tolerance(zoom):
+    """Simplification tolerance in Web Mercator degrees for TRAIL_TOLERANCE_PX at a zoom level"""
+    return TRAIL_TOLERANCE_PX * 360.0 / (256 * 2 ** zoom)
+
+def simplify_trail(points, tolerance):
+    """Douglas-Peucker on Web Mercator coordinates of (ts, lat, lon, ...) points, keeping both ends"""
+    if len(points) < 3:
+        return list(points)
+    lat = np.radians(np.clip([point[1] for point in points], -85.0, 85.0))
+    x = np.degrees(np.unwrap(np.radians([point[2] for point in points])))  # No jump at the antimeridian
+    y = np.degrees(np.log(np.tan(np.pi / 4 + lat / 2)))
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length = math.hypot(dx, dy)
+        distance = np.abs(dx * py - dy * px) / length if length else np.hypot(px, py)
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return [points[i] for i in np.flatnonzero(keep)]
+
+class TrailCache:
+    """LRU cache of simplified vessel trails per (MMSI, zoom), extended as new positions arrive"""
+    def __init__(self, max_entries=TRAIL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (MMSI, zoom) -> trail entry
+        self.zooms = {}  # MMSI -> cached zoom levels, so ingest only touches vessels someone is watching
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, mmsi, timestamp, lat, lon, course, speed):
+        """Extend the cached trails of a vessel with a new position"""
+        if mmsi not in self.zooms or lat is None or lon is None:
+            return
+        with self.lock:
+            for zoom in self.zooms.get(mmsi, ()):
+                entry = self.entries[(mmsi, zoom)]
+                entry["open"].append((timestamp, lat, lon, course, speed))
+                if not entry["loading"] and len(entry["open"]) >= TRAIL_SEGMENT_POINTS:
+                    self._commit(entry)
+
+    def discard(self, mmsi):
+        """Forget the cached trails of a vessel"""
+        with self.lock:
+            for zoom in self.zooms.pop(mmsi, ()):
+                del self.entries[(mmsi, zoom)]
+
+    def _commit(self, entry):
+        """Simplify the open tail for good, keeping its last point as the anchor of the next one"""
+        simplified = simplify_trail(entry["open"], entry["tolerance"])
+        entry["committed"].extend(simplified[:-1])
+        entry["open"] = simplified[-1:]
+        oldest = time.time() - TRACK_RETENTION
+        if entry["committed"] and entry["committed"][0][0] < oldest:
+            entry["committed"] = [point for point in entry["committed"] if point[0] >= oldest]
+            entry["since"] = max(entry["since"], oldest)
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.zooms.setdefault(key[0], set()).add(key[1])
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        mmsi, zoom = key
+        del self.entries[key]
+        self.zooms[mmsi].discard(zoom)
+        if not self.zooms[mmsi]:
+            del self.zooms[mmsi]
+
+    def trail(self, mmsi, zoom, since, load):
+        """Simplified trail points from since onwards; load(mmsi, since) supplies the raw history on a miss"""
+        key = (mmsi, zoom)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["since"] <= since and not entry["loading"]:
+                self.entries.move_to_end(key)
+                points = entry["committed"] + simplify_trail(entry["open"], entry["tolerance"])
+                return [point for point in points if point[0] >= since]
+            # Register first so positions arriving during the load are buffered rather than lost
+            entry = {"since": since, "tolerance": trail_tolerance(zoom), "committed": [], "open": [], "loading": True}
+            self._store(key, entry)
+        try:
+            history = simplify_trail(load(mmsi, since), entry["tolerance"])
+        except Exception:
+            with self.lock:
+                if self.entries.get(key) is entry:  # Not evicted or replaced meanwhile
+                    self._drop(key)
+            raise
+        with self.lock:
+            loaded_until = history[-1][0] if history else -math.inf
+            entry["committed"] = history[:-1]
+            entry["open"] = history[-1:] + [point for point in entry["open"] if point[0] > loaded_until]
+            entry["loading"] = False
+            if len(entry["open"]) >= TRAIL_SEGMENT_POINTS:
+                self._commit(entry)
+            points = entry["committed"] + simplify_trail(entry["open"], entry["tolerance"])
+        return [point for point in points if point[0] >= since]
+
+class VesselJournal:
+    """Checkpoint plus append-only change log of the vessel table, both in a compact binary format"""
+    def __init__(self, checkpoint_path, log_path, max_log_bytes=STATE_LOG_MAX_BYTES):
+        self.checkpoint_path = checkpoint_path
+        self.log_path = log_path
+        self.max_log_bytes = max_log_bytes
+        self.checkpoint_id = 0
+        self.generation = 0  # Snapshot generation persisted last; 0 forces a checkpoint
+        self.log = None
+        self.lock = threading.Lock()  # The map updater and shutdown can both persist
+
+    @staticmethod
+    def encode_block(snapshot, rows, deleted=()):
+        """Serialize snapshot rows and deleted MMSIs as one checksummed block"""
+        rows = np.asarray(rows, dtype=np.intp)
+        fixed = np.empty(len(rows), dtype=STATE_DTYPE)
+        for column in STATE_DTYPE.names:
+            fixed[column] = getattr(snapshot, column)[rows]
+        strings = json.dumps(list(zip(snapshot.name[rows].tolist(), snapshot.callsign[rows].tolist())),
+                             separators=(",", ":")).encode("utf-8")
+        payload = fixed.tobytes() + np.array(list(deleted), dtype="<i8").tobytes() + strings
+        return STATE_BLOCK.pack(len(rows), len(deleted), len(strings), zlib.crc32(payload)) + payload
+
+    @staticmethod
+    def read_blocks(f):
+        """Yield (fixed rows, deleted MMSIs, [name, callsign] pairs) until the end or a torn block"""
+        while True:
+            header = f.read(STATE_BLOCK.size)
+            if len(header) < STATE_BLOCK.size:
+                return
+            upserts, deletes, strings_length, crc = STATE_BLOCK.unpack(header)
+            payload = f.read(upserts * STATE_DTYPE.itemsize + deletes * 8 + strings_length)
+            if len(payload) < upserts * STATE_DTYPE.itemsize + deletes * 8 + strings_length or zlib.crc32(payload) != crc:
+                return  # Interrupted write; everything before it is intact
+            fixed = np.frombuffer(payload, dtype=STATE_DTYPE, count=upserts)
+            deleted = np.frombuffer(payload, dtype="<i8", count=deletes, offset=upserts * STATE_DTYPE.itemsize)
+            yield fixed, deleted.tolist(), json.loads(payload[len(payload) - strings_length:])
+
+    @staticmethod
+    def _write_atomically(path, data):
+        """Write a file beside its final path, sync it and rename it into place"""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def load(self):
+        """Return the persisted (fixed rows, [name, callsign] pairs), or None when there is no checkpoint"""
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path, "rb") as f:
+            if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+                raise ValueError(f"{self.checkpoint_path} is not a vessel state checkpoint")
+            checkpoint_id, = STATE_HEADER.unpack(f.read(STATE_HEADER.size))
+            blocks = list(self.read_blocks(f))
+        if not blocks:
+            raise ValueError(f"{self.checkpoint_path} is truncated")
+        self.checkpoint_id = checkpoint_id
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as f:
+                header = f.read(len(STATE_LOG_MAGIC) + STATE_HEADER.size)
+                # A log left over from before the latest checkpoint would replay stale changes
+                if header == STATE_LOG_MAGIC + STATE_HEADER.pack(checkpoint_id):
+                    blocks.extend(self.read_blocks(f))
+        fixed = np.concatenate([block[0] for block in blocks])
+        strings = [pair for block in blocks for pair in block[2]]
+        if len(blocks) == 1:
+            return fixed, strings
+        # Keep the newest record of each MMSI unless a later block deleted it
+        block_of = np.concatenate([np.full(len(block[0]), index) for index, block in enumerate(blocks)])
+        mmsis, reversed_index = np.unique(fixed["mmsi"][::-1], return_index=True)
+        latest = len(fixed) - 1 - reversed_index
+        keep = np.ones(len(mmsis), dtype=bool)
+        deleted_in = {mmsi: index for index, block in enumerate(blocks) for mmsi in block[1]}
+        if deleted_in:
+            deleted = np.fromiter(deleted_in, dtype=np.int64, count=len(deleted_in))
+            positions = np.minimum(np.searchsorted(mmsis, deleted), len(mmsis) - 1)
+            known = mmsis[positions] == deleted
+            keep[positions[known]] &= block_of[latest[positions[known]]] > np.fromiter(
+                deleted_in.values(), dtype=np.int64, count=len(deleted_in))[known]
+        latest = latest[keep]
+        return fixed[latest], [strings[i] for i in latest.tolist()]
+
+    def checkpoint(self, snapshot):
+        """Write the whole table to a new checkpoint and start an empty change log for it"""
+        self.close()
+        self.checkpoint_id += 1
+        rows = np.flatnonzero(snapshot.mmsi != 0)
+        self._write_atomically(self.checkpoint_path, CHECKPOINT_MAGIC + STATE_HEADER.pack(self.checkpoint_id) +
+                               self.encode_block(snapshot, rows))
+        self._write_atomically(self.log_path, STATE_LOG_MAGIC + STATE_HEADER.pack(self.checkpoint_id))
+        self.log = open(self.log_path, "ab")
+        self.generation = snapshot.generation
+        return len(rows)
+
+    def append(self, snapshot, rows, deleted):
+        """Append changed rows and deleted MMSIs to the change log and sync it"""
+        self.log.write(self.encode_block(snapshot, rows, deleted))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.generation = snapshot.generation
+
+    def log_size(self):
+        return self.log.tell() if self.log else 0
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+# Decoded reports are flat tuples, tagged with their AIS message type:
+# ("PositionReport", mmsi, lat, lon, course, speed, heading)
+# ("ShipStaticData", mmsi, name, ship_type, length, width, callsign, metadata lat, metadata lon)
+class ViewCache:
+    """LRU of results derived from one snapshot generation and a client's view parameters"""
+    def __init__(self, max_entries=VIEW_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, compute):
+        """Return the cached value for key, or compute and remember it"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc("ais_view_cache_requests_total", result="hit")
+                return self.entries[key]
+            self.misses += 1
+        metrics.inc("ais_view_cache_requests_total", result="miss")
+        value = compute()  # Outside the lock; two clients missing at once both compute, and one result wins
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+class Watchlist:
+    """Watched MMSIs cached in memory, reloaded only when the file changes on disk"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}  # MMSI string -> None, in file order
+        self.ids = np.empty(0, dtype=np.int64)
+        self.id_set = frozenset()
+        self.version = 0  # Bumped on every change, for views derived from the list
+        self.file_state = None  # (mtime_ns, size) of the file as last read or written
+        self.view = None  # ((snapshot generation, version), watched snapshot rows)
+
+    def _refresh(self):
+        """Reload the list if the file was changed by something else; caller must hold self.lock"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            log.info("Filter file %s not found. Creating empty watchlist.", self.path)
+            self._write({})
+            return
+        if (stat.st_mtime_ns, stat.st_size) == self.file_state:
+            return
+        entries = {}
+        with open(self.path, 'r') as f:
+            for line in f:
+                mmsi = line.strip()
+                if mmsi:
+                    entries[mmsi] = None
+        self._set(entries, (stat.st_mtime_ns, stat.st_size))
+        log.debug("Loaded %d vessels to watch from %s", len(entries), self.path)
+
+    def _set(self, entries, file_state):
+        self.entries = entries
+        ids = [int(mmsi) for mmsi in entries if mmsi.isdigit()]
+        self.ids = np.array(ids, dtype=np.int64)
+        self.id_set = frozenset(ids)
+        self.file_state = file_state
+        self.version += 1
+
+    def _write(self, entries):
+        """Replace the file through a temporary file so readers never see a partial list"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.writelines(f"{mmsi}\n" for mmsi in entries)
+        os.replace(temp_path, self.path)
+        stat = os.stat(self.path)
+        self._set(entries, (stat.st_mtime_ns, stat.st_size))
+
+    def mmsis(self):
+        """Watched MMSIs as strings, in the order they were added"""
+        with self.lock:
+            self._refresh()
+            return list(self.entries)
+
+    def current(self):
+        """(version, int64 MMSI array, MMSI set) of the current list"""
+        with self.lock:
+            self._refresh()
+            return self.version, self.ids, self.id_set
+
+    def add(self, mmsi):
+        """Watch a vessel; returns False if it was already watched"""
+        mmsi = str(mmsi).strip()
+        with self.lock:
+            self._refresh()
+            if mmsi in self.entries:
+                return False
+            self._write({**self.entries, mmsi: None})
+        return True
+
+    def remove(self, mmsi):
+        """Stop watching a vessel; returns False if it was not watched"""
+        mmsi = str(mmsi).strip()
+        with self.lock:
+            self._refresh()
+            if mmsi not in self.entries:
+                return False
+            self._write({m: None for m in self.entries if m != mmsi})
+        return True
+
+def point_in_polygon(lat, lon, polygon):
+    """Ray casting test of a point against a [[lat, lon], ...] ring"""
+    inside = False
+    lat_j, lon_j = polygon[-1]
+    for lat_i, lon_i in polygon:
+        if (lat_i > lat) != (lat_j > lat) and lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i:
+            inside = not inside
+        lat_j, lon_j = lat_i, lon_i
+    return inside
+
+def parse_alert_rule(raw):
+    """Validate one rule from the rules file and add the fields the engine needs"""
+    rule = dict(raw)
+    rule_type = rule.get("type")
+    if not rule.get("id"):
+        raise ValueError("rule without an id")
+    mmsi = rule.get("mmsi")
+    if mmsi is not None and mmsi != "watchlist" and not isinstance(mmsi, list):
+        raise ValueError(f"rule {rule['id']}: mmsi must be a list of MMSIs or \"watchlist\"")
+    rule["scope"] = None if mmsi is None else "watchlist" if mmsi == "watchlist" else frozenset(int(m) for m in mmsi)
+    if rule_type in ("geofence", "ship_type_in_zone"):
+        polygon = [(float(lat), float(lon)) for lat, lon in rule["polygon"]]
+        if len(polygon) < 3:
+            raise ValueError(f"rule {rule['id']}: a polygon needs at least 3 points")
+        rule["polygon"] = polygon
+        lats, lons = [lat for lat, lon in polygon], [lon for lat, lon in polygon]
+        rule["bounds"] = (min(lats), min(lons), max(lats), max(lons))
+        rule["events"] = set(rule.get("events", ["enter", "leave"] if rule_type == "geofence" else ["enter"]))
+        rule["ship_type_ranges"] = parse_ship_types(str(rule["ship_types"])) if rule.get("ship_types") else None
+        if rule_type == "ship_type_in_zone" and rule["ship_type_ranges"] is None:
+            raise ValueError(f"rule {rule['id']}: ship_type_in_zone needs ship_types")
+    elif rule_type == "speed":
+        if rule.get("above") is None and rule.get("below") is None:
+            raise ValueError(f"rule {rule['id']}: a speed rule needs above and/or below (knots)")
+    elif rule_type == "dark":
+        rule["seconds"] = float(rule.get("minutes", 30)) * 60
+    else:
+        raise ValueError(f"rule {rule.get('id')}: unknown type {rule_type!r}")
+    return rule
+
+class AlertEngine:
+    """Alert rules evaluated on every applied position; zones are found through a grid of their bounding boxes"""
+    def __init__(self, path=None, cell_size=SPATIAL_CELL_SIZE):
+        self.path = path
+        self.cell_size = cell_size
+        self.file_state = None
+        self.rules = {}  # id -> rule
+        self.zone_cells = {}  # (cell row, cell column) -> zone rules whose bounding box touches the cell
+        self.speed_rules = []
+        self.dark_rules = []  # (rule, VesselExpiry with the rule's timeout)
+        self.zones = {}  # MMSI -> ids of the zones it is in; vessels seen for the first time set a baseline only
+        self.fast = {}  # speed rule id -> MMSIs currently outside its limits
+        self.watched = frozenset()
+        self.pending = queue.Queue(maxsize=ALERT_QUEUE_SIZE)
+        self.sinks = []
+        self.recent = deque(maxlen=ALERT_HISTORY)
+
+    def _cell(self, lat, lon):
+        return int(lat // self.cell_size), int(lon // self.cell_size)
+
+    def add_sink(self, sink):
+        """Deliver every alert to sink(alert)"""
+        self.sinks.append(sink)
+
+    def set_rules(self, rules):
+        """Replace the rules and index the zones; caller must hold vessels_lock"""
+        self.rules = {rule["id"]: rule for rule in rules}
+        self.zone_cells = {}
+        self.speed_rules = []
+        self.dark_rules = []
+        for rule in rules:
+            if rule["type"] in ("geofence", "ship_type_in_zone"):
+                min_lat, min_lon, max_lat, max_lon = rule["bounds"]
+                (low_row, low_col), (high_row, high_col) = self._cell(min_lat, min_lon), self._cell(max_lat, max_lon)
+                for row in range(low_row, high_row + 1):
+                    for col in range(low_col, high_col + 1):
+                        self.zone_cells.setdefault((row, col), []).append(rule)
+            elif rule["type"] == "speed":
+                self.speed_rules.append(rule)
+            elif rule["type"] == "dark":
+                expiry = VesselExpiry(rule["seconds"], max(rule["seconds"], RETENTION_TTL))
+                expiry.on_hide(lambda mmsi, rule=rule: self.emit(rule, "dark", mmsi, time.time(), seconds=rule["seconds"]))
+                self.dark_rules.append((rule, expiry))
+        self.zones = {}
+        self.fast = {rule["id"]: set() for rule in self.speed_rules}
+
+    def load(self):
+        """Reload the rules file if it changed; returns True when the rules were replaced"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self.file_state is not None:
+                self.file_state = None
+                with vessels_lock:
+                    self.set_rules([])
+            return False
+        if (stat.st_mtime_ns, stat.st_size) == self.file_state:
+            return False
+        self.file_state = (stat.st_mtime_ns, stat.st_size)
+        with open(self.path) as f:
+            raw_rules = json.load(f)
+        rules = []
+        for raw in raw_rules:
+            try:
+                rules.append(parse_alert_rule(raw))
+            except (KeyError, TypeError, ValueError) as e:
+                log.error("Skipping alert rule %s: %s", raw.get("id") if isinstance(raw, dict) else raw, e)
+        with vessels_lock:
+            self.set_rules(rules)
+        log.info("Loaded %d alert rules from %s", len(rules), self.path)
+        return True
+
+    def _applies(self, rule, mmsi):
+        scope = rule["scope"]
+        if scope is None:
+            return True
+        return mmsi in (self.watched if scope == "watchlist" else scope)
+
+    def observe(self, mmsi, lat, lon, speed, ship_type, timestamp):
+        """Evaluate the rules for one applied report; caller must hold vessels_lock"""
+        for rule, expiry in self.dark_rules:
+            if self._applies(rule, mmsi):
+                expiry.touch(mmsi, timestamp)
+        if speed is not None and speed == speed and speed < 102.3:  # 102.3 knots means "not available"
+            for rule in self.speed_rules:
+                if not self._applies(rule, mmsi):
+                    continue
+                fast = self.fast[rule["id"]]
+                above, below = rule.get("above"), rule.get("below")
+                if (above is not None and speed > above) or (below is not None and speed < below):
+                    if mmsi not in fast:
+                        fast.add(mmsi)
+                        self.emit(rule, "speed", mmsi, timestamp, speed=speed)
+                else:
+                    fast.discard(mmsi)
+        if lat is None or lon is None or not self.zone_cells:
+            return
+        if lat != lat or lon != lon or not (-90 <= lat <= 90 and -180 <= lon <= 180):  # Missing or "not available"
+            return
+        inside = set()
+        for rule in self.zone_cells.get(self._cell(lat, lon), ()):
+            min_lat, min_lon, max_lat, max_lon = rule["bounds"]
+            if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon) or not self._applies(rule, mmsi):
+                continue
+            ranges = rule["ship_type_ranges"]
+            if ranges is not None and not any(low <= ship_type <= high for low, high in ranges):
+                continue
+            if point_in_polygon(lat, lon, rule["polygon"]):
+                inside.add(rule["id"])
+        previous = self.zones.get(mmsi)
+        self.zones[mmsi] = inside
+        if previous is None:
+            return
+        for rule_id in inside - previous:
+            rule = self.rules[rule_id]
+            if "enter" in rule["events"]:
+                self.emit(rule, "enter", mmsi, timestamp, lat=lat, lon=lon)
+        for rule_id in previous - inside:
+            rule = self.rules.get(rule_id)
+            if rule is not None and "leave" in rule["events"]:
+                self.emit(rule, "leave", mmsi, timestamp, lat=lat, lon=lon)
+
+    def emit(self, rule, event, mmsi, timestamp, **fields):
+        """Queue an alert for the sinks without blocking ingest"""
+        alert = {"rule": rule["id"], "rule_type": rule["type"], "event": event, "mmsi": str(mmsi), "time": timestamp}
+        alert.update(fields)
+        try:
+            self.pending.put_nowait(alert)
+            metrics.inc("ais_alerts_total", type=rule["type"], event=event)
+        except queue.Full:
+            metrics.inc("ais_alerts_dropped_total")
+
+    def check(self, now):
+        """Fire going-dark alerts that are due; caller must hold vessels_lock"""
+        for rule, expiry in self.dark_rules:
+            expiry.expire(now)
+
+    def forget(self, mmsi):
+        """Drop the per-vessel state of a vessel evicted from memory"""
+        self.zones.pop(mmsi, None)
+        for fast in self.fast.values():
+            fast.discard(mmsi)
+
+    def drain(self, timeout):
+        """Wait up to timeout for alerts and return all that are queued"""
+        try:
+            alerts = [self.pending.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                alerts.append(self.pending.get_nowait())
+            except queue.Empty:
+                return alerts
+
+    def deliver(self, alert):
+        self.recent.append(alert)
+        for sink in self.sinks:
+            try:
+                sink(alert)
+            except Exception as e:
+                log.error("Error delivering alert to %s: %s", getattr(sink, "__name__", type(sink).__name__), e)
+
+def log_alert(alert):
+    """Alert sink that writes to the log"""
+    log.warning("Alert [%s] %s", alert["rule"], alert["message"])
+
+class WebhookSink:
+    """Alert sink that POSTs each alert as JSON"""
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, alert):
+        request = urllib.request.Request(self.url, data=json.dumps(alert).encode(),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+class AlertBroadcaster:
+    """Alert sink that fans alerts out to the connected /alerts/stream clients"""
+    def __init__(self, backlog=100):
+        self.backlog = backlog
+        self.clients = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        client = queue.Queue(maxsize=self.backlog)
+        with self.lock:
+            self.clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def __call__(self, alert):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.put_nowait(alert)
+            except queue.Full:
+                pass  # A stalled page misses alerts rather than holding up the others
+
+class EncounterDetector:
+    """Closest point of approach between vessels, checking only pairs in neighbouring cells of a grid"""
+    def __init__(self, cpa_nm=ENCOUNTER_CPA_NM, tcpa_minutes=ENCOUNTER_TCPA_MINUTES):
+        self.cpa_nm = cpa_nm
+        self.tcpa_minutes = tcpa_minutes
+        self.lock = threading.Lock()
+        self.latest = None  # Last pass with the default thresholds
+
+    def evaluate(self, snapshot, now, cpa_nm=None, tcpa_minutes=None):
+        """Encounters among the recently reported vessels of a snapshot, projected to now"""
+        started = time.perf_counter()
+        cpa_nm = self.cpa_nm if cpa_nm is None else cpa_nm
+        tcpa_minutes = self.tcpa_minutes if tcpa_minutes is None else tcpa_minutes
+        horizon = tcpa_minutes / 60  # Hours
+        rows = snapshot.positioned_rows()
+        rows = rows[now - snapshot.last_update[rows] <= DEAD_RECKONING_MAX_AGE]
+        lat, lon, north, east, _ = dead_reckon(snapshot, rows, now)
+        # Velocities in knots on a local flat chart, x east and y north
+        lon_scale = 60 * np.cos(np.radians(lat))  # Nautical miles per degree of longitude
+        velocity_y = north * 216000
+        velocity_x = east * 216000 * lon_scale / 60
+        speed = np.hypot(velocity_x, velocity_y)
+        moving = np.flatnonzero(speed >= ENCOUNTER_MIN_SPEED)
+        candidates = 0
+        hits = []
+        if len(moving):
+            # Vessels further apart than a cell cannot close to cpa_nm within the horizon
+            reach = cpa_nm + 2 * float(speed.max()) * horizon
+            cell_lat = reach / 60
+            cos_max = max(math.cos(math.radians(min(float(np.abs(lat).max()), 85.0))), 1e-3)
+            columns = max(int(360 // (cell_lat / cos_max)), 1)
+            cell_row = np.floor((lat + 90) / cell_lat).astype(np.int64)
+            cell_col = np.floor((lon + 180) / (360 / columns)).astype(np.int64) % columns
+            keys = cell_row * columns + cell_col
+            is_moving = speed >= ENCOUNTER_MIN_SPEED
+            still = np.flatnonzero(~is_moving)
+            moving_order = moving[np.argsort(keys[moving], kind="stable")]
+            still_order = still[np.argsort(keys[still], kind="stable")]
+            wraps = len(lon) and float(lon.max()) - float(lon.min()) > 180
+            column_steps = (-1, 0, 1) if columns >= 3 else (0,)
+            every_cell = [(row_step, column_step) for row_step in (-1, 0, 1) for column_step in column_steps]
+            # Moving pairs are found from one end only: the same cell plus the cells after it
+            forward_cells = [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)] if columns >= 3 else [(0, 0), (1, 0)]
+
+            def neighbour_pairs(chunk, order, steps):
+                sorted_keys = keys[order]
+                first, second = [], []
+                for row_step, column_step in steps:
+                    target = (cell_row[chunk] + row_step) * columns + (cell_col[chunk] + column_step) % columns
+                    left = np.searchsorted(sorted_keys, target, "left")
+                    counts = np.searchsorted(sorted_keys, target, "right") - left
+                    total = int(counts.sum())
+                    if not total:
+                        continue
+                    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                    i, j = np.repeat(chunk, counts), order[np.repeat(left, counts) + offsets]
+                    if order is moving_order and (row_step, column_step) == (0, 0):
+                        i, j = i[i < j], j[i < j]
+                    first.append(i)
+                    second.append(j)
+                return first, second
+
+            for start in range(0, len(moving), ENCOUNTER_CHUNK_SIZE):
+                chunk = moving[start:start + ENCOUNTER_CHUNK_SIZE]
+                first, second = neighbour_pairs(chunk, moving_order, forward_cells)
+                still_first, still_second = neighbour_pairs(chunk, still_order, every_cell)
+                if not first + still_first:
+                    continue
+                i, j = np.concatenate(first + still_first), np.concatenate(second + still_second)
+                candidates += len(i)
+                dy = (lat[j] - lat[i]) * 60
+                dlon = lon[j] - lon[i]
+                if wraps:
+                    dlon = (dlon + 180) % 360 - 180
+                dx = dlon * (lon_scale[i] + lon_scale[j]) / 2  # Flat chart around the pair; they are at most a cell apart
+                vx, vy = velocity_x[j] - velocity_x[i], velocity_y[j] - velocity_y[i]
+                closing = np.maximum(vx * vx + vy * vy, 1e-9)
+                # Pairs already past their closest point are as close as they get now
+                tcpa = np.maximum(-(dx * vx + dy * vy) / closing, 0.0)
+                cx, cy = dx + vx * tcpa, dy + vy * tcpa
+                hit = np.flatnonzero((cx * cx + cy * cy <= cpa_nm * cpa_nm) & (tcpa <= horizon))
+                i, j, dx, dy, cx, cy = i[hit], j[hit], dx[hit], dy[hit], cx[hit], cy[hit]
+                hits.append((i, j, np.hypot(dx, dy), np.hypot(cx, cy), tcpa[hit]))
+        fields = ("mmsi_a", "mmsi_b", "name_a", "name_b", "distance_nm", "cpa_nm", "tcpa_minutes", "lat", "lon")
+        if hits:
+            i, j, distance, cpa, tcpa = (np.concatenate(column) for column in zip(*hits))
+            order = np.lexsort((cpa, tcpa))  # Soonest first, then closest
+            i, j, distance, cpa, tcpa = i[order], j[order], distance[order], cpa[order], tcpa[order]
+            # Halfway between where the two vessels will be at their closest point
+            at_lat = lambda k: lat[k] + velocity_y[k] * tcpa / 60
+            at_lon = lambda k: lon[k] + velocity_x[k] * tcpa / np.maximum(lon_scale[k], 0.06)
+            span = (at_lon(j) - at_lon(i) + 180) % 360 - 180
+            mmsi, name = snapshot.mmsi[rows], snapshot.name[rows]
+            pairs = dict(zip(fields, (mmsi[i], mmsi[j], name[i], name[j], distance, cpa, tcpa * 60,
+                                      (at_lat(i) + at_lat(j)) / 2, (at_lon(i) + span / 2 + 180) % 360 - 180)))
+        else:
+            pairs = {field: np.empty(0) for field in fields}
+        return {
+            "generated": now,
+            "generation": snapshot.generation,
+            "cpa_nm": cpa_nm,
+            "tcpa_minutes": tcpa_minutes,
+            "vessels": len(rows),
+            "moving": len(moving),
+            "candidate_pairs": candidates,
+            "evaluation_ms": round((time.perf_counter() - started) * 1000, 2),
+            "count": len(pairs["mmsi_a"]),
+            "pairs": pairs  # Columns of vessels and CPA figures, soonest first; see encounters()
+        }
+
+    @staticmethod
+    def encounters(result, limit=None):
+        """The first limit encounters of a pass as plain dicts"""
+        pairs = {column: values[:limit] for column, values in result["pairs"].items()}
+        return [
+            {
+                "mmsi": [str(a), str(b)],
+                "names": [name_a, name_b],
+                "distance_nm": distance,
+                "cpa_nm": cpa,
+                "tcpa_minutes": tcpa,
+                "cpa_position": [lat, lon]
+            }
+            for a, b, name_a, name_b, distance, cpa, tcpa, lat, lon in zip(
+                pairs["mmsi_a"].tolist(), pairs["mmsi_b"].tolist(), pairs["name_a"].tolist(), pairs["name_b"].tolist(),
+                np.round(pairs["distance_nm"], 3).tolist(), np.round(pairs["cpa_nm"], 3).tolist(),
+                np.round(pairs["tcpa_minutes"], 1).tolist(), np.round(pairs["lat"], 5).tolist(),
+                np.round(pairs["lon"], 5).tolist())
+        ]
+
+    def update(self):
+        """Run a pass with the default thresholds over the current fleet and keep its result"""
+        result = self.evaluate(take_snapshot(), time.time())
+        with self.lock:
+            self.latest = result
+        metrics.observe("ais_encounter_pass_seconds", result["evaluation_ms"] / 1000)
+        metrics.set("ais_encounters", result["count"])
+        log.debug("Encounter pass: %d vessels, %d candidate pairs, %d encounters in %.1f ms",
+                  result["vessels"], result["candidate_pairs"], result["count"], result["evaluation_ms"])
+        return result
+
+    def query(self, cpa_nm=None, tcpa_minutes=None):
+        """The last pass for the default thresholds, otherwise a fresh one cached for the current generation"""
+        cpa_nm = self.cpa_nm if cpa_nm is None else cpa_nm
+        tcpa_minutes = self.tcpa_minutes if tcpa_minutes is None else tcpa_minutes
+        with self.lock:
+            latest = self.latest
+        if latest is not None and (cpa_nm, tcpa_minutes) == (self.cpa_nm, self.tcpa_minutes):
+            return latest
+        snapshot = take_snapshot()
+        current_time = time.time()
+        key = ("encounters", snapshot.generation, cpa_nm, tcpa_minutes, int(current_time // VIEW_CACHE_SECONDS))
+        return view_cache.get(key, lambda: self.evaluate(snapshot, current_time, cpa_nm, tcpa_minutes))
+
+    def stats(self):
+        with self.lock:
+            latest = self.latest
+        if latest is None:
+            return None
+        return {key: latest[key] for key in ("generated", "vessels", "moving", "candidate_pairs", "evaluation_ms", "count")}
+
+def report_from_message(message):
+    """Flatten a decoded AISStream message into a report tuple, or None if it carries nothing we store"""
+    message_type = message.get("MessageType")
+    if message_type == "PositionReport":
+        ais_message = message.get("Message", {}).get("PositionReport", {})
+        if ais_message and ais_message.get("UserID"):
+            return (message_type, int(ais_message["UserID"]), ais_message.get("Latitude"), ais_message.get("Longitude"),
+                    ais_message.get("Cog"), ais_message.get("Sog"), ais_message.get("TrueHeading"))
+    elif message_type == "ShipStaticData":
+        ais_message = message.get("Message", {}).get("ShipStaticData", {})
+        if ais_message and ais_message.get("UserID"):
+            metadata = message.get("Metadata", {})
+            has_position = "Latitude" in metadata and "Longitude" in metadata
+            return (message_type, int(ais_message["UserID"]), ais_message.get("Name", "").strip(),
+                    ais_message.get("ShipType"), ais_message.get("Length"), ais_message.get("Width"),
+                    ais_message.get("CallSign", "").strip(),
+                    metadata.get("Latitude") if has_position else None,
+                    metadata.get("Longitude") if has_position else None)
+    return None
+
+def decode_json(frame):
+    return report_from_message(json.loads(frame))
+
+def decode_orjson(frame):
+    return report_from_message(orjson.loads(frame))
+
+if msgspec is not None:
+    # Typed schemas: only the fields we store are decoded, everything else in the frame is skipped
+    class PositionReportFields(msgspec.Struct, frozen=True):
+        UserID: int = 0
+        Latitude: Optional[float] = None
+        Longitude: Optional[float] = None
+        Cog: Optional[float] = None  # Course and speed over ground
+        Sog: Optional[float] = None
+        TrueHeading: Optional[float] = None
+
+    class ShipStaticDataFields(msgspec.Struct, frozen=True):
+        UserID: int = 0
+        Name: str = ""
+        ShipType: Optional[int] = None
+        Length: Optional[float] = None
+        Width: Optional[float] = None
+        CallSign: str = ""
+
+    class MessageFields(msgspec.Struct, frozen=True):
+        PositionReport: Optional[PositionReportFields] = None
+        ShipStaticData: Optional[ShipStaticDataFields] = None
+
+    class MetadataFields(msgspec.Struct, frozen=True):
+        Latitude: Optional[float] = None
+        Longitude: Optional[float] = None
+
+    class FrameFields(msgspec.Struct, frozen=True):
+        MessageType: str = ""
+        Metadata: MetadataFields = MetadataFields()
+        Message: MessageFields = MessageFields()
+
+    frame_fields_decoder = msgspec.json.Decoder(FrameFields)
+
+def decode_msgspec(frame):
+    decoded = frame_fields_decoder.decode(frame)
+    if decoded.MessageType == "PositionReport":
+        ais_message = decoded.Message.PositionReport
+        if ais_message is not None and ais_message.UserID:
+            return ("PositionReport", ais_message.UserID, ais_message.Latitude, ais_message.Longitude,
+                    ais_message.Cog, ais_message.Sog, ais_message.TrueHeading)
+    elif decoded.MessageType == "ShipStaticData":
+        ais_message = decoded.Message.ShipStaticData
+        if ais_message is not None and ais_message.UserID:
+            metadata = decoded.Metadata
+            has_position = metadata.Latitude is not None and metadata.Longitude is not None
+            return ("ShipStaticData", ais_message.UserID, ais_message.Name.strip(), ais_message.ShipType,
+                    ais_message.Length, ais_message.Width, ais_message.CallSign.strip(),
+                    metadata.Latitude if has_position else None, metadata.Longitude if has_position else None)
+    return None
+
+FRAME_DECODERS = {
+    "msgspec": decode_msgspec if msgspec is not None else None,
+    "orjson": decode_orjson if orjson is not None else None,
+    "json": decode_json
+}
+
+def get_frame_decoder(name=None):
+    """Return (name, decoder) for a FRAME_DECODER setting, falling back to the stdlib json module"""
+    name = name or FRAME_DECODER
+    if name == "auto":
+        name = next(candidate for candidate, decoder in FRAME_DECODERS.items() if decoder is not None)
+    if name not in FRAME_DECODERS:
+        raise ValueError(f"Unknown frame decoder: {name}")
+    if FRAME_DECODERS[name] is None:
+        log.warning("Frame decoder '%s' is not installed, falling back to json", name)
+        name = "json"
+    return name, FRAME_DECODERS[name]
+
+frame_queue = FrameQueue()
+vessels = VesselStore()
+spatial_index = SpatialGrid()
+cluster_index = ClusterIndex()
+search_index = SearchIndex()
+track_store = TrackStore(TRACK_DB_FILE) if TRACK_DB_FILE else None
+trail_cache = TrailCache()
+vessel_journal = VesselJournal(STATE_CHECKPOINT_FILE, STATE_LOG_FILE) if STATE_CHECKPOINT_FILE else None
+vessel_expiry = VesselExpiry()
+watchlist = Watchlist(MMSI_FILTER_FILE)
+view_cache = ViewCache()
+alert_engine = AlertEngine(ALERT_RULES_FILE) if ALERT_RULES_FILE else None
+alert_broadcaster = AlertBroadcaster()
+heatmap = HeatmapGrid() if HEATMAP else None
+encounter_detector = EncounterDetector()
+frame_decoder_name, decode_frame = get_frame_decoder()
+
+def open_capture(path):
+    """Open a capture file for appending raw frames"""
+    is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+    capture = gzip.open(path, "ab", compresslevel=5)
+    if is_new:
+        capture.write(CAPTURE_MAGIC)
+    log.info("Recording raw frames to %s", path)
+    return capture
+
+def write_capture_frame(capture, frame, received_at=None):
+    """Append one raw frame with its receive timestamp to a capture file"""
+    if isinstance(frame, str):
+        frame = frame.encode("utf-8")
+    capture.write(CAPTURE_RECORD.pack(received_at or time.time(), len(frame)))
+    capture.write(frame)
+
+def read_capture(path):
+    """Yield (receive time, raw frame) pairs from a capture file"""
+    with gzip.open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not an AIS capture file")
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                break
+            received_at, length = CAPTURE_RECORD.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                break  # Truncated tail from an interrupted recording
+            yield received_at, frame
+
+async def paced_frames(path, speed):
+    """Yield recorded frames, sleeping to reproduce the original pacing divided by speed"""
+    started = time.monotonic()
+    first_ts = None
+    for count, (received_at, frame) in enumerate(read_capture(path)):
+        if first_ts is None:
+            first_ts = received_at
+        if speed:
+            delay = (received_at - first_ts) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % 1000 == 0:
+            await asyncio.sleep(0)  # Let the rest of the event loop breathe at full speed
+        yield frame
+
+async def enqueue_frame(frame, block=None):
+    """Hand a raw frame to the ingest worker, waiting for room when blocking"""
+    if block is None:
+        block = frame_queue.policy == "block"
+    while not frame_queue.put(frame, drop_oldest=not block):
+        if not running:
+            return
+        await asyncio.sleep(0.005)
+
+def ingest_worker():
+    """Drain the frame queue in batches and apply each batch under one lock acquisition"""
+    while running:
+        frames = frame_queue.get_batch(INGEST_BATCH_SIZE, timeout=0.5)
+        if not frames:
+            continue
+        report_times = sample_report_times(frames)
+        reports = []
+        for frame in frames:
+            try:
+                report = decode_frame(frame)
+            except Exception as e:
+                metrics.inc("ais_decode_errors_total")
+                log.error("Error decoding message: %s", e)
+                continue
+            if report is not None:
+                reports.append(report)
+        process_ais_reports(reports)
+        frame_queue.mark_processed(len(frames))
+        observe_ingest_latency(report_times)
+
+def frame_report_time(frame):
+    """Unix time of a raw frame's Metadata time_utc, or None when it has none"""
+    if isinstance(frame, bytes):
+        frame = frame.decode("utf-8", "replace")
+    match = FRAME_TIME_PATTERN.search(frame)
+    if match is None:
+        return None
+    *fields, fraction = match.groups()
+    return calendar.timegm(tuple(int(field) for field in fields)) + (float(fraction) if fraction else 0.0)
+
+def sample_report_times(frames):
+    """Report times of every LATENCY_SAMPLE_EVERY-th frame of a batch"""
+    times = (frame_report_time(frame) for frame in frames[::LATENCY_SAMPLE_EVERY])
+    return [report_time for report_time in times if report_time is not None]
+
+def observe_ingest_latency(report_times):
+    current_time = time.time()
+    for report_time in report_times:
+        metrics.observe("ais_ingest_latency_seconds", current_time - report_time)
+
+def frame_shard(frame, shard_count):
+    """Worker index for a raw frame, from its MMSI without decoding the whole frame"""
+    match = (FRAME_MMSI_PATTERN_BYTES if isinstance(frame, bytes) else FRAME_MMSI_PATTERN).search(frame)
+    return int(match.group(1)) % shard_count if match else 0
+
+def shard_worker(inbox, outbox, decoder_name):
+    """Worker process: decode one MMSI shard and send back compact position arrays and changed static data"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles Ctrl+C
+    name, decode = get_frame_decoder(decoder_name)
+    statics = {}  # MMSI -> (last static report sent, when); the state this shard owns
+    while True:
+        frames = inbox.get()
+        if frames is None:
+            break
+        current_time = time.time()
+        report_times = sample_report_times(frames)
+        positions = []
+        changed_statics = []
+        errors = 0
+        for frame in frames:
+            try:
+                report = decode(frame)
+            except Exception:
+                errors += 1
+                continue
+            if report is None:
+                continue
+            if report[0] == "PositionReport":
+                positions.append(tuple(math.nan if value is None else value for value in
+                                       (report[1], current_time) + report[2:]))
+            else:
+                previous = statics.get(report[1])
+                if previous is None or previous[0] != report or current_time - previous[1] > STATIC_RESEND_INTERVAL:
+                    statics[report[1]] = (report, current_time)
+                    changed_statics.append(report)
+        outbox.put((np.array(positions, dtype=SHARD_POSITION_DTYPE), changed_statics, len(frames), errors, report_times))
+
+def start_ingest_processes(count=None):
+    """Start the sharded ingest: worker processes plus dispatcher and collector threads"""
+    count = count or INGEST_PROCESSES
+    context = multiprocessing.get_context("spawn")  # Never fork a process that is running threads
+    inboxes = [context.Queue(SHARD_QUEUE_BATCHES) for _ in range(count)]
+    outbox = context.Queue()
+    for inbox in inboxes:
+        worker = context.Process(target=shard_worker, args=(inbox, outbox, frame_decoder_name))
+        worker.daemon = True
+        worker.start()
+    for target, args in ((shard_dispatcher, (inboxes,)), (shard_collector, (outbox,))):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+    log.info("Ingest sharded across %d worker processes", count)
+
+def shard_dispatcher(inboxes):
+    """Route batches of raw frames to the worker process that owns each MMSI"""
+    while running:
+        frames = frame_queue.get_batch(INGEST_BATCH_SIZE, timeout=0.5)
+        if not frames:
+            continue
+        shards = [[] for _ in inboxes]
+        for frame in frames:
+            shards[frame_shard(frame, len(inboxes))].append(frame)
+        for inbox, shard in zip(inboxes, shards):
+            if shard:
+                inbox.put(shard)  # Blocks when that worker is behind, which backs up into frame_queue
+    for inbox in inboxes:
+        inbox.put(None)
+
+def shard_collector(outbox):
+    """Merge worker results into the vessel table"""
+    while running:
+        try:
+            positions, statics, frame_count, errors, report_times = outbox.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if errors:
+            metrics.inc("ais_decode_errors_total", errors)
+            log.error("Error decoding %d messages", errors)
+        process_shard_results(positions, statics)
+        frame_queue.mark_processed(frame_count)
+        observe_ingest_latency(report_times)
+
+def track_writer():
+    """Flush queued positions to the track store in batches and expire old partitions"""
+    last_expiry = 0
+    while running:
+        time.sleep(TRACK_FLUSH_INTERVAL)
+        try:
+            track_store.flush()
+            if time.time() - last_expiry > 60:
+                expired = track_store.expire()
+                if expired:
+                    log.info("Dropped %d expired track partitions", len(expired))
+                last_expiry = time.time()
+        except Exception as e:
+            log.error("Error writing vessel tracks: %s", e)
+    try:
+        track_store.flush()
+    finally:
+        track_store.close()
+
+def describe_alert(alert):
+    """Fill in the vessel's name and position and a readable message; caller must hold vessels_lock"""
+    row = vessels.rows.get(int(alert["mmsi"]))
+    name = (vessels.name[row] if row is not None else None) or "Unknown"
+    alert["name"] = name
+    if row is not None and "lat" not in alert and vessels.lat[row] == vessels.lat[row]:
+        alert["lat"], alert["lon"] = float(vessels.lat[row]), float(vessels.lon[row])
+    vessel = f"{name} ({alert['mmsi']})"
+    if alert["event"] == "enter":
+        alert["message"] = f"{vessel} entered {alert['rule']}"
+    elif alert["event"] == "leave":
+        alert["message"] = f"{vessel} left {alert['rule']}"
+    elif alert["event"] == "speed":
+        alert["message"] = f"{vessel} is at {alert['speed']:.1f} knots ({alert['rule']})"
+    else:
+        alert["message"] = f"{vessel} has not reported for {alert['seconds'] / 60:g} minutes"
+
+def alert_worker():
+    """Deliver queued alerts, check for vessels going dark and pick up changes to the rules file"""
+    next_check = 0
+    while running:
+        current_time = time.time()
+        if current_time >= next_check:
+            try:
+                alert_engine.load()
+                alert_engine.watched = watchlist.current()[2]
+                with vessels_lock:
+                    alert_engine.check(current_time)
+            except Exception as e:
+                log.error("Error checking alert rules: %s", e)
+            next_check = current_time + ALERT_CHECK_INTERVAL
+        alerts = alert_engine.drain(timeout=max(0.1, next_check - time.time()))
+        if not alerts:
+            continue
+        described = []
+        with vessels_lock:
+            for alert in alerts:
+                try:
+                    describe_alert(alert)
+                    described.append(alert)
+                except Exception as e:
+                    log.error("Error describing alert %s: %s", alert.get("rule"), e)
+        for alert in described:
+            alert_engine.deliver(alert)
+
+def encounter_worker():
+    """Re-evaluate encounters across the fleet every ENCOUNTER_CHECK_INTERVAL seconds"""
+    while running:
+        try:
+            encounter_detector.update()
+        except Exception as e:
+            log.error("Error checking encounters: %s", e)
+        time.sleep(ENCOUNTER_CHECK_INTERVAL)
+
+def start_alerting():
+    """Attach the configured sinks and start the alert worker"""
+    sinks = {"log": log_alert, "sse": alert_broadcaster}
+    for name in ALERT_SINKS:
+        if name == "webhook":
+            if ALERT_WEBHOOK_URL:
+                alert_engine.add_sink(WebhookSink(ALERT_WEBHOOK_URL))
+            else:
+                log.warning("The webhook alert sink needs ALERT_WEBHOOK_URL")
+        elif name in sinks:
+            alert_engine.add_sink(sinks[name])
+        else:
+            log.warning("Unknown alert sink %s", name)
+    alert_thread = threading.Thread(target=alert_worker)
+    alert_thread.daemon = True
+    alert_thread.start()
+
+async def replay_ais_stream(path=None, speed=None):
+    """Feed frames from a capture file into the tracker instead of the live stream"""
+    path = path or REPLAY_FILE
+    speed = REPLAY_SPEED if speed is None else speed
+    log.info("Replaying %s at %s speed...", path, f"{speed}x" if speed else "full")
+    started = time.monotonic()
+    count = 0
+    async for frame in paced_frames(path, speed):
+        if not running:
+            break
+        await enqueue_frame(frame, block=True)  # Never drop recorded frames
+        count += 1
+    elapsed = time.monotonic() - started
+    log.info("Replay finished: %d frames in %.1fs (%.0f frames/s)", count, elapsed, count / max(elapsed, 1e-9))
+
+async def serve_replay(path=None, speed=None, port=None):
+    """Serve a capture file over a local WebSocket that stands in for AISStream.io"""
+    path = path or REPLAY_FILE
+    speed = REPLAY_SPEED if speed is None else speed
+    port = port or REPLAY_SERVER_PORT
+
+    async def stream(websocket, *args):
+        await websocket.recv()  # Subscription message; the stand-in replays everything it has
+        log.info("Replay client connected, streaming %s", path)
+        async for frame in paced_frames(path, speed):
+            await websocket.send(frame)
+        log.info("Replay stream finished")
+
+    async with websockets.serve(stream, "localhost", port):
+        log.info("Replay server listening on ws://localhost:%d", port)
+        await asyncio.Future()
+
+class FrameDeduplicator:
+    """Drop repeated reports seen on more than one subscription within DEDUP_WINDOW seconds"""
+    def __init__(self, window=DEDUP_WINDOW):
+        self.window = window
+        self.seen = set()
+        self.order = deque()  # (first seen, key), oldest first
+        self.duplicates = 0
+
+    @staticmethod
+    def key(frame):
+        """(message type, MMSI, report time) of a raw frame; the frame itself when those cannot be found"""
+        text = frame.decode("utf-8", "replace") if isinstance(frame, bytes) else frame
+        match = FRAME_KEY_PATTERN.search(text)
+        if match is None:
+            return text
+        message_type = "PositionReport" if '"PositionReport"' in text else "ShipStaticData"
+        return (message_type, int(match.group(1)), match.group(2))
+
+    def is_duplicate(self, frame):
+        now = time.monotonic()
+        while self.order and self.order[0][0] < now - self.window:
+            self.seen.discard(self.order.popleft()[1])
+        key = self.key(frame)
+        if key in self.seen:
+            self.duplicates += 1
+            return True
+        self.seen.add(key)
+        self.order.append((now, key))
+        return False
+
+def normalize_box(box):
+    """(min_lat, min_lon, max_lat, max_lon) of a [[lat, lon], [lat, lon]] box given in any corner order"""
+    (lat1, lon1), (lat2, lon2) = box
+    return min(lat1, lat2), min(lon1, lon2), max(lat1, lat2), max(lon1, lon2)
+
+def box_area_km2(box):
+    min_lat, min_lon, max_lat, max_lon = normalize_box(box)
+    km_per_degree = math.pi * EARTH_RADIUS_KM / 180
+    return (max_lat - min_lat) * km_per_degree * (max_lon - min_lon) * km_per_degree * math.cos(math.radians((min_lat + max_lat) / 2))
+
+def band_cover(boxes):
+    """Cover (south, west, north, east) boxes with boxes grown northwards from runs of covered grid cells"""
+    lats = sorted({box[0] for box in boxes} | {box[2] for box in boxes})
+    lons = sorted({box[1] for box in boxes} | {box[3] for box in boxes})
+    cover = []
+    open_runs = {}  # (west, east) -> south edge of a box still growing northwards
+    for i in range(len(lats)):
+        runs = []
+        if i < len(lats) - 1:
+            # Runs of covered cells in this latitude band
+            start = None
+            for j in range(len(lons) - 1):
+                covered = any(box[0] <= lats[i] and lats[i + 1] <= box[2] and box[1] <= lons[j] and lons[j + 1] <= box[3]
+                              for box in boxes)
+                if covered and start is None:
+                    start = j
+                elif not covered and start is not None:
+                    runs.append((lons[start], lons[j]))
+                    start = None
+            if start is not None:
+                runs.append((lons[start], lons[-1]))
+        for run in list(open_runs):
+            if run not in runs:
+                cover.append((open_runs.pop(run), run[0], lats[i], run[1]))
+        for run in runs:
+            open_runs.setdefault(run, lats[i])
+    return cover
+
+def box_cover(boxes):
+    """Non-overlapping boxes covering exactly the union of the given boxes, as few as banding allows"""
+    boxes = [normalize_box(box) for box in boxes]
+    by_latitude = band_cover(boxes)
+    # Banding along the other axis is sometimes much better, so try both
+    by_longitude = [(south, west, north, east) for west, south, east, north in
+                    band_cover([(west, south, east, north) for south, west, north, east in boxes])]
+    cover = min(by_latitude, by_longitude, key=len)
+    return [[[south, west], [north, east]] for south, west, north, east in cover]
 
-async def connect_to_ais_stream():
+def print_box_cover(boxes=None):
+    """Print a non-overlapping cover of the configured boxes, ready to paste into SUBSCRIPTION_REGIONS"""
+    if boxes is None:
+        boxes = [box for region in SUBSCRIPTION_REGIONS.values() for box in region] if SUBSCRIPTION_REGIONS else BOUNDING_BOXES
+    cover = box_cover(boxes)
+    configured = sum(box_area_km2(box) for box in boxes)
+    union = sum(box_area_km2(box) for box in cover)
+    print(f"{len(boxes)} configured boxes cover {configured:,.0f} km² in total, {union:,.0f} km² without overlaps "
+          f"({(1 - union / configured) * 100 if configured else 0:.0f}% redundant)")
+    print("SUBSCRIPTION_REGIONS = {")
+    for i, box in enumerate(cover):
+        print(f'    "region {i + 1}": [{json.dumps(box)}],  # {box_area_km2(box):,.0f} km²')
+    print("}")
+    return cover
+
+subscription_stats = {}  # Subscription name -> frame, duplicate and reconnect counters
+
+async def connect_to_ais_stream(name="AISStream", boxes=None, capture=None, deduplicator=None):
     """Connect to AISStream.io WebSocket API and process incoming messages"""
-    print("Connecting to AISStream.io...")
+    log.info("Connecting to AISStream.io (%s)...", name)
+    stats = subscription_stats.setdefault(name, {"connected": False, "frames": 0, "duplicates": 0, "reconnects": 0})
     backoff = 5
     while running:
         try:
-            async with websockets.connect("wss://stream.aisstream.io/v0/stream") as websocket:
+            async with websockets.connect(AIS_STREAM_URL) as websocket:
                 subscribe_message = {
                     "APIKey": API_KEY,
-                    # Adjust these coordinates as you wish, you can use maps for determining coordinates
-                    # You can add more bounding boxes if needed. Refer below for format.
-                    # Format: [[min_lat, min_lon], [max_lat, max_lon]] 
-                    "BoundingBoxes": [
-                        [[48.155583, -2.926026], [53.684314, 10.279541]], # Northern Europe
-                        [[51.373832, 6.060791], [50.104884, 8.665237]], # Rhine river
-                        [[50.001780, 8.277969], [47.614036, 7.589722]], # Rhine river
-                        [[42.703819, 10.587158], [41.075161, 2.103882]], # Mediterranean
-                        [[43.416062, -8.340454], [44.936130, -0.617065]], # Bay of Biscay
-                        [[46.166358, -1.210327], [48.232469, 48.232469]], # Central Europe
-                        [[46.814774, 1.689119], [47.003679, 8.403625]], # Central Europe
-                        [[47.989921, 7.207642], [48.806863, 9.228516]], # Southern Germany
-                        [[35.0, -10.0], [60.0, 30.0]] # Europe
-                    ],
+                    "BoundingBoxes": boxes or BOUNDING_BOXES,
                     "FilterMessageTypes": ["PositionReport", "ShipStaticData"]
                 }
                 await websocket.send(json.dumps(subscribe_message))
-                print("Subscription sent, waiting for vessel data...")
+                log.info("Subscription %s sent, waiting for vessel data...", name)
+                stats["connected"] = True
                 backoff = 5
                 async for message_json in websocket:
                     if not running:
                         break
-                    try:
-                        message = json.loads(message_json)
-                        process_ais_message(message)
-                    except Exception as e:
-                        print(f"Error processing message: {e}")
+                    stats["frames"] += 1
+                    metrics.inc("ais_frames_received_total", subscription=name)
+                    if deduplicator is not None and deduplicator.is_duplicate(message_json):
+                        stats["duplicates"] += 1
+                        metrics.inc("ais_duplicate_frames_total", subscription=name)
+                        continue
+                    if capture:
+                        write_capture_frame(capture, message_json)
+                    await enqueue_frame(message_json)
         except websockets.exceptions.ConnectionClosedError as e:
             if running:
-                print(f"Connection closed: {e}. Reconnecting in {backoff} seconds...")
-                await asyncio.sleep(backoff)
-                backoff = min(backoff * 2, 60)
+                log.warning("Connection %s closed: %s. Reconnecting in %d seconds...", name, e, backoff)
         except Exception as e:
             if running:
-                print(f"Unexpected error: {e}. Reconnecting in {backoff} seconds...")
-                await asyncio.sleep(backoff)
-                backoff = min(backoff * 2, 60)
+                log.error("Unexpected error on %s: %s. Reconnecting in %d seconds...", name, e, backoff)
+        stats["connected"] = False
+        if running:
+            stats["reconnects"] += 1
+            metrics.inc("ais_reconnects_total", subscription=name)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+async def stream_ais_subscriptions():
+    """Run one connection per subscription region, merging their frames into the ingest queue"""
+    regions = list(SUBSCRIPTION_REGIONS.items()) if SUBSCRIPTION_REGIONS else [("AISStream", BOUNDING_BOXES)]
+    capture = open_capture(CAPTURE_FILE) if CAPTURE_FILE else None
+    deduplicator = FrameDeduplicator() if len(regions) > 1 else None
+    try:
+        await asyncio.gather(*(connect_to_ais_stream(name, boxes, capture, deduplicator) for name, boxes in regions))
+    finally:
+        if capture:
+            capture.close()
+
+def process_ais_reports(reports):
+    """Apply a batch of report tuples from decode_frame under a single lock acquisition"""
+    errors = 0
+    with vessels_lock:
+        for report in reports:
+            try:
+                apply_ais_report(report)
+            except Exception as e:
+                errors += 1
+                log.error("Error processing message: %s", e)
+    count_processed([report[0] for report in reports], errors)
+
+def count_processed(message_types, errors=0):
+    """Add a batch to the processed-messages counters, once per message type"""
+    counts = {}
+    for message_type in message_types:
+        counts[message_type] = counts.get(message_type, 0) + 1
+    for message_type, count in counts.items():
+        metrics.inc("ais_messages_processed_total", count, type=message_type)
+    if errors:
+        metrics.inc("ais_process_errors_total", errors)
+
+def process_shard_results(positions, statics):
+    """Apply one worker batch: changed static data, then the newest position of each vessel"""
+    # Every position goes to the history, but only the newest per vessel has to touch the table and indexes
+    mmsis, reversed_index = np.unique(positions["mmsi"][::-1], return_index=True)
+    newest = np.sort(len(positions) - 1 - reversed_index)
+    errors = 0
+    with vessels_lock:
+        for report in statics:
+            try:
+                apply_ais_report(report)
+            except Exception as e:
+                errors += 1
+                log.error("Error processing message: %s", e)
+        if track_store is not None:
+            for mmsi, timestamp, lat, lon, course, speed in zip(
+                    positions["mmsi"].tolist(), positions["ts"].tolist(), positions["lat"].tolist(),
+                    positions["lon"].tolist(), positions["course"].tolist(), positions["speed"].tolist()):
+                if lat == lat and lon == lon:
+                    track_store.append(mmsi, timestamp, lat, lon, course, speed)
+                    trail_cache.append(mmsi, timestamp, lat, lon, course, speed)
+        for mmsi, timestamp, lat, lon, course, speed, heading in positions[newest].tolist():
+            try:
+                apply_position(mmsi, lat, lon, course, speed, heading, timestamp, record_track=False)
+            except Exception as e:
+                errors += 1
+                log.error("Error processing message: %s", e)
+    count_processed([report[0] for report in statics], errors)
+    metrics.inc("ais_messages_processed_total", len(positions), type="PositionReport")
 
 def process_ais_message(message):
-    """Process incoming AIS message and update vessels dictionary"""
-    message_type = message.get("MessageType")
-    metadata = message.get("Metadata", {})
-    mmsi = None
+    """Process incoming AIS message and update vessels table"""
+    with vessels_lock:
+        apply_ais_message(message)
 
+def take_snapshot():
+    """Return an immutable snapshot of the vessel table at most SNAPSHOT_MAX_AGE old"""
     with vessels_lock:
-        if message_type == "PositionReport":
-            ais_message = message.get("Message", {}).get("PositionReport", {})
-            if ais_message:
-                mmsi = str(ais_message.get("UserID"))
-                if mmsi:
-                    if mmsi not in vessels:
-                        vessels[mmsi] = {"last_update": time.time()}
-                    vessels[mmsi].update({
-                        "mmsi": mmsi,
-                        "lat": ais_message.get("Latitude"),
-                        "lon": ais_message.get("Longitude"),
-                        "course": ais_message.get("Course"),
-                        "speed": ais_message.get("Speed"),
-                        "heading": ais_message.get("TrueHeading"),
-                        "last_update": time.time()
-                    })
-        elif message_type == "ShipStaticData":
-            ais_message = message.get("Message", {}).get("ShipStaticData", {})
-            if ais_message:
-                mmsi = str(ais_message.get("UserID"))
-                if mmsi:
-                    if mmsi not in vessels:
-                        vessels[mmsi] = {"last_update": time.time()}
-                    vessels[mmsi].update({
-                        "mmsi": mmsi,
-                        "name": ais_message.get("Name", "").strip(),
-                        "ship_type": ais_message.get("ShipType"),
-                        "length": ais_message.get("Length"),
-                        "width": ais_message.get("Width"),
-                        "callsign": ais_message.get("CallSign", "").strip(),
-                        "last_update": time.time()
-                    })
-                    if "Latitude" in metadata and "Longitude" in metadata:
-                        vessels[mmsi].update({
-                            "lat": metadata.get("Latitude"),
-                            "lon": metadata.get("Longitude")
-                        })
+        return vessels.snapshot(SNAPSHOT_MAX_AGE)
+
+def vessels_changed_since(generation):
+    """MMSIs changed after a snapshot generation (None means reload everything)"""
+    with vessels_lock:
+        return vessels.changed_since(generation)
+
+def apply_ais_message(message):
+    """Update vessels table from one AIS message; caller must hold vessels_lock"""
+    report = report_from_message(message)
+    if report is not None:
+        apply_ais_report(report)
+
+def apply_ais_report(report):
+    """Update vessels table from one report tuple; caller must hold vessels_lock"""
+    if report[0] == "PositionReport":
+        message_type, mmsi, lat, lon, course, speed, heading = report
+        apply_position(mmsi, lat, lon, course, speed, heading, time.time())
+    elif report[0] == "ShipStaticData":
+        message_type, mmsi, name, ship_type, length, width, callsign, lat, lon = report
+        timestamp = time.time()
+        row = vessels.upsert_static(mmsi, name, ship_type, length, width, callsign, timestamp, lat, lon)
+        vessel_expiry.touch(mmsi, timestamp)
+        if alert_engine is not None:
+            alert_engine.observe(mmsi, lat, lon, None, int(vessels.ship_type[row]), timestamp)
+        if lat is not None and lon is not None:
+            spatial_index.update(mmsi, lat, lon)
+        cluster_index.update(mmsi, vessels.lat[row], vessels.lon[row], int(vessels.ship_type[row]))
+        if heatmap is not None:
+            heatmap.update(mmsi, vessels.lat[row], vessels.lon[row], int(vessels.ship_type[row]))
+        search_index.update(mmsi, vessels.name[row], vessels.callsign[row])
+
+def apply_position(mmsi, lat, lon, course, speed, heading, timestamp, record_track=True):
+    """Update a vessel and the indexes from a position; caller must hold vessels_lock"""
+    row = vessels.upsert_position(mmsi, lat, lon, course, speed, heading, timestamp)
+    vessel_expiry.touch(mmsi, timestamp)
+    if alert_engine is not None:
+        alert_engine.observe(mmsi, lat, lon, speed, int(vessels.ship_type[row]), timestamp)
+    if record_track and track_store is not None:
+        track_store.append(mmsi, timestamp, lat, lon, course, speed)
+        trail_cache.append(mmsi, timestamp, lat, lon, course, speed)
+    spatial_index.update(mmsi, lat, lon)
+    cluster_index.update(mmsi, lat, lon, int(vessels.ship_type[row]))
+    if heatmap is not None:
+        heatmap.observe(mmsi, lat, lon, int(vessels.ship_type[row]), timestamp)
+    search_index.add(mmsi)
 
 def get_ship_type_name(type_code):
     """Convert AIS ship type code to readable name"""
@@ -141,112 +2724,561 @@ def get_ship_type_name(type_code):
             return name
     return "Unknown"
 
-def load_filtered_mmsi():
-    """Load MMSI numbers from filter file"""
-    filtered_mmsi = set()
+def save_mmsi_to_filter(mmsi):
+    """Add a new MMSI to the filter file"""
     try:
-        if os.path.exists(MMSI_FILTER_FILE):
-            with open(MMSI_FILTER_FILE, 'r') as f:
-                for line in f:
-                    mmsi = line.strip()
-                    if mmsi:
-                        filtered_mmsi.add(mmsi)
-            print(f"Loaded {len(filtered_mmsi)} vessels to watch from {MMSI_FILTER_FILE}")
-        else:
-            print(f"Filter file {MMSI_FILTER_FILE} not found. Creating empty watchlist.")
-            open(MMSI_FILTER_FILE, 'a').close()
+        if watchlist.add(mmsi):
+            log.info("Added MMSI %s to watch list", mmsi)
+        return True
     except Exception as e:
-        print(f"Error loading filter file: {e}")
-    return filtered_mmsi
+        log.error("Error saving MMSI to filter: %s", e)
+        return False
 
-def save_mmsi_to_filter(mmsi):
-    """Add a new MMSI to the filter file"""
+def remove_mmsi_from_filter(mmsi):
+    """Remove an MMSI from the filter file"""
     try:
-        with open(MMSI_FILTER_FILE, 'a+') as f:
-            f.write(f"{mmsi}\n")
-        print(f"Added MMSI {mmsi} to watch list")
+        if watchlist.remove(mmsi):
+            log.info("Removed MMSI %s from watch list", mmsi)
         return True
     except Exception as e:
-        print(f"Error saving MMSI to filter: {e}")
+        log.error("Error updating filter file: %s", e)
         return False
 
-def create_map():
-    """Create and save a map with vessel markers and filter controls"""
-    global filter_enabled, search_term
+def watched_rows(snapshot):
+    """Snapshot rows of watched vessels, looked up per watched MMSI and cached until the snapshot or list changes"""
+    version, ids, id_set = watchlist.current()
+    key = (snapshot.generation, version)
+    view = watchlist.view
+    if view is not None and view[0] == key:
+        return view[1]
     with vessels_lock:
-        vessels_copy = copy.deepcopy(vessels)
+        rows = np.array([vessels.rows.get(mmsi, -1) for mmsi in ids.tolist()], dtype=np.intp)
+    # Rows handed out or recycled after the snapshot was taken don't belong to it
+    rows = rows[(rows >= 0) & (rows < snapshot.row_count)]
+    rows = np.sort(rows[np.isin(snapshot.mmsi[rows], ids)])
+    watchlist.view = (key, rows)
+    return rows
+
+def watched_visible_rows(snapshot, now, max_age=DISPLAY_TTL):
+    """Positioned watched vessels updated within max_age, without scanning the rest of the fleet"""
+    rows = watched_rows(snapshot)
+    lat, lon = snapshot.lat[rows], snapshot.lon[rows]
+    return rows[~np.isnan(lat) & ~np.isnan(lon) & (now - snapshot.last_update[rows] <= max_age)]
+
+def default_view():
+    """The server-wide (filter, search) view set by /toggle_filter and /search"""
+    return filter_enabled, search_term
+
+def parse_view(query):
+    """(filter, search) view of a request; parameters it leaves out fall back to the server-wide view"""
+    view_filter = query['filter'][0].lower() in ('1', 'true', 'yes') if 'filter' in query else filter_enabled
+    view_search = query['search'][0].strip() if 'search' in query else search_term
+    return view_filter, view_search
 
-    filtered_mmsi = load_filtered_mmsi() if filter_enabled else set()
-    all_positions = []
-    vessels_to_show = {}
+def view_key(view, current_time):
+    """Cache key part for a view: the watch list version matters only when filtering, and time only coarsely"""
+    view_filter, view_search = view
+    return (watchlist.current()[0] if view_filter else None, view_search, int(current_time // VIEW_CACHE_SECONDS))
 
+def search_matches(snapshot, term):
+    """MMSIs matching a search term, shared by every view on the same snapshot"""
+    def search():
+        with vessels_lock:
+            return np.array(search_index.search(term, limit=None), dtype=np.int64)
+    return view_cache.get(("search", snapshot.generation, term), search)
+
+def filter_view_rows(snapshot, rows, view=None):
+    """Apply the watchlist filter and search term of a view (the server-wide one by default) to snapshot rows"""
+    view_filter, view_search = view or default_view()
+    if view_filter:
+        rows = np.intersect1d(rows, watched_rows(snapshot), assume_unique=True)
+    if view_search:
+        rows = rows[np.isin(snapshot.mmsi[rows], search_matches(snapshot, view_search))]
+    return rows
+
+def view_rows(snapshot, view, current_time):
+    """Visible rows of a view, computed once per snapshot generation and view"""
+    def compute():
+        if view[0]:
+            rows = watched_visible_rows(snapshot, current_time)
+        else:
+            rows = snapshot.visible_rows(current_time, DISPLAY_TTL)
+        rows = filter_view_rows(snapshot, rows, view)
+        rows.flags.writeable = False
+        return rows
+    return view_cache.get(("rows", snapshot.generation, view[0]) + view_key(view, current_time), compute)
+
+def map_view_payload(view):
+    """The map payload JSON of a view, shared by every client asking for the same one"""
+    snapshot = take_snapshot()
     current_time = time.time()
-    for mmsi, vessel in vessels_copy.items():
-        if "lat" not in vessel or "lon" not in vessel or current_time - vessel.get("last_update", 0) > 1800:
-            continue
-        if filter_enabled and mmsi not in filtered_mmsi:
-            continue
-        vessels_to_show[mmsi] = vessel
-        all_positions.append((vessel.get("lat", 0), vessel.get("lon", 0)))
 
-    # Apply search filter if provided and not empty
+    def compute():
+        rows = view_rows(snapshot, view, current_time)
+        if MAX_MARKERS and len(rows) > MAX_MARKERS:
+            rows = snapshot.newest(rows, MAX_MARKERS)
+        return map_payload(snapshot, rows, len(snapshot), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), view)
+    return view_cache.get(("payload", snapshot.generation, view[0], MAX_MARKERS) + view_key(view, current_time), compute)
+
+def create_map():
+    """Publish the map page with the visible vessels, unless nothing changed since the last one"""
+    global last_map_key
+    started = time.perf_counter()
+    snapshot = take_snapshot()
+    current_time = time.time()
+    total_vessels = len(snapshot)
+
+    # Apply watchlist and search filters if enabled
     if search_term:
-        print(f"Applying search filter for: '{search_term}'")
-        filtered_vessels = {}
-        for mmsi, vessel in vessels_to_show.items():
-            vessel_name = vessel.get("name", "").lower()
-            vessel_mmsi = mmsi.lower()
-            if search_term.lower() in vessel_name or search_term.lower() in vessel_mmsi:
-                filtered_vessels[mmsi] = vessel
-        vessels_to_show = filtered_vessels
-        all_positions = [(v.get("lat", 0), v.get("lon", 0)) for v in filtered_vessels.values()]
+        log.debug("Applying search filter for: '%s'", search_term)
     else:
-        print("No search term applied")
+        log.debug("No search term applied")
+    rows = view_rows(snapshot, default_view(), current_time)
 
     # Optional: Limit number of markers for performance
-    if MAX_MARKERS and len(vessels_to_show) > MAX_MARKERS:
-        print(f"Limiting to {MAX_MARKERS} most recent vessels out of {len(vessels_to_show)}")
-        vessels_to_show = dict(sorted(vessels_to_show.items(), key=lambda x: x[1]["last_update"], reverse=True)[:MAX_MARKERS])
-        all_positions = [(v.get("lat", 0), v.get("lon", 0)) for v in vessels_to_show.values()]
-
-    center = [48.0, 10.0] if not all_positions else [
-        sum(pos[0] for pos in all_positions) / len(all_positions),
-        sum(pos[1] for pos in all_positions) / len(all_positions)
+    if MAX_MARKERS and len(rows) > MAX_MARKERS:
+        log.debug("Limiting to %d most recent vessels out of %d", MAX_MARKERS, len(rows))
+        rows = snapshot.newest(rows, MAX_MARKERS)
+
+    key = (snapshot.generation, filter_enabled, search_term, zlib.crc32(rows.tobytes()))
+    if key == last_map_key:
+        log.debug("Map unchanged since generation %d, not rebuilt", snapshot.generation)
+        return
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    payload = map_view_payload(default_view())  # Shared with pages showing the server-wide view
+    if publish_map(payload):
+        last_map_key = key
+    metrics.observe("ais_map_build_seconds", time.perf_counter() - started)
+    log.info("Map updated with %d active vessels out of %d total at %s", len(rows), total_vessels, timestamp)
+
+def map_payload(snapshot, rows, total_vessels, timestamp, view=None):
+    """Everything that changes between map updates, as one compact JSON string"""
+    view_filter, view_search = view or default_view()
+    if DEAD_RECKONING:
+        lat, lon = dead_reckon(snapshot, rows, time.time())[:2]
+    else:
+        lat, lon = snapshot.lat[rows], snapshot.lon[rows]
+    vessels_to_show = [
+        [mmsi, round(lat, 5), round(lon, 5), ship_type, name]
+        for mmsi, lat, lon, ship_type, name in zip(
+            snapshot.mmsi[rows].tolist(), lat.tolist(), lon.tolist(),
+            snapshot.ship_type[rows].tolist(), snapshot.name[rows].tolist())
     ]
+    payload = {
+        "center": snapshot.center(rows) or [48.0, 10.0],
+        "active": len(rows),
+        "total": total_vessels,
+        "updated": timestamp,
+        "filter": view_filter,
+        "search": view_search,
+        "vessels": vessels_to_show
+    }
+    # "</" would end the script element the payload is embedded in
+    return json.dumps(payload, separators=(",", ":")).replace("</", "<\\/")
 
-    m = folium.Map(location=center, zoom_start=6, tiles="cartodb positron")
+def build_map_template():
+    """Render the static map page once, with a placeholder where each update's vessel payload goes"""
+    m = folium.Map(location=[48.0, 10.0], zoom_start=6, tiles="cartodb positron")
     marker_cluster = MarkerCluster(
         maxClusterRadius=30,  # Smaller radius for tighter clusters
         spiderfyOnMaxZoom=False,  # Avoid overwhelming at max zoom
         disableClusteringAtZoom=15  # Show individual markers at higher zoom
     ).add_to(m)
+    add_page_controls(m, 0, 0, "")
+
+    ship_type_names = json.dumps({code: get_ship_type_name(code) for code in range(100)})
+    payload_js = f'''
+        const VESSEL_PAYLOAD = {MAP_PAYLOAD_PLACEHOLDER};
+        const SHIP_TYPE_NAMES = {ship_type_names};
+        function vesselColor(shipType) {{
+            if (shipType >= 60 && shipType <= 69) return 'green';
+            if (shipType >= 70 && shipType <= 79) return 'blue';
+            if (shipType >= 80 && shipType <= 89) return 'red';
+            return 'gray';
+        }}
+        function escapeHtml(text) {{
+            return String(text).replace(/[&<>"']/g, c => ({{'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}})[c]);
+        }}
+        function showPayload(payload) {{
+            document.getElementById('activeCount').textContent = payload.active;
+            document.getElementById('totalCount').textContent = payload.total;
+            document.getElementById('lastUpdated').textContent = payload.updated;
+            document.getElementById('filterSwitch').checked = payload.filter;
+            document.getElementById('searchInput').value = payload.search;
+            // One bulk add instead of a folium object and script block per vessel
+            {marker_cluster.get_name()}.clearLayers();
+            {marker_cluster.get_name()}.addLayers(payload.vessels.map(([mmsi, lat, lon, shipType, name]) => {{
+                const label = escapeHtml(`${{name || 'Unknown'}} (${{mmsi}})`);
+                const icon = L.AwesomeMarkers.icon({{icon: 'ship', prefix: 'fa', iconColor: 'white', markerColor: vesselColor(shipType)}});
+                return L.marker([lat, lon], {{icon: icon}})
+                    .bindPopup(`${{label}}<br>Type: ${{escapeHtml(SHIP_TYPE_NAMES[shipType] || 'Unknown')}}`, {{maxWidth: 200}})
+                    .bindTooltip(label);
+            }}));
+        }}
+        let mapViewTimer = null;
+        function refreshMapView() {{
+            // This tab's own view, from the server's shared view cache; the page file only holds the server-wide view
+            if (!mapViewTimer) mapViewTimer = setInterval(refreshMapView, {MAP_UPDATE_INTERVAL * 1000});
+            fetch(`${{BASE_URL}}/map/payload?${{viewQuery().slice(1)}}`)
+                .then(response => {{
+                    if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
+                    return response.json();
+                }})
+                .then(showPayload)
+                .catch(error => console.error('Error refreshing vessels:', error));
+        }}
+        document.addEventListener('DOMContentLoaded', () => {{
+            {m.get_name()}.setView(VESSEL_PAYLOAD.center, {m.get_name()}.getZoom());
+            showPayload(VESSEL_PAYLOAD);
+            if (vesselView) refreshMapView();
+        }});
+    '''
+    m.get_root().script.add_child(folium.Element(payload_js))
+    return m.get_root().render()
+
+def offline_page(html):
+    """The map page with its status switched to offline"""
+    return html.replace('Capturing data...', 'Tracker offline').replace('class="sonar"', 'class="offline"')
+
+def write_file_atomically(path, data):
+    """Write a file beside its final path and rename it into place, so readers never see it half-written"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w" if isinstance(data, str) else "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def map_render_worker(inbox, outbox, path):
+    """Worker process: fill payloads into the cached page template and publish each page"""
+    template = None
+    while True:
+        job = inbox.get()
+        if job is None:
+            break
+        payload, offline = job
+        started = time.perf_counter()
+        try:
+            if template is None:
+                template = build_map_template()
+            html = template.replace(MAP_PAYLOAD_PLACEHOLDER, payload)
+            write_file_atomically(path, offline_page(html) if offline else html)
+            outbox.put((len(html.encode()), time.perf_counter() - started, None))
+        except Exception as e:
+            outbox.put((0, time.perf_counter() - started, str(e)))
 
-    active_vessels = 0
-    filtered_vessels = 0
-
-    print(f"Adding {len(vessels_to_show)} markers to the map")
-    for mmsi, vessel in vessels_to_show.items():
-        active_vessels += 1
-        if filter_enabled and mmsi in filtered_mmsi:
-            filtered_vessels += 1
-
-        ship_type = vessel.get("ship_type", 0)
-        color = "gray"
-        if ship_type:
-            if 60 <= ship_type <= 69: color = "green"
-            elif 70 <= ship_type <= 79: color = "blue"
-            elif 80 <= ship_type <= 89: color = "red"
-
-        name = vessel.get("name", "Unknown")
-        # Simplified popup to reduce rendering load
-        popup_content = f"{name} ({mmsi})<br>Type: {get_ship_type_name(ship_type)}"
-        folium.Marker(
-            location=[vessel["lat"], vessel["lon"]],
-            popup=folium.Popup(popup_content, max_width=200),
-            icon=folium.Icon(color=color, icon="ship", prefix="fa"),
-            tooltip=f"{name} ({mmsi})"
-        ).add_to(marker_cluster)
+class MapRenderProcess:
+    """Renders the static map page in a worker process; only the newest payload is ever waiting"""
+    def __init__(self, path):
+        context = multiprocessing.get_context("spawn")
+        self.inbox = context.Queue(maxsize=1)
+        self.outbox = context.Queue()
+        path = os.path.abspath(path)  # The worker resolves it independently of later chdirs
+        self.process = context.Process(target=map_render_worker, args=(self.inbox, self.outbox, path), daemon=True)
+        self.process.start()
 
+    def submit(self, payload, offline=False, block=False):
+        """Queue a page; returns False when the worker is still busy with the previous one"""
+        try:
+            self.inbox.put((payload, offline), block=block, timeout=10 if block else None)
+            return True
+        except queue.Full:
+            return False
+
+    def results(self):
+        """(bytes, seconds, error) of the pages written since the last call"""
+        results = []
+        while True:
+            try:
+                results.append(self.outbox.get_nowait())
+            except queue.Empty:
+                return results
+
+    def stop(self, timeout=10):
+        try:
+            self.inbox.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.process.join(timeout)
+
+def publish_map(payload, offline=False):
+    """Hand a page to the render process, or render it here; returns False if it was not taken"""
+    global last_map_payload, map_offline
+    with map_publish_lock:
+        if map_offline:
+            return False  # The shutdown page is final
+        map_offline = offline
+        last_map_payload = payload
+        if map_renderer is not None:
+            for size, seconds, error in map_renderer.results():
+                if error:
+                    log.error("Error rendering map: %s", error)
+                else:
+                    metrics.observe("ais_map_save_seconds", seconds)
+                    metrics.set("ais_map_html_bytes", size)
+            return map_renderer.submit(payload, offline, block=offline)
+        global map_template
+        save_started = time.perf_counter()
+        if map_template is None:
+            map_template = build_map_template()
+        html = map_template.replace(MAP_PAYLOAD_PLACEHOLDER, payload)
+        write_file_atomically(MAP_FILE, offline_page(html) if offline else html)
+        metrics.observe("ais_map_save_seconds", time.perf_counter() - save_started)
+        metrics.set("ais_map_html_bytes", len(html))
+        return True
+
+def publish_offline_map():
+    """Mark the published map page offline; later updates are refused so they can't overwrite it"""
+    global map_offline
+    if DYNAMIC_MAP or last_map_payload is None:
+        with map_publish_lock:
+            map_offline = True
+            with open(MAP_FILE, 'r') as file:
+                filedata = file.read()
+            write_file_atomically(MAP_FILE, offline_page(filedata))
+        return
+    publish_map(last_map_payload, offline=True)
+    if map_renderer is not None:
+        map_renderer.stop()
+
+def start_map_renderer():
+    """Start the render process for the static map page"""
+    global map_renderer
+    map_renderer = MapRenderProcess(MAP_FILE)
+    log.info("Rendering the map page in a worker process")
+
+def create_map_shell():
+    """Write the dynamic map page once; vessels are streamed into it from /vessels/delta"""
+    snapshot = take_snapshot()
+    center = snapshot.center(snapshot.visible_rows(time.time(), DISPLAY_TTL)) or [48.0, 10.0]
+    m = folium.Map(location=center, zoom_start=6, tiles="cartodb positron", prefer_canvas=True)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    add_page_controls(m, 0, len(snapshot), timestamp, dynamic=True)
+
+    ship_type_names = json.dumps({code: get_ship_type_name(code) for code in range(100)})
+    dynamic_js = f'''
+        let vesselMap = null;  // Folium defines the map later in this script block
+        const vesselRenderer = L.canvas({{ padding: 0.5 }});
+        const vesselMarkers = new Map();
+        const SHIP_TYPE_NAMES = {ship_type_names};
+        let vesselGeneration = 0;
+        let vesselPolling = false;
+        let vesselRequestId = 0;
+        let vesselFullRequestId = 0;
+        const clusterLayer = L.layerGroup();
+        const trailLayer = L.layerGroup();
+        let trailMmsi = null;
+        let serverClockOffset = 0;  // Server time minus browser time, in seconds
+        let deadReckoningMaxAge = 0;
+        function clusterMode() {{
+            // Watch list and search results are small enough to always draw vessel by vessel
+            const filtered = document.getElementById('filterSwitch').checked || document.getElementById('searchInput').value;
+            return !filtered && vesselMap.getZoom() <= {CLUSTER_MAX_ZOOM};
+        }}
+        function clearVessels() {{
+            vesselMarkers.forEach(marker => marker.remove());
+            vesselMarkers.clear();
+        }}
+        function refreshClusters() {{
+            const zoom = vesselMap.getZoom();
+            const pixels = vesselMap.getPixelBounds();
+            const size = 2 ** zoom;
+            const tiles = [];
+            for (let x = Math.floor(pixels.min.x / 256); x <= Math.floor(pixels.max.x / 256); x++) {{
+                for (let y = Math.max(Math.floor(pixels.min.y / 256), 0); y <= Math.min(Math.floor(pixels.max.y / 256), size - 1); y++) {{
+                    tiles.push([((x % size) + size) % size, y]);
+                }}
+            }}
+            return Promise.all(tiles.map(([x, y]) => fetch(`${{BASE_URL}}/clusters/${{zoom}}/${{x}}/${{y}}`).then(response => {{
+                if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
+                return response.json();
+            }}))).then(results => {{
+                if (vesselMap.getZoom() !== zoom) return;
+                clusterLayer.clearLayers();
+                let shown = 0;
+                results.forEach(tile => tile.clusters.forEach(([lat, lon, count, types]) => {{
+                    shown += count;
+                    const breakdown = Object.entries(types).map(([name, n]) => `${{escapeHtml(name)}}: ${{n}}`).join('<br>');
+                    const size = Math.round(24 + 8 * Math.log10(count));
+                    L.marker([lat, lon], {{
+                        icon: L.divIcon({{
+                            html: `<div style="width:${{size}}px;height:${{size}}px;line-height:${{size}}px;border-radius:50%;text-align:center;background:rgba(52,152,219,0.75);color:white;font-weight:bold;">${{count}}</div>`,
+                            className: '', iconSize: [size, size]
+                        }})
+                    }}).bindTooltip(`${{count}} vessels<br>${{breakdown}}`)
+                      .on('click', () => vesselMap.setView([lat, lon], Math.min(zoom + 2, {CLUSTER_MAX_ZOOM + 1})))
+                      .addTo(clusterLayer);
+                }}));
+                document.getElementById('activeCount').textContent = shown;
+                document.getElementById('lastUpdated').textContent = new Date().toLocaleString();
+            }});
+        }}
+        function refreshTrail() {{
+            // Trail of the vessel whose popup is open, simplified server-side for the current zoom
+            if (!trailMmsi) return;
+            const mmsi = trailMmsi;
+            fetch(`${{BASE_URL}}/track?mmsi=${{mmsi}}&zoom=${{vesselMap.getZoom()}}`)
+                .then(response => response.ok ? response.json() : null)
+                .then(track => {{
+                    if (!track || trailMmsi !== mmsi) return;
+                    trailLayer.clearLayers();
+                    L.polyline(track.geometry.coordinates.map(([lon, lat]) => [lat, lon]), {{
+                        color: '#e67e22', weight: 2, opacity: 0.8
+                    }}).addTo(trailLayer);
+                }})
+                .catch(error => console.error('Error loading trail:', error));
+        }}
+        function vesselColor(shipType) {{
+            if (shipType >= 60 && shipType <= 69) return 'green';
+            if (shipType >= 70 && shipType <= 79) return 'blue';
+            if (shipType >= 80 && shipType <= 89) return 'red';
+            return 'gray';
+        }}
+        function escapeHtml(text) {{
+            return String(text).replace(/[&<>"']/g, c => ({{'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}})[c]);
+        }}
+        function setTrackerStatus(online) {{
+            const status = document.getElementById('status');
+            status.textContent = online ? 'Capturing data...' : 'Tracker offline';
+            status.className = online ? 'sonar' : 'offline';
+        }}
+        function applyVesselDelta(data) {{
+            if (data.full) {{
+                // Keep markers that are still present so open popups survive a resync
+                const present = new Set(data.vessels.map(vessel => vessel[0]));
+                vesselMarkers.forEach((marker, mmsi) => {{
+                    if (!present.has(mmsi)) {{
+                        marker.remove();
+                        vesselMarkers.delete(mmsi);
+                    }}
+                }});
+            }}
+            data.removed.forEach(mmsi => {{
+                const marker = vesselMarkers.get(mmsi);
+                if (marker) {{
+                    marker.remove();
+                    vesselMarkers.delete(mmsi);
+                }}
+            }});
+            serverClockOffset = data.now - Date.now() / 1000;
+            deadReckoningMaxAge = data.dead_reckoning_max_age;
+            data.vessels.forEach(([mmsi, lat, lon, shipType, name, lastUpdate, north, east]) => {{
+                const color = vesselColor(shipType);
+                const label = `${{escapeHtml(name || 'Unknown')}} (${{mmsi}})`;
+                const popup = `${{label}}<br>Type: ${{SHIP_TYPE_NAMES[shipType] || 'Unknown'}}`;
+                let marker = vesselMarkers.get(mmsi);
+                if (marker) {{
+                    marker.setLatLng([lat, lon]);
+                    marker.setStyle({{ color: color, fillColor: color }});
+                    marker.setTooltipContent(label);
+                    marker.setPopupContent(popup);
+                }} else {{
+                    marker = L.circleMarker([lat, lon], {{
+                        renderer: vesselRenderer, radius: 5, weight: 1, color: color, fillColor: color, fillOpacity: 0.8
+                    }}).bindTooltip(label).bindPopup(popup, {{ maxWidth: 200 }}).addTo(vesselMap);
+                    marker.on('popupopen', () => {{
+                        trailMmsi = mmsi;
+                        refreshTrail();
+                    }});
+                    marker.on('popupclose', () => {{
+                        if (trailMmsi !== mmsi) return;
+                        trailMmsi = null;
+                        trailLayer.clearLayers();
+                    }});
+                    vesselMarkers.set(mmsi, marker);
+                }}
+                marker.lastUpdate = lastUpdate;
+                marker.motion = {{ lat: lat, lon: lon, at: data.now, north: north, east: east }};
+            }});
+            // Vessels that stopped reporting age out without a server-side change
+            vesselMarkers.forEach((marker, mmsi) => {{
+                if (data.now - marker.lastUpdate > data.max_age) {{
+                    marker.remove();
+                    vesselMarkers.delete(mmsi);
+                }}
+            }});
+            document.getElementById('activeCount').textContent = vesselMarkers.size;
+            document.getElementById('totalCount').textContent = data.total;
+            document.getElementById('lastUpdated').textContent = new Date(data.now * 1000).toLocaleString();
+        }}
+        function animateVessels() {{
+            // Keep moving vessels along their course between polls, up to the dead reckoning cutoff
+            if (!deadReckoningMaxAge || document.hidden) return;
+            const now = Date.now() / 1000 + serverClockOffset;
+            vesselMarkers.forEach(marker => {{
+                const motion = marker.motion;
+                if (!motion || motion.settled || (!motion.north && !motion.east)) return;
+                const cutoff = marker.lastUpdate + deadReckoningMaxAge;
+                const elapsed = Math.min(now, cutoff) - motion.at;
+                motion.settled = now >= cutoff;
+                if (elapsed <= 0) return;
+                const lat = Math.max(Math.min(motion.lat + motion.north * elapsed, 90), -90);
+                const lon = ((motion.lon + motion.east * elapsed + 180) % 360 + 360) % 360 - 180;
+                marker.setLatLng([lat, lon]);
+            }});
+        }}
+        function viewportBbox() {{
+            // Only vessels on screen (plus a margin) are sent to the browser
+            const bounds = vesselMap.getBounds().pad(0.25);
+            if (bounds.getEast() - bounds.getWest() >= 360) return '';
+            const wrap = lon => ((lon + 180) % 360 + 360) % 360 - 180;
+            const south = Math.max(bounds.getSouth(), -90);
+            const north = Math.min(bounds.getNorth(), 90);
+            return `&bbox=${{wrap(bounds.getWest())}},${{south}},${{wrap(bounds.getEast())}},${{north}}`;
+        }}
+        function refreshVessels(full) {{
+            if (vesselPolling && !full) return;
+            vesselPolling = true;
+            if (clusterMode()) {{
+                clearVessels();
+                vesselGeneration = 0;
+                refreshClusters()
+                    .then(() => setTrackerStatus(true))
+                    .catch(error => {{
+                        console.error('Error refreshing clusters:', error);
+                        setTrackerStatus(false);
+                    }})
+                    .finally(() => {{ vesselPolling = false; }});
+                return;
+            }}
+            clusterLayer.clearLayers();
+            const requestId = ++vesselRequestId;
+            if (full) vesselFullRequestId = requestId;
+            const since = full ? 0 : vesselGeneration;
+            fetch(`${{BASE_URL}}/vessels/delta?since=${{since}}${{viewportBbox()}}${{viewQuery()}}`)
+                .then(response => {{
+                    if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
+                    return response.json();
+                }})
+                .then(data => {{
+                    if (requestId < vesselFullRequestId) return;  // Superseded by a resync
+                    applyVesselDelta(data);
+                    vesselGeneration = data.generation;
+                    refreshTrail();
+                    setTrackerStatus(true);
+                }})
+                .catch(error => {{
+                    console.error('Error refreshing vessels:', error);
+                    setTrackerStatus(false);
+                }})
+                .finally(() => {{ vesselPolling = false; }});
+        }}
+        document.addEventListener('DOMContentLoaded', () => {{
+            vesselMap = {m.get_name()};
+            clusterLayer.addTo(vesselMap);
+            trailLayer.addTo(vesselMap);
+            vesselMap.on('moveend', () => refreshVessels(true));
+            refreshVessels(true);
+            setInterval(() => refreshVessels(false), {DYNAMIC_POLL_INTERVAL * 1000});
+            setInterval(animateVessels, 1000);
+        }});
+    '''
+    m.get_root().script.add_child(folium.Element(dynamic_js))
+
+    with map_publish_lock:
+        write_file_atomically(MAP_FILE, m.get_root().render())
+    log.info("Dynamic map page written to %s, vessels will be streamed from port %d", MAP_FILE, PORT)
+
+def add_page_controls(m, active_vessels, total_vessels, timestamp, dynamic=False):
+    """Add the legend, control panel, title, watch list modal and page scripts to a map"""
     legend_html = """
     <div style="position: fixed; bottom: 50px; left: 50px; z-index: 1000; background-color: white; 
                 padding: 10px; border: 2px solid grey; border-radius: 5px;">
@@ -273,7 +3305,9 @@ def create_map():
         </div>
         <div class="form-group">
             <label for="searchInput">Search vessels:</label>
-            <input type="text" class="form-control" id="searchInput" placeholder="Name or MMSI" value="{search_term_safe}">
+            <input type="text" class="form-control" id="searchInput" placeholder="Name, callsign or MMSI" value="{search_term_safe}"
+                   list="vesselSuggestions" autocomplete="off" oninput="suggestVessels(this.value)">
+            <datalist id="vesselSuggestions"></datalist>
             <div class="mt-2">
                 <button class="btn btn-primary btn-sm" onclick="searchVessels(document.getElementById('searchInput').value)">
                     Search
@@ -288,15 +3322,21 @@ def create_map():
     """
     m.get_root().html.add_child(folium.Element(control_panel))
 
+    if heatmap is not None:
+        # Rendered by the control server from the ingest counters; off until picked in the layer control
+        for layer, name in (("traffic", "Traffic heatmap"), ("density", "Vessel density")):
+            folium.raster_layers.TileLayer(
+                tiles=f"http://localhost:{PORT}/heatmap/{{z}}/{{x}}/{{y}}.png?layer={layer}",
+                attr="AIS traffic", name=name, overlay=True, show=False, opacity=0.75
+            ).add_to(m)
     folium.LayerControl().add_to(m)
 
-    timestamp = datetime.now().strftime("%Y-%m-d %H:%M:%S")
     title_html = f'''
         <div id="status" class="sonar">Capturing data...</div>
         <h3 align="center" style="font-size:2vw; margin: 0;"><b>European Vessel Tracking Map</b></h3>
         <h4 align="center" style="font-size:1vw; margin: 0;"><b><i>Made by <a href="https://github.com/m3m0rydmp" target="_blank">m3m0rydmp</a></i></b></h4>
         <div class="marquee">
-            <b>{active_vessels}</b> active vessels shown | Total database: <b>{len(vessels_copy)}</b> vessels | Last updated: {timestamp}
+            <b id="activeCount">{active_vessels}</b> active vessels shown | Total database: <b id="totalCount">{total_vessels}</b> vessels | Last updated: <span id="lastUpdated">{timestamp}</span>
         </div>
     '''
     m.get_root().html.add_child(folium.Element(title_html))
@@ -356,45 +3396,41 @@ def create_map():
     </style>
     <script>
         const BASE_URL = 'http://localhost:{PORT}';
+        // Filter and search belong to this browser tab; other viewers keep their own
+        const VIEW_STORAGE_KEY = 'aisVesselView';
+        let vesselView = JSON.parse(sessionStorage.getItem(VIEW_STORAGE_KEY) || 'null');
+        function viewQuery() {{
+            if (!vesselView) return '';  // Follow the server-wide view until this tab sets its own
+            return `&filter=${{vesselView.filter}}&search=${{encodeURIComponent(vesselView.search)}}`;
+        }}
+        function setView(changes) {{
+            vesselView = Object.assign({{
+                filter: document.getElementById('filterSwitch').checked,
+                search: document.getElementById('searchInput').value
+            }}, vesselView, changes);
+            sessionStorage.setItem(VIEW_STORAGE_KEY, JSON.stringify(vesselView));
+            reloadVessels();
+        }}
+        document.addEventListener('DOMContentLoaded', () => {{
+            if (!vesselView) return;
+            document.getElementById('filterSwitch').checked = vesselView.filter;
+            document.getElementById('searchInput').value = vesselView.search;
+        }});
+        function reloadVessels() {{
+            {"refreshVessels(true);" if dynamic else "refreshMapView();"}
+        }}
         function toggleFilter(isEnabled) {{
             console.log("Toggling filter to: " + isEnabled);
-            fetch(`${{BASE_URL}}/toggle_filter?enabled=${{isEnabled}}`)
-                .then(response => {{
-                    if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
-                    console.log('Filter toggle successful');
-                    location.reload();
-                }})
-                .catch(error => {{
-                    console.error('Error toggling filter:', error);
-                    alert('Failed to toggle filter: ' + error.message + '. Ensure server is running on port {PORT}.');
-                }});
+            setView({{filter: isEnabled}});
         }}
         function searchVessels(term) {{
             console.log("Searching for: " + term);
-            fetch(`${{BASE_URL}}/search?term=${{encodeURIComponent(term)}}`)
-                .then(response => {{
-                    if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
-                    console.log('Search successful');
-                    location.reload();
-                }})
-                .catch(error => {{
-                    console.error('Error applying search:', error);
-                    alert('Failed to search: ' + error.message + '. Ensure server is running on port {PORT}.');
-                }});
+            setView({{search: term}});
         }}
         function clearSearch() {{
             console.log("Clearing search");
             document.getElementById('searchInput').value = '';
-            fetch(`${{BASE_URL}}/search?term=`)
-                .then(response => {{
-                    if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
-                    console.log('Clear search successful');
-                    location.reload();
-                }})
-                .catch(error => {{
-                    console.error('Error clearing search:', error);
-                    alert('Failed to clear search: ' + error.message + '. Ensure server is running on port {PORT}.');
-                }});
+            setView({{search: ''}});
         }}
         function addToWatchlist(mmsi) {{
             console.log("Adding to watchlist: " + mmsi);
@@ -403,7 +3439,7 @@ def create_map():
                     if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
                     console.log('Added to watchlist');
                     alert('Vessel with MMSI ' + mmsi + ' added to watch list');
-                    location.reload();
+                    reloadVessels();
                 }})
                 .catch(error => console.error('Error adding to watchlist:', error));
         }}
@@ -453,17 +3489,40 @@ def create_map():
                     if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
                     console.log('Removed from watchlist');
                     loadWatchlist();
-                    location.reload();
+                    reloadVessels();
                 }})
                 .catch(error => console.error('Error removing from watchlist:', error));
         }}
+        let suggestTimer = null;
+        function suggestVessels(term) {{
+            clearTimeout(suggestTimer);
+            if (!term) return;
+            suggestTimer = setTimeout(() => {{
+                fetch(`${{BASE_URL}}/autocomplete?term=${{encodeURIComponent(term)}}&limit=8${{viewQuery()}}`)
+                    .then(response => {{
+                        if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
+                        return response.json();
+                    }})
+                    .then(data => {{
+                        const list = document.getElementById('vesselSuggestions');
+                        list.innerHTML = '';
+                        data.forEach(vessel => {{
+                            const option = document.createElement('option');
+                            option.value = vessel.name || vessel.mmsi;
+                            option.label = `${{vessel.name || 'Unknown'}} (${{vessel.mmsi}})${{vessel.callsign ? ' ' + vessel.callsign : ''}}`;
+                            list.appendChild(option);
+                        }});
+                    }})
+                    .catch(error => console.error('Error fetching suggestions:', error));
+            }}, 150);
+        }}
         function findVessel(term) {{
             if (!term) {{
                 alert('Please enter a vessel name or MMSI to find');
                 return;
             }}
             console.log("Finding vessel: " + term);
-            fetch(`${{BASE_URL}}/find_vessel?term=${{encodeURIComponent(term)}}`)
+            fetch(`${{BASE_URL}}/find_vessel?term=${{encodeURIComponent(term)}}${{viewQuery()}}`)
                 .then(response => {{
                     if (!response.ok) throw new Error('Network error: ' + response.status + ' ' + response.statusText);
                     return response.json();
@@ -479,7 +3538,8 @@ def create_map():
                         const highlightMarker = L.circleMarker([lat, lon], {{
                             radius: 20, color: '#ff0000', fillColor: '#ff7700', fillOpacity: 0.3, weight: 2
                         }}).addTo(eval(map));
-                        alert(`Found vessel: ${{name}} (MMSI: ${{data.mmsi}})`);
+                        const others = data.results.length > 1 ? ` and ${{data.results.length - 1}} other matches` : '';
+                        alert(`Found vessel: ${{name}} (MMSI: ${{data.mmsi}})${{others}}`);
                         setTimeout(() => eval(`${{map}}.removeLayer(highlightMarker)`), 5000);
                     }} else {{
                         alert('Vessel not found in current view.');
@@ -494,39 +3554,87 @@ def create_map():
     '''
     m.get_root().html.add_child(folium.Element(custom_css_js))
 
-    m.save(MAP_FILE)
-    print(f"Map updated with {active_vessels} active vessels out of {len(vessels_copy)} total at {timestamp}")
-    if filter_enabled:
-        print(f"Filter active: Showing {filtered_vessels} watched vessels")
-    if search_term:
-        print(f"Search active: '{search_term}'")
-    else:
-        print("No search term active")
+    if alert_engine is not None:
+        alert_feed = """
+    <div id="alertFeed" style="position: fixed; bottom: 50px; right: 10px; z-index: 1000; background-color: white; display: none;
+                               padding: 10px; border: 2px solid #e67e22; border-radius: 5px; max-width: 300px; font-size: 12px;">
+        <b>Alerts</b>
+        <div id="alertItems"></div>
+    </div>
+    <script>
+        function showAlert(alert) {
+            const item = document.createElement('div');
+            item.style.cursor = alert.lat !== undefined ? 'pointer' : 'default';
+            item.textContent = new Date(alert.time * 1000).toLocaleTimeString() + ' ' + alert.message;
+            if (alert.lat !== undefined) {
+                item.onclick = () => eval(document.querySelector('div.folium-map').id).flyTo([alert.lat, alert.lon], 12);
+            }
+            const items = document.getElementById('alertItems');
+            items.prepend(item);
+            while (items.children.length > 5) items.lastChild.remove();
+            document.getElementById('alertFeed').style.display = 'block';
+        }
+        fetch(`${BASE_URL}/alerts?limit=5`)
+            .then(response => response.json())
+            .then(data => data.alerts.reverse().forEach(showAlert))
+            .catch(error => console.error('Error fetching alerts:', error));
+        new EventSource(`${BASE_URL}/alerts/stream`).onmessage = event => showAlert(JSON.parse(event.data));
+    </script>
+    """
+        m.get_root().html.add_child(folium.Element(alert_feed))
 
 def map_updater():
     """Update the map at regular intervals"""
     first_update = True
     while running:
         try:
-            create_map()
+            if not DYNAMIC_MAP:
+                create_map()
+            elif first_update:
+                create_map_shell()
             save_vessel_data()
+            if vessel_journal is not None:
+                persist_vessel_state()
             if first_update and os.path.exists(MAP_FILE):
                 webbrowser.open("file://" + os.path.realpath(MAP_FILE))
                 first_update = False
         except Exception as e:
-            print(f"Error updating map: {e}")
+            log.error("Error updating map: %s", e)
 
         with vessels_lock:
-            current_time = time.time()
-            vessels_to_remove = [mmsi for mmsi, v in vessels.items() 
-                               if current_time - v.get("last_update", 0) > 7200]
-            for mmsi in vessels_to_remove:
-                vessels.pop(mmsi, None)
-            if vessels_to_remove:
-                print(f"Removed {len(vessels_to_remove)} inactive vessels from memory")
+            hidden, evicted = vessel_expiry.expire(time.time())
+        if evicted:
+            log.info("Removed %d inactive vessels from memory", len(evicted))
+        log.debug("%d vessels left the map", len(hidden))
+
+        queue_stats = frame_queue.stats()
+        log.info("Ingest queue: %d/%d frames, %d processed, %d dropped",
+                 queue_stats['depth'], queue_stats['max_size'], queue_stats['processed'], queue_stats['dropped'])
 
         time.sleep(MAP_UPDATE_INTERVAL)
 
+def hide_vessel(mmsi):
+    """Expiry callback: clusters and the density heatmap only count vessels still shown on the map; they rejoin on their next report"""
+    cluster_index.remove(mmsi)
+    if heatmap is not None:
+        heatmap.remove(mmsi)
+
+def evict_vessel(mmsi):
+    """Expiry callback: drop an inactive vessel from the table, the indexes and the trail cache"""
+    vessels.remove(mmsi)
+    spatial_index.remove(mmsi)
+    cluster_index.remove(mmsi)
+    search_index.remove(mmsi)
+    trail_cache.discard(mmsi)
+    if heatmap is not None:
+        heatmap.forget(mmsi)
+    if alert_engine is not None:
+        alert_engine.forget(mmsi)
+    metrics.inc("ais_vessels_evicted_total")
+
+vessel_expiry.on_hide(hide_vessel)
+vessel_expiry.on_evict(evict_vessel)
+
 def signal_handler(sig, frame):
     global running
     print("Termination requested. This will stop the program from capturing data. Confirm? (Y/N)")
@@ -544,130 +3652,648 @@ PLEASE DON'T PRESS ANY BUTTON, IT WILL STILL UPDATE BUT IT WILL CLOSE AFTER
         print("Shutting down...")
         running = False
         try:
-            with open(MAP_FILE, 'r') as file:
-                filedata = file.read()
-            filedata = filedata.replace('Capturing data...', 'Tracker offline')
-            filedata = filedata.replace('class="sonar"', 'class="offline"')
-            with open(MAP_FILE, 'w') as file:
-                file.write(filedata)
+            publish_offline_map()
         except Exception as e:
-            print(f"Error updating map file: {e}")
+            log.error("Error updating map file: %s", e)
+        if vessel_journal is not None:
+            try:
+                persist_vessel_state()
+            except Exception as e:
+                log.error("Error saving vessel state: %s", e)
         time.sleep(5)
         sys.exit(0)
     else:
         print("Cancelled.")
 
+def persist_vessel_state():
+    """Log vessel changes since the last save, or write a fresh checkpoint when one is due"""
+    with vessel_journal.lock:
+        with vessels_lock:
+            snapshot = vessels.snapshot()
+            changed = vessels.changed_since(vessel_journal.generation) if vessel_journal.generation else None
+            if changed is not None:
+                changed_rows = {mmsi: vessels.rows.get(mmsi) for mmsi in changed}
+        if changed is None or vessel_journal.log is None or vessel_journal.log_size() > vessel_journal.max_log_bytes:
+            count = vessel_journal.checkpoint(snapshot)
+            log.debug("Checkpointed %d vessels to %s", count, vessel_journal.checkpoint_path)
+        elif changed_rows:
+            vessel_journal.append(snapshot,
+                                  [row for row in changed_rows.values() if row is not None],
+                                  [mmsi for mmsi, row in changed_rows.items() if row is None])
+
+def restore_vessel_state():
+    """Reload the last persisted vessel table and rebuild the indexes from it"""
+    started = time.perf_counter()
+    try:
+        state = vessel_journal.load()
+    except Exception as e:
+        log.error("Error loading vessel state: %s", e)
+        return 0
+    if state is None:
+        return 0
+    fixed, strings = state
+    with vessels_lock:
+        vessels.restore(fixed, strings)
+        vessel_expiry.reset(fixed["mmsi"].tolist(), fixed["last_update"].tolist())
+        for mmsi, lat, lon in zip(fixed["mmsi"].tolist(), fixed["lat"].tolist(), fixed["lon"].tolist()):
+            if lat == lat and lon == lon:
+                spatial_index.update(mmsi, lat, lon)
+        snapshot = vessels.snapshot()
+    log.info("Restored %d vessels from %s in %.0f ms", len(fixed), vessel_journal.checkpoint_path,
+             (time.perf_counter() - started) * 1000)
+    # Clusters and search are slower to build and are filled in behind the live stream
+    index_thread = threading.Thread(target=index_restored_vessels, args=(fixed["mmsi"].tolist(),))
+    index_thread.daemon = True
+    index_thread.start()
+    with vessel_journal.lock:
+        vessel_journal.checkpoint(snapshot)  # Folds the old log in and drops any torn tail
+    return len(fixed)
+
+def index_restored_vessels(mmsis, chunk_size=2000):
+    """Add restored vessels to the cluster, heatmap and search indexes in chunks, from their current values"""
+    started = time.perf_counter()
+    for start in range(0, len(mmsis), chunk_size):
+        with vessels_lock:
+            current_time = time.time()
+            for mmsi in mmsis[start:start + chunk_size]:
+                row = vessels.rows.get(mmsi)
+                if row is None:
+                    continue  # Evicted since the restore
+                if vessel_expiry.is_visible(mmsi, current_time):
+                    cluster_index.update(mmsi, vessels.lat[row], vessels.lon[row], int(vessels.ship_type[row]))
+                    if heatmap is not None:
+                        heatmap.update(mmsi, vessels.lat[row], vessels.lon[row], int(vessels.ship_type[row]))
+                search_index.update(mmsi, vessels.name[row], vessels.callsign[row])
+    log.info("Indexed %d restored vessels in %.1fs", len(mmsis), time.perf_counter() - started)
+
 def save_vessel_data():
     """Save current vessel data to a JSON file"""
     vessels_data = {}
-    with vessels_lock:
-        for mmsi, vessel in vessels.items():
-            if "lat" in vessel and "lon" in vessel:
-                vessels_data[mmsi] = {
-                    "mmsi": mmsi,
-                    "name": vessel.get("name", "Unknown"),
-                    "lat": vessel.get("lat"),
-                    "lon": vessel.get("lon"),
-                    "ship_type": vessel.get("ship_type"),
-                    "last_update": vessel.get("last_update")
-                }
+    snapshot = take_snapshot()
+    for vessel in snapshot.records(snapshot.positioned_rows()):
+        vessels_data[vessel["mmsi"]] = {
+            "mmsi": vessel["mmsi"],
+            "name": vessel["name"] or "Unknown",
+            "lat": vessel["lat"],
+            "lon": vessel["lon"],
+            "ship_type": vessel["ship_type"],
+            "last_update": vessel["last_update"]
+        }
     try:
-        with open("vessel_data.json", "w") as f:
+        with open("vessel_data.json.tmp", "w") as f:
             json.dump(vessels_data, f)
+        os.replace("vessel_data.json.tmp", "vessel_data.json")  # Readers never see a half-written file
     except Exception as e:
-        print(f"Error saving vessel data: {e}")
+        log.error("Error saving vessel data: %s", e)
+
+def parse_bbox(value):
+    """Parse a "min_lon,min_lat,max_lon,max_lat" bounding box (GeoJSON order)"""
+    bbox = [float(part) for part in value.split(",")]
+    if len(bbox) != 4:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    if not all(math.isfinite(part) for part in bbox) or any(abs(lon) > 180 for lon in bbox[::2]) or any(abs(lat) > 90 for lat in bbox[1::2]):
+        raise ValueError("bbox longitudes must be within -180..180 and latitudes within -90..90")
+    return bbox
+
+def parse_ship_types(value):
+    """Parse ship type codes like "70,80-89" into inclusive (low, high) ranges"""
+    ranges = []
+    for part in value.split(","):
+        low, _, high = part.strip().partition("-")
+        ranges.append((int(low), int(high or low)))
+    return ranges
+
+def snapshot_viewport(bbox):
+    """Snapshot plus the rows of vessels inside a (min_lon, min_lat, max_lon, max_lat) box"""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    with vessels_lock:
+        snapshot = vessels.snapshot(SNAPSHOT_MAX_AGE)
+        mmsis = spatial_index.query_bbox(min_lat, min_lon, max_lat, max_lon)
+        rows = np.array([vessels.rows[mmsi] for mmsi in mmsis], dtype=np.intp)
+    return snapshot, snapshot_rows(snapshot, rows, mmsis)
+
+def snapshot_rows(snapshot, rows, mmsis):
+    """Sorted live-table rows of mmsis that belong to the same vessels in an older snapshot"""
+    # Vessels that arrived or moved rows after the snapshot are picked up by the next one
+    rows = rows[rows < snapshot.row_count]
+    return np.sort(rows[np.isin(snapshot.mmsi[rows], mmsis)])
+
+def select_vessels(snapshot, rows=None, ship_types=None, max_age=DISPLAY_TTL, now=None):
+    """Filter snapshot rows (all positioned vessels by default) by ship type ranges and maximum age"""
+    if rows is None:
+        rows = snapshot.positioned_rows()
+    if max_age is not None:
+        rows = rows[(now or time.time()) - snapshot.last_update[rows] <= max_age]
+    if ship_types:
+        codes = snapshot.ship_type[rows]
+        mask = np.zeros(len(rows), dtype=bool)
+        for low, high in ship_types:
+            mask |= (codes >= low) & (codes <= high)
+        rows = rows[mask]
+    return rows
+
+def nearest_vessels(lat, lon, k=10, max_distance=None):
+    """GeoJSON features of the k vessels nearest to a point, with their distance in km"""
+    with vessels_lock:
+        snapshot = vessels.snapshot(SNAPSHOT_MAX_AGE)
+        found = [(distance, mmsi, vessels.rows[mmsi]) for distance, mmsi in spatial_index.nearest(lat, lon, k, max_distance)]
+    # Skip vessels that arrived or moved rows after the snapshot
+    found = [(distance, row) for distance, mmsi, row in found if row < snapshot.row_count and snapshot.mmsi[row] == mmsi]
+    features = []
+    for (distance, row), vessel in zip(found, snapshot.records([row for distance, row in found])):
+        feature = vessel_feature(vessel)
+        feature["properties"]["distance_km"] = round(distance, 3)
+        features.append(feature)
+    return features
+
+def vessel_feature(vessel):
+    """Convert a vessel record into a GeoJSON Feature"""
+    properties = {key: value for key, value in vessel.items() if key not in ("lat", "lon")}
+    properties["ship_type_name"] = get_ship_type_name(vessel["ship_type"])
+    return {
+        "type": "Feature",
+        "id": vessel["mmsi"],
+        "geometry": None if vessel["lat"] is None else {"type": "Point", "coordinates": [vessel["lon"], vessel["lat"]]},
+        "properties": properties
+    }
+
+def get_stats():
+    """Summary of tracker state for the /stats endpoint"""
+    snapshot = take_snapshot()
+    current_time = time.time()
+    return {
+        "generation": snapshot.generation,
+        "vessels": len(snapshot),
+        "positioned": len(snapshot.positioned_rows()),
+        "visible": len(snapshot.visible_rows(current_time, DISPLAY_TTL)),
+        "ingest_queue": frame_queue.stats(),
+        "frame_decoder": frame_decoder_name,
+        "ingest_processes": INGEST_PROCESSES,
+        "subscriptions": subscription_stats,
+        "track_store": track_store.stats() if track_store is not None else None,
+        "alert_rules": len(alert_engine.rules) if alert_engine is not None else None,
+        "view_cache": view_cache.stats(),
+        "encounters": encounter_detector.stats(),
+        "filter_enabled": filter_enabled,
+        "search_term": search_term,
+        "uptime": round(current_time - start_time, 1)
+    }
+
+def dead_reckoning_velocity(snapshot, rows):
+    """Northward and eastward speed of rows in degrees per second; 0 without a usable course and speed"""
+    speed, lat = snapshot.speed[rows], snapshot.lat[rows]
+    course, heading = snapshot.course[rows], snapshot.heading[rows]
+    # 360 (course) and 511 (heading) mean "not available"; fall back from course over ground to heading
+    direction = np.where((course >= 0) & (course < 360), course, np.where((heading >= 0) & (heading < 360), heading, np.nan))
+    usable = (speed >= DEAD_RECKONING_MIN_SPEED) & (speed < 102.3) & ~np.isnan(direction)
+    degrees_per_second = np.where(usable, speed, 0.0) / 216000  # One knot is a minute of latitude per hour
+    radians = np.radians(np.where(usable, direction, 0.0))
+    north = degrees_per_second * np.cos(radians)
+    east = degrees_per_second * np.sin(radians) / np.maximum(np.cos(np.radians(np.nan_to_num(lat))), 0.01)
+    return north, east
+
+def dead_reckon(snapshot, rows, now, max_age=DEAD_RECKONING_MAX_AGE):
+    """(lat, lon, north, east, projected) of rows at time now, projected from their last report within max_age"""
+    lat, lon = snapshot.lat[rows], snapshot.lon[rows]
+    north, east = dead_reckoning_velocity(snapshot, rows)
+    real = (np.abs(lat) <= 90) & (np.abs(lon) <= 180)  # Neither NaN nor the "not available" 91/181
+    north, east = np.where(real, north, 0.0), np.where(real, east, 0.0)
+    age = now - snapshot.last_update[rows]
+    projected = (age > 0) & (age <= max_age) & ((north != 0) | (east != 0))
+    elapsed = np.where(projected, age, 0.0)
+    # Only projected rows are wrapped and clipped, so other positions come back exactly as reported
+    lat = np.where(projected, np.clip(lat + north * elapsed, -90.0, 90.0), lat)
+    lon = np.where(projected, (lon + east * elapsed + 180.0) % 360.0 - 180.0, lon)
+    return lat, lon, north, east, projected
+
+def project_records(snapshot, rows, records, now):
+    """Move vessel records to their dead-reckoned positions, keeping the reported one alongside"""
+    lat, lon, north, east, projected = dead_reckon(snapshot, rows, now)
+    for record, lat, lon, projected in zip(records, lat.tolist(), lon.tolist(), projected.tolist()):
+        record["projected"] = projected
+        if projected:
+            record["reported_lat"], record["reported_lon"] = record["lat"], record["lon"]
+            record["lat"], record["lon"] = round(lat, 6), round(lon, 6)
+    return records
+
+def compact_vessels(snapshot, rows, now=None):
+    """[mmsi, lat, lon, ship_type, name, last_update, north, east] rows for the map page, dead-reckoned to now"""
+    if DEAD_RECKONING:
+        lat, lon, north, east, projected = dead_reckon(snapshot, rows, now or time.time())
+    else:
+        lat, lon = snapshot.lat[rows], snapshot.lon[rows]
+        north = east = np.zeros(len(rows))
+    return [
+        [mmsi, round(lat, 5), round(lon, 5), ship_type, name, last_update, round(north, 9), round(east, 9)]
+        for mmsi, lat, lon, ship_type, name, last_update, north, east in zip(
+            snapshot.mmsi[rows].tolist(), lat.tolist(), lon.tolist(), snapshot.ship_type[rows].tolist(),
+            snapshot.name[rows].tolist(), snapshot.last_update[rows].tolist(), north.tolist(), east.tolist())
+    ]
+
+def vessel_delta(since, bbox=None, view=None):
+    """JSON of the vessels of a view (optionally only inside bbox) that changed after a snapshot generation"""
+    view = view or default_view()
+    with vessels_lock:
+        snapshot = vessels.snapshot(SNAPSHOT_MAX_AGE)
+    current_time = time.time()
+
+    def compute():
+        with vessels_lock:
+            changed = vessels.changed_since(since, snapshot.generation) if since else None
+            viewport = None
+            if bbox is not None:
+                min_lon, min_lat, max_lon, max_lat = bbox
+                mmsis = spatial_index.query_bbox(min_lat, min_lon, max_lat, max_lon)
+                viewport = np.array([vessels.rows[mmsi] for mmsi in mmsis], dtype=np.intp)
+        if viewport is not None:
+            viewport = snapshot_rows(snapshot, viewport, mmsis)
+        rows = select_vessels(snapshot, viewport, now=current_time)
+        if changed is not None:
+            rows = rows[np.isin(snapshot.mmsi[rows], np.fromiter(changed, dtype=np.int64, count=len(changed)))]
+        rows = filter_view_rows(snapshot, rows, view)
+        removed = [] if changed is None else list(changed.difference(snapshot.mmsi[rows].tolist()))
+        return json.dumps({
+            "generation": snapshot.generation,
+            "full": changed is None,
+            "now": current_time,
+            "max_age": DISPLAY_TTL,
+            "total": len(snapshot),
+            "dead_reckoning_max_age": DEAD_RECKONING_MAX_AGE if DEAD_RECKONING else 0,
+            "vessels": compact_vessels(snapshot, rows, current_time),
+            "removed": removed
+        }, separators=(",", ":"))
+    key = ("delta", snapshot.generation, since, bbox and tuple(bbox), view[0]) + view_key(view, current_time)
+    return view_cache.get(key, compute)
+
+def vessel_track(mmsi, since, until=None, zoom=None):
+    """Recorded positions of one vessel as a GeoJSON LineString with per-point times, simplified for a zoom level"""
+    if zoom is None:
+        points = track_store.query(mmsi, since, until)
+    elif until is None:
+        points = trail_cache.trail(mmsi, zoom, since, track_store.query)  # Live trail, kept up to date on ingest
+    else:
+        points = simplify_trail(track_store.query(mmsi, since, until), trail_tolerance(zoom))
+    return {
+        "type": "Feature",
+        "id": str(mmsi),
+        "geometry": {"type": "LineString", "coordinates": [[lon, lat] for ts, lat, lon, course, speed in points]},
+        "properties": {
+            "mmsi": str(mmsi),
+            "times": [ts for ts, lat, lon, course, speed in points],
+            "course": [course for ts, lat, lon, course, speed in points],
+            "speed": [speed for ts, lat, lon, course, speed in points]
+        }
+    }
+
+def cluster_tile(z, x, y):
+    """Vessel clusters in tile z/x/y, or the individual vessels once zoomed in past CLUSTER_MAX_ZOOM"""
+    if z <= CLUSTER_MAX_ZOOM:
+        with vessels_lock:
+            clusters = cluster_index.tile(z, x, y)
+        return {"z": z, "x": x, "y": y, "clusters": clusters}
+    snapshot, rows = snapshot_viewport(tile_bounds(z, x, y))
+    return {"z": z, "x": x, "y": y, "vessels": compact_vessels(snapshot, select_vessels(snapshot, rows))}
+
+def heatmap_categories(ranges):
+    """Heatmap category indexes covering ship type code ranges such as parse_ship_types returns"""
+    return sorted({HeatmapGrid.category(code) for low, high in ranges for code in range(max(low, 0), min(high, 99) + 1)})
+
+def encode_png(rgba):
+    """Encode a (height, width, 4) uint8 array as an RGBA PNG"""
+    height, width = rgba.shape[:2]
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)  # Each scanline starts with filter type 0
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b""))
+
+def heatmap_tile(z, x, y, layer="traffic", categories=None, image=False):
+    """A heatmap tile as PNG bytes, or as a dict of its non-empty bins with their ship type breakdown"""
+    current_time = time.time()
+    with vessels_lock:
+        values = heatmap.tile(z, x, y, layer, current_time)
+        peak = heatmap.peak(z, layer, current_time)
+    totals = (values if categories is None else values[:, :, categories]).sum(axis=2)
+    if image:
+        # Log scale over two decades below the busiest cell of the zoom level, the same for every tile
+        level = np.log1p(totals / max(peak, 1e-12) * 100) / math.log1p(100)
+        rgba = np.stack([np.interp(level, HEATMAP_STOPS, HEATMAP_COLORS[:, k]) for k in range(4)], axis=-1)
+        rgba[totals <= 0] = 0
+        pixels = 256 // heatmap.grid
+        return encode_png(np.repeat(np.repeat(rgba.astype(np.uint8), pixels, axis=0), pixels, axis=1))
+    names = HeatmapGrid.category_names()
+    rows, columns = np.nonzero(totals > 0)
+    return {
+        "z": z, "x": x, "y": y, "layer": layer, "grid": heatmap.grid, "max": peak,
+        "unit": "vessels" if layer == "density" else "vessel-hours",
+        "bins": [
+            [column, row, round(float(totals[row, column]), 4),
+             {names[k]: round(float(values[row, column, k]), 4) for k in np.flatnonzero(values[row, column]).tolist()
+              if categories is None or k in categories}]
+            for row, column in zip(rows.tolist(), columns.tolist())
+        ]
+    }
+
+def search_vessels(term, limit=SEARCH_RESULT_LIMIT, positioned_only=False, view_filter=None):
+    """Ranked vessel records matching term by name, callsign or MMSI, within the watch list when filtering"""
+    view_filter = filter_enabled if view_filter is None else view_filter
+    scope = watchlist.current()[2] if view_filter else None
+    with vessels_lock:
+        snapshot = vessels.snapshot(SNAPSHOT_MAX_AGE)
+        # Rank every match when unpositioned vessels will be skipped
+        matches = np.array(search_index.search(term, None if positioned_only else limit, scope), dtype=np.int64)
+        rows = np.array([vessels.rows[mmsi] for mmsi in matches.tolist()], dtype=np.intp)
+    # Skip vessels that arrived or moved rows after the snapshot, keeping the ranking
+    current = rows < snapshot.row_count
+    rows, matches = rows[current], matches[current]
+    rows = rows[snapshot.mmsi[rows] == matches]
+    if positioned_only:
+        rows = rows[~np.isnan(snapshot.lat[rows])]
+    return snapshot.records(rows[:limit])
+
+def find_vessel(term, view_filter=None):
+    """Find the best positioned vessel match for term, along with the other ranked matches"""
+    results = search_vessels(term, positioned_only=True, view_filter=view_filter)
+    log.debug("Found %d vessels matching '%s'", len(results), term)
+    if not results:
+        return {"found": False, "results": []}
+    matches = [{"mmsi": v["mmsi"], "name": v["name"], "callsign": v["callsign"], "lat": v["lat"], "lon": v["lon"]}
+               for v in results]
+    return dict(matches[0], found=True, results=matches)
+
+def render_metrics():
+    """Refresh the gauges and return every metric in the Prometheus text format"""
+    snapshot = take_snapshot()
+    current_time = time.time()
+    metrics.set("ais_vessels", len(snapshot), state="tracked")
+    metrics.set("ais_vessels", len(snapshot.positioned_rows()), state="positioned")
+    metrics.set("ais_vessels", len(snapshot.visible_rows(current_time, DISPLAY_TTL)), state="visible")
+    queue_stats = frame_queue.stats()
+    metrics.set("ais_ingest_queue_depth", queue_stats["depth"])
+    metrics.set("ais_uptime_seconds", round(current_time - start_time, 1))
+    return metrics.render()
 
 class FilterControlHandler(BaseHTTPRequestHandler):
-    def _set_headers(self, content_type='text/html'):
-        self.send_response(200)
+    protocol_version = "HTTP/1.1"  # Keep connections alive for polling dashboards
+    timeout = 30  # Drop idle keep-alive connections
+    disable_nagle_algorithm = True  # Headers and body are separate writes; don't stall them on delayed ACKs
+
+    def _send(self, body, content_type='text/html', status=200):
+        if isinstance(body, str):
+            body = body.encode()
+        metrics.inc("ais_http_requests_total", route=self.route if status != 404 else "other", status=status)
+        self.send_response(status)
         self.send_header('Content-type', content_type)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET')
+        self.send_header('Vary', 'Accept-Encoding')
+        if (len(body) >= GZIP_MIN_SIZE and 'gzip' in self.headers.get('Accept-Encoding', '')
+                and not content_type.startswith('image/')):  # PNG is compressed already
+            body = gzip.compress(body, compresslevel=5)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data, status=200):
+        self._send(json.dumps(data, separators=(",", ":")), 'application/json', status)
+
+    def _stream_alerts(self):
+        """Server-sent events: one data line per alert, until the page goes away"""
+        metrics.inc("ais_http_requests_total", route=self.route, status=200)
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.close_connection = True
+        client = alert_broadcaster.subscribe()
+        try:
+            while running:
+                try:
+                    alert = client.get(timeout=15)
+                    self.wfile.write(f"data: {json.dumps(alert)}\n\n".encode())
+                except queue.Empty:
+                    self.wfile.write(b": keep-alive\n\n")
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            pass
+        finally:
+            alert_broadcaster.unsubscribe(client)
 
     def do_GET(self):
         global filter_enabled, search_term
         parsed_url = urlparse(self.path)
         path = parsed_url.path
         query = parse_qs(parsed_url.query)
-        print(f"Received request: {self.path}")
+        log.debug("Received request: %s", self.path)
+        self.route = re.sub(r"/\d+", "/*", path)  # /vessels/<mmsi> and tile addresses share one series
 
         if path == '/toggle_filter':
             if 'enabled' in query:
                 filter_enabled = query['enabled'][0].lower() == 'true'
-                print(f"Filter set to: {filter_enabled}")
-            self._set_headers()
-            self.wfile.write(b"OK")
+                log.info("Filter set to: %s", filter_enabled)
+            self._send(b"OK")
         elif path == '/search':
             search_term = query.get('term', [''])[0] if 'term' in query else ""
-            print(f"Search term set to: '{search_term}'")
-            self._set_headers()
-            self.wfile.write(b"OK")
+            log.info("Search term set to: '%s'", search_term)
+            self._send(b"OK")
         elif path == '/add_to_watchlist':
             if 'mmsi' in query:
                 save_mmsi_to_filter(query['mmsi'][0])
-            self._set_headers()
-            self.wfile.write(b"OK")
+            self._send(b"OK")
         elif path == '/get_watchlist':
-            filtered_mmsi = list(load_filtered_mmsi())
-            self._set_headers('application/json')
-            self.wfile.write(json.dumps(filtered_mmsi).encode())
+            try:
+                self._send_json(watchlist.mmsis())
+            except Exception as e:
+                log.error("Error loading filter file: %s", e)
+                self._send_json([])
         elif path == '/remove_from_watchlist':
             if 'mmsi' in query:
-                mmsi = query['mmsi'][0]
-                filtered_mmsi = load_filtered_mmsi()
-                if mmsi in filtered_mmsi:
-                    filtered_mmsi.remove(mmsi)
-                    try:
-                        with open(MMSI_FILTER_FILE, 'w') as f:
-                            for m in filtered_mmsi:
-                                f.write(f"{m}\n")
-                        print(f"Removed MMSI {mmsi} from watch list")
-                    except Exception as e:
-                        print(f"Error updating filter file: {e}")
-            self._set_headers()
-            self.wfile.write(b"OK")
+                remove_mmsi_from_filter(query['mmsi'][0])
+            self._send(b"OK")
         elif path == '/find_vessel':
+            result = {"found": False}
             if 'term' in query:
-                search_term = query['term'][0].lower()
-                result = {"found": False}
                 try:
-                    if os.path.exists("vessel_data.json"):
-                        with open("vessel_data.json", "r") as f:
-                            vessel_data = json.load(f)
-                        search_scope = load_filtered_mmsi() if filter_enabled else set(vessel_data.keys())
-                        print(f"Searching for '{search_term}' in scope: {len(search_scope)} vessels")
-                        for mmsi in search_scope:
-                            if mmsi not in vessel_data:
-                                continue
-                            vessel = vessel_data[mmsi]
-                            vessel_name = vessel.get("name", "").lower()
-                            if search_term in vessel_name or search_term in mmsi.lower():
-                                result = {
-                                    "found": True,
-                                    "mmsi": mmsi,
-                                    "name": vessel.get("name"),
-                                    "lat": vessel.get("lat"),
-                                    "lon": vessel.get("lon")
-                                }
-                                print(f"Found vessel: {result}")
-                                break
-                    else:
-                        print("vessel_data.json not found")
+                    result = find_vessel(query['term'][0], parse_view(query)[0])
+                    if result["found"]:
+                        log.debug("Found vessel: %s", result)
                 except Exception as e:
-                    print(f"Error finding vessel: {e}")
-                self._set_headers('application/json')
-                self.wfile.write(json.dumps(result).encode())
+                    log.error("Error finding vessel: %s", e)
+            self._send_json(result)
+        elif path == '/autocomplete':
+            try:
+                limit = int(query.get('limit', [str(SEARCH_RESULT_LIMIT)])[0])
+            except ValueError:
+                self._send_json({"error": "limit must be a number"}, 400)
+                return
+            view_filter = parse_view(query)[0]
+            results = search_vessels(query.get('term', [''])[0], limit, view_filter=view_filter) if limit > 0 else []
+            self._send_json([{"mmsi": v["mmsi"], "name": v["name"], "callsign": v["callsign"]} for v in results])
+        elif path == '/vessels':
+            try:
+                bbox = parse_bbox(query['bbox'][0]) if 'bbox' in query else None
+                ship_types = parse_ship_types(query['ship_type'][0]) if 'ship_type' in query else None
+                max_age = float(query['max_age'][0]) if 'max_age' in query else DISPLAY_TTL
+            except ValueError as e:
+                self._send_json({"error": str(e)}, 400)
+                return
+            snapshot, rows = snapshot_viewport(bbox) if bbox else (take_snapshot(), None)
+            rows = select_vessels(snapshot, rows, ship_types, max_age)
+            records = snapshot.records(rows)
+            if DEAD_RECKONING and query.get('project', ['1'])[0] != '0':
+                records = project_records(snapshot, rows, records, time.time())
+            self._send_json({
+                "type": "FeatureCollection",
+                "generation": snapshot.generation,
+                "features": [vessel_feature(vessel) for vessel in records]
+            })
+        elif path == '/vessels/delta':
+            try:
+                since = int(query.get('since', ['0'])[0])
+                bbox = parse_bbox(query['bbox'][0]) if 'bbox' in query else None
+            except ValueError as e:
+                self._send_json({"error": str(e)}, 400)
+                return
+            self._send(vessel_delta(since, bbox, parse_view(query)), 'application/json')
+        elif path == '/map/payload':
+            self._send(map_view_payload(parse_view(query)), 'application/json')
+        elif path == '/vessels/nearest':
+            try:
+                lat = float(query['lat'][0])
+                lon = float(query['lon'][0])
+                k = int(query.get('k', ['10'])[0])
+                max_distance = float(query['max_distance'][0]) if 'max_distance' in query else None
+                if not (-90 <= lat <= 90 and -180 <= lon <= 180 and k >= 1) or not (max_distance is None or 0 < max_distance < math.inf):
+                    raise ValueError
+            except (KeyError, ValueError):
+                self._send_json({"error": "nearest needs lat (-90..90) and lon (-180..180), optional k (1 or more) "
+                                          "and max_distance (km)"}, 400)
+                return
+            self._send_json({"type": "FeatureCollection", "features": nearest_vessels(lat, lon, k, max_distance)})
+        elif path == '/track':
+            if track_store is None:
+                self._send_json({"error": "Track history is disabled (TRACK_DB_FILE is None)"}, 404)
+                return
+            try:
+                mmsi = int(query['mmsi'][0])
+                until = float(query['until'][0]) if 'until' in query else None
+                since = float(query['since'][0]) if 'since' in query else (until or time.time()) - 3600
+                zoom = int(query['zoom'][0]) if 'zoom' in query else None
+                if (zoom is not None and not 0 <= zoom <= 22) or not math.isfinite(since) or not math.isfinite(until or 0):
+                    raise ValueError
+            except (KeyError, ValueError):
+                self._send_json({"error": "track needs mmsi, optional since and until (Unix seconds) and zoom (0-22)"}, 400)
+                return
+            self._send_json(vessel_track(mmsi, since, until, zoom))
+        elif path.startswith('/clusters/'):
+            try:
+                z, x, y = (int(part) for part in path[len('/clusters/'):].split('/'))
+                if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+                    raise ValueError
+            except ValueError:
+                self._send_json({"error": "Expected /clusters/<z>/<x>/<y> with a valid tile address"}, 400)
+                return
+            self._send_json(cluster_tile(z, x, y))
+        elif path.startswith('/vessels/'):
+            mmsi = path[len('/vessels/'):]
+            snapshot = take_snapshot()
+            row = snapshot.rows.get(int(mmsi)) if mmsi.isdigit() else None
+            if row is None:
+                self._send_json({"error": f"Unknown MMSI {mmsi}"}, 404)
+                return
+            records = snapshot.records([row])
+            if DEAD_RECKONING and query.get('project', ['1'])[0] != '0':
+                records = project_records(snapshot, [row], records, time.time())
+            self._send_json(vessel_feature(records[0]))
+        elif path == '/stats':
+            self._send_json(get_stats())
+        elif path == '/alerts':
+            if alert_engine is None:
+                self._send(b"Alerts are disabled", 'text/plain', 404)
+                return
+            try:
+                limit = int(query.get('limit', ['50'])[0])
+            except ValueError:
+                self._send(b"limit must be an integer", 'text/plain', 400)
+                return
+            recent = list(alert_engine.recent)[::-1][:max(limit, 0)]
+            self._send_json({"rules": len(alert_engine.rules), "alerts": recent})
+        elif path == '/alerts/stream':
+            if alert_engine is None:
+                self._send(b"Alerts are disabled", 'text/plain', 404)
+                return
+            self._stream_alerts()
+        elif path == '/heatmap/summary':
+            if heatmap is None:
+                self._send(b"The heatmap is disabled", 'text/plain', 404)
+                return
+            try:
+                min_lon, min_lat, max_lon, max_lat = parse_bbox(query['bbox'][0]) if 'bbox' in query else (-180, -85, 180, 85)
+                layer = query.get('layer', ['traffic'])[0]
+                if layer not in HeatmapGrid.LAYERS:
+                    raise ValueError(f"layer must be one of {', '.join(HeatmapGrid.LAYERS)}")
+            except ValueError as e:
+                self._send_json({"error": str(e)}, 400)
+                return
+            with vessels_lock:
+                zoom, totals = heatmap.region(min_lat, min_lon, max_lat, max_lon, layer)
+            self._send_json({
+                "layer": layer,
+                "zoom": zoom,
+                "unit": "vessels" if layer == "density" else "vessel-hours",
+                "total": round(float(totals.sum()), 4),
+                "ship_types": {name: round(value, 4) for name, value in zip(HeatmapGrid.category_names(), totals.tolist()) if value}
+            })
+        elif path.startswith('/heatmap/'):
+            if heatmap is None:
+                self._send(b"The heatmap is disabled", 'text/plain', 404)
+                return
+            try:
+                match = re.fullmatch(r'/heatmap/(\d+)/(\d+)/(\d+)\.(png|json)', path)
+                z, x, y = (int(part) for part in match.groups()[:3]) if match else (0, -1, -1)
+                if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+                    raise ValueError("Expected /heatmap/<z>/<x>/<y>.png or .json with a valid tile address")
+                extension = match.group(4)
+                layer = query.get('layer', ['traffic'])[0]
+                if layer not in HeatmapGrid.LAYERS:
+                    raise ValueError(f"layer must be one of {', '.join(HeatmapGrid.LAYERS)}")
+                categories = heatmap_categories(parse_ship_types(query['ship_type'][0])) if 'ship_type' in query else None
+            except ValueError as e:
+                self._send_json({"error": str(e)}, 400)
+                return
+            image = extension == 'png'
+            # Tiles are served up to VIEW_CACHE_SECONDS old, however busy the stream is
+            key = ("heatmap", z, x, y, layer, None if categories is None else tuple(categories), image, int(time.time() // VIEW_CACHE_SECONDS))
+            tile = view_cache.get(key, lambda: heatmap_tile(z, x, y, layer, categories, image))
+            if image:
+                self._send(tile, 'image/png')
+            else:
+                self._send_json(tile)
+        elif path == '/encounters':
+            try:
+                cpa_nm = float(query.get('cpa', [ENCOUNTER_CPA_NM])[0])
+                tcpa_minutes = float(query.get('tcpa', [ENCOUNTER_TCPA_MINUTES])[0])
+                limit = int(query.get('limit', ['100'])[0])
+            except ValueError:
+                self._send_json({"error": "cpa, tcpa and limit must be numbers"}, 400)
+                return
+            if not (0 < cpa_nm <= ENCOUNTER_MAX_CPA_NM and 0 < tcpa_minutes <= ENCOUNTER_MAX_TCPA_MINUTES):
+                self._send_json({"error": f"cpa must be within (0, {ENCOUNTER_MAX_CPA_NM}] nm and tcpa within "
+                                          f"(0, {ENCOUNTER_MAX_TCPA_MINUTES}] minutes"}, 400)
+                return
+            result = encounter_detector.query(cpa_nm, tcpa_minutes)
+            response = {key: value for key, value in result.items() if key != "pairs"}
+            response["encounters"] = encounter_detector.encounters(result, max(limit, 0))
+            self._send_json(response)
+        elif path == '/metrics':
+            self._send(render_metrics(), 'text/plain; version=0.0.4')
         elif path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(b"This is the AIS Vessel Tracking server. Use vessel_map.html to interact with the map.")
+            self._send(b"This is the AIS Vessel Tracking server. Use vessel_map.html to interact with the map.", 'text/plain')
         else:
-            self.send_response(404)
-            self._set_headers()
-            self.wfile.write(b"Invalid request")
+            self._send(b"Invalid request", status=404)
 
     def log_message(self, format, *args):
         return  # Silence default logging, we use print instead
@@ -676,12 +4302,12 @@ def run_http_server(port=PORT):
     """Run HTTP server for filter control"""
     try:
         server_address = ('0.0.0.0', port)
-        httpd = HTTPServer(server_address, FilterControlHandler)
-        print(f"Starting control server on port {port}")
+        httpd = ThreadingHTTPServer(server_address, FilterControlHandler)
+        log.info("Starting control server on port %d", port)
         httpd.serve_forever()
     except OSError as e:
-        print(f"Error starting server on port {port}: {e}")
-        print(f"Filter controls will not work. Free up port {port} or change PORT variable.")
+        log.error("Error starting server on port %d: %s", port, e)
+        log.error("Filter controls will not work. Free up port %d or change PORT variable.", port)
 
 async def main():
     print(r"""
@@ -699,16 +4325,58 @@ async def main():
     print("Press Ctrl+C to terminate the program")
     time.sleep(2)
 
+    if vessel_journal is not None:
+        restore_vessel_state()  # Serve the last known fleet before the stream reconnects
+
     server_thread = threading.Thread(target=run_http_server, args=(PORT,))
     server_thread.daemon = True
     server_thread.start()
 
+    log.info("Decoding frames with %s", frame_decoder_name)
+    if INGEST_PROCESSES:
+        start_ingest_processes()
+    else:
+        ingest_thread = threading.Thread(target=ingest_worker)
+        ingest_thread.daemon = True
+        ingest_thread.start()
+
+    if track_store is not None:
+        track_thread = threading.Thread(target=track_writer)
+        track_thread.daemon = True
+        track_thread.start()
+
+    if alert_engine is not None:
+        start_alerting()
+
+    if ENCOUNTER_CHECK_INTERVAL:
+        encounter_thread = threading.Thread(target=encounter_worker)
+        encounter_thread.daemon = True
+        encounter_thread.start()
+
+    if MAP_RENDER_PROCESS and not DYNAMIC_MAP:
+        start_map_renderer()
+
     updater_thread = threading.Thread(target=map_updater)
     updater_thread.daemon = True
     updater_thread.start()
 
-    await connect_to_ais_stream()
+    if REPLAY_FILE:
+        await replay_ais_stream()
+        while running:  # Keep serving the map after the capture runs out
+            await asyncio.sleep(1)
+    else:
+        await stream_ais_subscriptions()
 
 if __name__ == "__main__":
+    setup_logging()
+    if len(sys.argv) > 2 and sys.argv[1] == "serve-replay":
+        # python AIS_vessel.py serve-replay <capture file> [speed]
+        speed = float(sys.argv[3]) if len(sys.argv) > 3 else None
+        asyncio.run(serve_replay(sys.argv[2], speed))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "box-cover":
+        # python AIS_vessel.py box-cover
+        print_box_cover()
+        sys.exit(0)
     signal.signal(signal.SIGINT, signal_handler)
     asyncio.run(main())
\ No newline at end of file
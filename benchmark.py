@@ -0,0 +1,324 @@
+"""Benchmarks for the AIS vessel tracker: python benchmark.py [--fleets 1000,10000,50000] [--json results.json]"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+import numpy as np
+import AIS_vessel
+
+def synthetic_frames(vessel_count, message_count, static_share=0.1, seed=1):
+    """AISStream-shaped PositionReport and ShipStaticData frames for a synthetic fleet"""
+    rnd = random.Random(seed)
+    mmsis = rnd.sample(range(200000000, 780000000), vessel_count)
+    names = ["NORDIC STAR", "RHEINPOESIE", "JACOBA MARIA", "MAERSK ESSEN", "BALTIC QUEEN", "SEA WOLF", "AMADEUS"]
+    frames = []
+    for i in range(message_count):
+        # Every vessel reports at least once, the rest of the traffic is random
+        mmsi = mmsis[i] if i < vessel_count else rnd.choice(mmsis)
+        lat = 35 + (mmsi % 2500) / 100 + rnd.random() * 0.01
+        lon = -10 + (mmsi % 4000) / 100 + rnd.random() * 0.01
+        metadata = {"MMSI": mmsi, "MMSI_String": mmsi, "ShipName": "", "latitude": lat, "longitude": lon,
+                    "time_utc": "2026-10-16 10:%02d:%02d.000000000 +0000 UTC" % (i // 60 % 60, i % 60)}
+        if rnd.random() < static_share:
+            frame = {"MessageType": "ShipStaticData", "Metadata": metadata, "Message": {"ShipStaticData": {
+                "AisVersion": 0, "CallSign": "PD%04d " % (mmsi % 10000), "Destination": "ROTTERDAM",
+                "Dimension": {"A": 80, "B": 20, "C": 6, "D": 6}, "Dte": False,
+                "Eta": {"Day": 17, "Hour": 6, "Minute": 0, "Month": 10}, "FixType": 1, "ImoNumber": 9000000 + i % 1000,
+                "MaximumStaticDraught": 3.2, "MessageID": 5, "Name": f"{rnd.choice(names)} {mmsi % 97}   ",
+                "RepeatIndicator": 0, "ShipType": rnd.choice([0, 30, 52, 60, 70, 80]), "Spare": False,
+                "UserID": mmsi, "Valid": True}}}
+        else:
+            frame = {"MessageType": "PositionReport", "Metadata": metadata, "Message": {"PositionReport": {
+                "Cog": rnd.random() * 360, "CommunicationState": 59916, "Latitude": lat, "Longitude": lon,
+                "MessageID": 1, "NavigationalStatus": 0, "PositionAccuracy": True, "Raim": False, "RateOfTurn": 0,
+                "RepeatIndicator": 0, "Sog": rnd.random() * 20, "Spare": 0, "SpecialManoeuvreIndicator": 0,
+                "Timestamp": i % 60, "TrueHeading": rnd.randint(0, 359), "UserID": mmsi, "Valid": True}}}
+        frames.append(json.dumps(frame))
+    return frames
+
+def best_time(function, repeat):
+    """Fastest of repeat runs of function, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def percentiles(samples):
+    """p50/p95/p99/max of latency samples in milliseconds"""
+    if not samples:
+        return {}
+    values = np.array(samples) * 1000
+    return {f"p{q}": round(float(np.percentile(values, q)), 3) for q in (50, 95, 99)} | {"max": round(float(values.max()), 3)}
+
+def reset_tracker():
+    """Empty the tracker's in-memory state and keep benchmarks away from persistent files"""
+    AIS_vessel.vessels.clear()
+    AIS_vessel.spatial_index = AIS_vessel.SpatialGrid()
+    AIS_vessel.cluster_index = AIS_vessel.ClusterIndex()
+    AIS_vessel.search_index = AIS_vessel.SearchIndex()
+    AIS_vessel.vessel_expiry.clear()
+    AIS_vessel.heatmap = AIS_vessel.HeatmapGrid() if AIS_vessel.HEATMAP else None
+    AIS_vessel.view_cache = AIS_vessel.ViewCache()  # Keys start again from generation 0
+    AIS_vessel.track_store = None
+    AIS_vessel.vessel_journal = None
+    AIS_vessel.filter_enabled = False
+    AIS_vessel.search_term = ""
+
+def bench_decoders(frames, repeat=3):
+    """Messages per second for every installed frame decoder"""
+    results = {}
+    for name, decoder in AIS_vessel.FRAME_DECODERS.items():
+        if decoder is None:
+            print(f"  {name:>8}: not installed")
+            continue
+        elapsed = best_time(lambda: [decoder(frame) for frame in frames], repeat)
+        results[name] = {"messages": len(frames), "seconds": round(elapsed, 4), "messages_per_second": round(len(frames) / elapsed)}
+        print(f"  {name:>8}: {len(frames) / elapsed:>10,.0f} msg/s ({elapsed * 1000:.0f} ms for {len(frames)} frames)")
+    return results
+
+def bench_ingest(frames):
+    """Throughput of process_ais_message on decoded messages and of the batched frame path"""
+    messages = [json.loads(frame) for frame in frames]
+    reset_tracker()
+    started = time.perf_counter()
+    for message in messages:
+        AIS_vessel.process_ais_message(message)
+    per_message = time.perf_counter() - started
+
+    reset_tracker()
+    started = time.perf_counter()
+    for start in range(0, len(frames), AIS_vessel.INGEST_BATCH_SIZE):
+        batch = frames[start:start + AIS_vessel.INGEST_BATCH_SIZE]
+        AIS_vessel.process_ais_reports([report for report in map(AIS_vessel.decode_frame, batch) if report is not None])
+    batched = time.perf_counter() - started
+    result = {
+        "messages": len(frames),
+        "process_ais_message_per_second": round(len(frames) / per_message),
+        "batched_frames_per_second": round(len(frames) / batched)
+    }
+    print(f"  ingest: {result['process_ais_message_per_second']:,} msg/s through process_ais_message, "
+          f"{result['batched_frames_per_second']:,} frames/s decoded and batched ({AIS_vessel.frame_decoder_name})")
+    return result
+
+def bench_create_map(marker_caps):
+    """create_map latency and HTML size for each MAX_MARKERS setting"""
+    results = []
+    original = AIS_vessel.MAX_MARKERS
+    try:
+        for cap in marker_caps:
+            AIS_vessel.MAX_MARKERS = cap
+            AIS_vessel.last_map_key = None  # Unchanged pages are skipped; always measure a full publish
+            started = time.perf_counter()
+            AIS_vessel.create_map()
+            elapsed = time.perf_counter() - started
+            size = os.path.getsize(AIS_vessel.MAP_FILE)
+            results.append({"max_markers": cap, "seconds": round(elapsed, 3), "html_bytes": size})
+            print(f"  create_map: MAX_MARKERS={cap}: {elapsed:.2f}s, {size / 1e6:.1f} MB")
+    finally:
+        AIS_vessel.MAX_MARKERS = original
+    return results
+
+def bench_save_vessel_data(repeat=3):
+    elapsed = best_time(AIS_vessel.save_vessel_data, repeat)
+    size = os.path.getsize("vessel_data.json")
+    print(f"  save_vessel_data: {elapsed * 1000:.0f} ms, {size / 1e6:.1f} MB")
+    return {"seconds": round(elapsed, 4), "json_bytes": size}
+
+def bench_dead_reckoning(repeat=3):
+    """Projecting every positioned vessel to the current time"""
+    snapshot = AIS_vessel.take_snapshot()
+    rows = snapshot.positioned_rows()
+    now = float(snapshot.last_update[rows].max()) + 60 if len(rows) else time.time()
+    elapsed = best_time(lambda: AIS_vessel.dead_reckon(snapshot, rows, now), repeat)
+    print(f"  dead_reckon: {len(rows):,} vessels in {elapsed * 1000:.2f} ms")
+    return {"vessels": len(rows), "seconds": round(elapsed, 5)}
+
+def bench_encounters(repeat=3):
+    """One fleet-wide CPA/TCPA pass with the default thresholds"""
+    snapshot = AIS_vessel.take_snapshot()
+    rows = snapshot.positioned_rows()
+    now = float(snapshot.last_update[rows].max()) + 60 if len(rows) else time.time()
+    result = None
+
+    def run():
+        nonlocal result
+        result = AIS_vessel.encounter_detector.evaluate(snapshot, now)
+    elapsed = best_time(run, repeat)
+    print(f"  encounters: {result['vessels']:,} vessels, {result['candidate_pairs']:,} candidate pairs, "
+          f"{result['count']:,} encounters in {elapsed * 1000:.1f} ms")
+    return {"vessels": result["vessels"], "candidate_pairs": result["candidate_pairs"], "seconds": round(elapsed, 4)}
+
+def bench_heatmap(zoom=6, repeat=3):
+    """Rendering the heatmap PNG tile at the middle of the fleet, and a world-wide summary"""
+    if AIS_vessel.heatmap is None:
+        print("  heatmap: disabled")
+        return {}
+    snapshot = AIS_vessel.take_snapshot()
+    rows = snapshot.positioned_rows()
+    if not len(rows):
+        return {}
+    x, y = AIS_vessel.mercator_cell(float(np.median(snapshot.lat[rows])), float(np.median(snapshot.lon[rows])), 2 ** zoom)
+    AIS_vessel.heatmap.flush()
+    tile = best_time(lambda: AIS_vessel.heatmap_tile(zoom, x, y, "traffic", None, True), repeat)
+    summary = best_time(lambda: AIS_vessel.heatmap.region(-85, -180, 85, 180), repeat)
+    print(f"  heatmap: PNG tile {zoom}/{x}/{y} in {tile * 1000:.2f} ms, world summary in {summary * 1000:.2f} ms")
+    return {"tile": {"seconds": round(tile, 5)}, "summary": {"seconds": round(summary, 5)}}
+
+def bench_find_vessel(terms, clients=8, requests_per_client=200):
+    """/find_vessel latency with concurrent keep-alive clients against the real control server"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), AIS_vessel.FilterControlHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    port = server.server_address[1]
+    latencies = [[] for _ in range(clients)]
+    errors = []
+
+    def client(index):
+        rnd = random.Random(index)
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        try:
+            for _ in range(requests_per_client):
+                term = rnd.choice(terms)
+                started = time.perf_counter()
+                connection.request("GET", f"/find_vessel?term={term}")
+                response = connection.getresponse()
+                response.read()
+                latencies[index].append(time.perf_counter() - started)
+                if response.status != 200:
+                    errors.append(response.status)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+    samples = [latency for client_latencies in latencies for latency in client_latencies]
+    result = {"clients": clients, "requests": len(samples), "errors": len(errors),
+              "requests_per_second": round(len(samples) / elapsed), "latency_ms": percentiles(samples)}
+    print(f"  /find_vessel: {result['requests_per_second']:,} req/s with {clients} clients, "
+          f"p50 {result['latency_ms']['p50']} ms, p99 {result['latency_ms']['p99']} ms")
+    return result
+
+def search_terms(count=200, seed=1):
+    """A mix of MMSIs, name fragments and callsigns currently in the tracker"""
+    rnd = random.Random(seed)
+    snapshot = AIS_vessel.take_snapshot()
+    records = snapshot.records(rnd.sample(list(snapshot.positioned_rows()), min(count, len(snapshot.positioned_rows()))))
+    terms = []
+    for record in records:
+        choice = rnd.random()
+        if choice < 0.4 or not record["name"]:
+            terms.append(record["mmsi"])
+        elif choice < 0.8:
+            word = rnd.choice(record["name"].split())
+            terms.append(word[:rnd.randint(2, len(word))] if len(word) > 2 else word)
+        else:
+            terms.append(record["callsign"] or record["mmsi"])
+    return [term.replace(" ", "+") for term in terms]
+
+def compare(results, baseline, tolerance):
+    """Names of measurements more than tolerance worse than the baseline run"""
+    regressions = []
+
+    def walk(current, previous, path):
+        if isinstance(current, dict) and isinstance(previous, dict):
+            for key in current.keys() & previous.keys():
+                walk(current[key], previous[key], f"{path}.{key}" if path else key)
+        elif isinstance(current, list) and isinstance(previous, list):
+            for i, (now, before) in enumerate(zip(current, previous)):
+                walk(now, before, f"{path}[{i}]")
+        elif isinstance(current, (int, float)) and isinstance(previous, (int, float)) and previous > 0:
+            name = path.rsplit(".", 1)[-1]
+            if name.endswith("per_second") and current < previous * (1 - tolerance):
+                regressions.append(f"{path}: {current} < {previous}")
+            elif (name == "seconds" or path.split(".")[-2:-1] == ["latency_ms"]) and current > previous * (1 + tolerance):
+                regressions.append(f"{path}: {current} > {previous}")
+
+    walk(results["fleets"], baseline.get("fleets", {}), "fleets")
+    walk(results["decoders"], baseline.get("decoders", {}), "decoders")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fleets", default="1000,10000,50000", help="Comma separated fleet sizes (distinct MMSIs)")
+    parser.add_argument("--messages-per-vessel", type=int, default=5, help="Synthetic messages per vessel in each fleet")
+    parser.add_argument("--markers", default="1000,5000", help="MAX_MARKERS values for create_map; 'none' for no cap")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent /find_vessel clients")
+    parser.add_argument("--requests", type=int, default=200, help="/find_vessel requests per client")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per micro-benchmark; the fastest counts")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Baseline results file; exit 1 if anything regressed")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+    fleets = [int(size) for size in args.fleets.split(",")]
+    marker_caps = [None if cap.strip().lower() == "none" else int(cap) for cap in args.markers.split(",")]
+
+    results = {
+        "meta": {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "frame_decoder": AIS_vessel.frame_decoder_name,
+            "messages_per_vessel": args.messages_per_vessel
+        },
+        "decoders": {},
+        "fleets": {}
+    }
+    output_path = os.path.abspath(args.json) if args.json else None
+    baseline = None
+    if args.compare:
+        with open(os.path.abspath(args.compare)) as f:  # Before the chdir below, and before a long run ends on a bad path
+            baseline = json.load(f)
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)  # create_map and save_vessel_data write into the current directory
+    AIS_vessel.MAP_FILE = os.path.join(workdir.name, "vessel_map.html")
+
+    frames = synthetic_frames(10000, 100000)
+    print(f"Frame decoders (100000 frames, best of {args.repeat}):")
+    results["decoders"] = bench_decoders(frames, args.repeat)
+
+    for fleet in fleets:
+        print(f"Fleet of {fleet:,} vessels ({fleet * args.messages_per_vessel:,} messages):")
+        frames = synthetic_frames(fleet, fleet * args.messages_per_vessel, seed=fleet)
+        results["fleets"][str(fleet)] = {
+            "ingest": bench_ingest(frames),
+            "create_map": bench_create_map([cap for cap in marker_caps if cap is None or cap <= fleet] or marker_caps[:1]),
+            "save_vessel_data": bench_save_vessel_data(args.repeat),
+            "dead_reckoning": bench_dead_reckoning(args.repeat),
+            "encounters": bench_encounters(args.repeat),
+            "heatmap": bench_heatmap(repeat=args.repeat),
+            "find_vessel": bench_find_vessel(search_terms(), args.clients, args.requests)
+        }
+
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {output_path}")
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+if __name__ == "__main__":
+    main()